@@ -1,6 +1,6 @@
 from abc import ABC, abstractmethod
-from qrm_defs.resource_definition import Resource, ResourcesRequest, ResourcesRequestResponse
-from typing import List, Dict
+from qrm_defs.resource_definition import Resource, ResourcesRequest, ResourcesRequestResponse, TokenState
+from typing import AsyncIterator, List, Dict, Tuple
 
 
 class QrmBaseDB(ABC):
@@ -80,6 +80,10 @@ class QrmBaseDB(ABC):
     async def get_token_resources(self, token: str) -> List[Resource]:
         pass
 
+    @abstractmethod
+    async def get_resources_tokens(self, resources_names: List[str]) -> Dict[str, str]:
+        pass
+
     @abstractmethod
     async def add_resources_request(self, resources_req: ResourcesRequest) -> None:
         pass
@@ -101,7 +105,8 @@ class QrmBaseDB(ABC):
         pass
 
     @abstractmethod
-    async def partial_fill_request(self, token: str, resource: Resource) -> None:
+    async def partial_fill_request(self, token: str, resource: Resource, req_index: int = None,
+                                   owner: str = '', claim: bool = False) -> bool:
         pass
 
     @abstractmethod
@@ -124,6 +129,27 @@ class QrmBaseDB(ABC):
     async def is_request_filled(self, token: str) -> bool:
         pass
 
+    @abstractmethod
+    async def get_token_state(self, token: str) -> TokenState or None:
+        pass
+
+    @abstractmethod
+    async def get_all_tokens_state(self) -> Dict[str, TokenState]:
+        pass
+
+    @abstractmethod
+    def scan_tokens_state(self, batch_size: int) -> AsyncIterator[Dict[str, TokenState]]:
+        pass
+
+    @abstractmethod
+    def scan_open_requests_tokens(self, batch_size: int) -> AsyncIterator[List[str]]:
+        pass
+
+    @abstractmethod
+    async def set_token_state(self, token: str, state: str, grants: List[str] = None,
+                              rrr: ResourcesRequestResponse = None) -> None:
+        pass
+
     @abstractmethod
     async def get_active_token_from_user_token(self, user_token: str) -> str:
         pass
@@ -144,10 +170,30 @@ class QrmBaseDB(ABC):
     async def set_req_resp(self, rrr: ResourcesRequestResponse) -> None:
         pass
 
+    @abstractmethod
+    async def bump_token_revision(self, *tokens: str) -> None:
+        pass
+
+    @abstractmethod
+    async def get_token_revision(self, token: str) -> int:
+        pass
+
     @abstractmethod
     async def get_all_open_tokens(self) -> List[str]:
         pass
 
+    @abstractmethod
+    async def get_tokens_status_snapshot(self, tokens: List[str]) -> dict:
+        pass
+
+    @abstractmethod
+    async def set_req_resps(self, rrrs: List[ResourcesRequestResponse]) -> None:
+        pass
+
+    @abstractmethod
+    async def update_tokens_last_update_time(self, tokens_last_update: Dict[str, str]) -> None:
+        pass
+
     @abstractmethod
     async def get_resources_names_by_tags(self, tags: List[str]) -> List[str]:
         pass
@@ -191,3 +237,96 @@ class QrmBaseDB(ABC):
     @abstractmethod
     async def delete_auto_managed_token(self, token: str) -> None:
         pass
+
+    @abstractmethod
+    async def fill_request_at_once(self, token: str, grants: List[Tuple[Resource, int]], owner: str = '') -> bool:
+        pass
+
+    @abstractmethod
+    async def requeue_active_job(self, token: str, resource: Resource) -> bool:
+        pass
+
+    @abstractmethod
+    async def backfill_job(self, resource: Resource, active_token: str, token: str) -> bool:
+        pass
+
+    @abstractmethod
+    async def get_resources_holders(self, resources_names: List[str]) -> Dict[str, dict]:
+        pass
+
+    @abstractmethod
+    async def get_hold_times(self, owners: List[str]) -> Dict[str, float]:
+        pass
+
+    @abstractmethod
+    async def set_owner_share(self, owner: str, weight: float = None, max_held: int = None) -> None:
+        pass
+
+    @abstractmethod
+    async def get_owners_usage(self) -> Dict[str, dict]:
+        pass
+
+    @abstractmethod
+    async def add_job_to_pool(self, names: List[str], job: dict, count: int) -> Tuple[str, List[str]]:
+        pass
+
+    @abstractmethod
+    async def hand_over_to_pools(self, resource: Resource) -> str or None:
+        pass
+
+    @abstractmethod
+    async def get_pool_queue(self, pool_id: str) -> List[str]:
+        pass
+
+    @abstractmethod
+    async def get_pool_handed(self, token: str) -> List[str]:
+        pass
+
+    @abstractmethod
+    async def set_token_pools(self, token: str, pools: Dict[int, str]) -> None:
+        pass
+
+    @abstractmethod
+    async def get_token_pools(self, token: str) -> Dict[int, str]:
+        pass
+
+    @abstractmethod
+    async def remove_pool_jobs(self, token: str) -> None:
+        pass
+
+    @abstractmethod
+    async def publish_token_event(self, token: str, reason: str = None, resources: List[str] = None,
+                                  instance_id: str = '') -> None:
+        pass
+
+    @abstractmethod
+    async def set_token_instance(self, token: str, instance_id: str) -> None:
+        pass
+
+    @abstractmethod
+    async def get_tokens_instance(self, tokens: List[str] = None) -> Dict[str, str]:
+        pass
+
+    @abstractmethod
+    async def remove_token_instance(self, token: str) -> None:
+        pass
+
+    @abstractmethod
+    async def set_tokens_instance(self, tokens: List[str], instance_id: str) -> None:
+        pass
+
+    @abstractmethod
+    async def acquire_lease(self, instance_id: str, lease_time: float) -> bool:
+        pass
+
+    @abstractmethod
+    async def renew_lease(self, instance_id: str, lease_time: float) -> bool:
+        pass
+
+    @abstractmethod
+    async def release_lease(self, instance_id: str) -> None:
+        pass
+
+    @abstractmethod
+    async def get_leader(self) -> str or None:
+        pass
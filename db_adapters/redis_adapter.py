@@ -3,39 +3,490 @@ import time
 import aioredis
 import asyncio
 import async_timeout
+import hashlib
 import json
 import logging
+import math
 
 from qrm_defs import resource_definition
-from qrm_defs.resource_definition import Resource, ALLOWED_SERVER_STATUSES, ResourcesRequest, ResourcesRequestResponse
+from qrm_defs.resource_definition import Resource, ALLOWED_SERVER_STATUSES, ResourcesRequest, ResourcesRequestResponse, \
+    resource_db_name, TokenState, TOKEN_QUEUED, TOKEN_PARTIAL, TOKEN_WAITING_ACTIVE, TOKEN_FILLED, TOKEN_INVALID
 from db_adapters.qrm_db import QrmBaseDB
-from typing import Dict, List
+from typing import AsyncIterator, Callable, Dict, List, Tuple
 
 
 CHANNEL_RES_CHANGE_EVENT = 'channel:res_change_event'
-PARTIAL_FILL_REQUESTS = 'fill_requests'
+CHANNEL_TOKEN_CHANGE_EVENT = 'channel:token_change_event'  # token events between qrm server instances
+# every instance gets the events of its tokens in channel:token_change_event:<instance id>,
+# the events of tokens without instance are published to CHANNEL_TOKEN_CHANGE_EVENT
+PARTIAL_FILL_REQUESTS = 'fill_requests'  # used only by DBs from older versions, replaced by FILL_REQUEST lists
+FILL_REQUEST = 'fill_request'  # list of the granted resources names per token
 OPEN_REQUESTS = 'open_requests'
+OPEN_REQUEST_COUNTS = 'open_request_counts'  # remaining count per names group of open request
+OPEN_REQUEST_NAMES = 'open_request_names'  # list of remaining candidates per names group of open request
 ORIG_REQUESTS = 'orig_requests'
 ALL_RESOURCES = 'all_resources'
 SERVER_STATUS_IN_DB = 'qrm_status'
 ACTIVE_STATUS = 'active'
 TOKEN_RESOURCES_MAP = 'token_dict'
+RESOURCE_TOKEN_MAP = 'resource_token_map'
 ACTIVE_TOKEN_DICT = 'active_token_dict'
 LAST_REQ_RESP = 'last_req_resp'
+TOKEN_REVISION = 'last_req_resp_revision'
+TOKEN_STATE = 'token_state'
 TAGS_RES_NAME_MAP = 'tag_res_name_map'
 TOKEN_LAST_UPDATE = 'token_last_update_time'
 MANAGED_TOKENS = 'managed_tokens_list'
 PUBSUB_POLLING_TIME = 0.1
+PRIORITY_AGING_TIME = 600  # seconds, every waiting period of this time raises the job priority by one
+JOB_SEQUENCE = 'job_sequence'  # global counter, orders the jobs that were added to several queues
+OWNER_USAGE = 'owner_usage'  # owner -> {usage: decayed resource-seconds, held: resources held now, time: last update}
+RESOURCE_OWNER = 'resource_owner'  # resource name -> {owner, token, time} of the granted token
+HOLD_TIME = 'hold_time'  # owner -> moving average of the time its tokens hold a resource, '*' for all the owners
+ALL_OWNERS_HOLD_TIME = '*'
+OWNER_WEIGHTS = 'owner_weights'
+OWNER_CAPS = 'owner_caps'  # max resources an owner holds before owners below their cap pass it
+OWNER_USAGE_DECAY_TIME = 3600  # seconds, usage older than this weighs e times less
+DEFAULT_OWNER_WEIGHT = 1
+POOLS = 'pools'  # pool id -> sorted names of the pool resources, a pool is the candidates of a large names group
+POOL_QUEUE = 'pool_queue'  # list of the tokens that wait for the pool, head first, per pool
+POOL_JOBS = 'pool_jobs'  # token -> job json of the tokens that wait for the pool, per pool
+POOL_COUNTS = 'pool_counts'  # token -> number of resources the token still waits for, per pool
+RESOURCE_POOLS = 'resource_pools'  # set of the pools of the resource, per resource
+POOL_HANDED = 'pool_handed'  # token -> list of the resources that the token pools handed to it
+TOKEN_POOLS = 'token_pools'  # token -> {names group index: pool id} of the token groups that wait in pools
+TOKEN_INSTANCE = 'token_instance'  # token -> id of the qrm server instance that runs the token worker
+LEADER_LEASE = 'leader_lease'  # id of the qrm server instance that runs the workers, expires unless it's renewed
+
+# add job to resources queues in one atomic step, every queue is ordered by (effective priority, sequence).
+# the queue head (the active job) is always kept, so the job is added behind the head and behind
+# every job with effective priority >= the job priority, only jobs with lower effective priority are passed.
+# effective priority = priority + waiting time / aging time, so waiting jobs can't be passed forever.
+# jobs without enqueue_time (added without priority) are never passed.
+# a job that waits for several queues can hold some of its resources while it waits for the others,
+# so a job of several queues never passes another job of several queues ('queues' > 1, missing is several).
+# these jobs are in sequence order in all the queues, and the job with the lowest sequence always gets all
+# its resources, so two requests can't wait forever for each other's resources.
+# with sequence, the job gets the next global sequence number, the job json must end with "}"
+# and the number is added as its last "seq" key, the same as json.dumps of the job with "seq".
+# KEYS: JOB_SEQUENCE, resources queues
+# ARGV: job json, job priority, current time, aging time (0 disables aging), add sequence (1 or 0)
+# returns the job sequence number or 0
+ENQUEUE_JOBS_SCRIPT = """
+local priority = tonumber(ARGV[2])
+local now = tonumber(ARGV[3])
+local aging_time = tonumber(ARGV[4])
+local single_queue = #KEYS == 2
+local job_json = ARGV[1]
+local seq = 0
+if ARGV[5] == '1' then
+    seq = redis.call('INCR', KEYS[1])
+    job_json = string.sub(job_json, 1, -2) .. ', "seq": ' .. seq .. '}'
+end
+
+local function is_passed(job)
+    if job['enqueue_time'] == nil or (not single_queue and job['queues'] ~= 1) then
+        return false
+    end
+    local job_priority = tonumber(job['priority']) or 0
+    if aging_time > 0 then
+        job_priority = job_priority + (now - tonumber(job['enqueue_time'])) / aging_time
+    end
+    return job_priority < priority
+end
+
+for index = 2, #KEYS do
+    local jobs = redis.call('LRANGE', KEYS[index], 0, -1)
+    -- jobs[1] is the last job in queue, jobs[#jobs - 1] is the head and jobs[#jobs] is the empty job
+    local pivot = nil
+    for job_index = 1, #jobs - 1 do
+        if job_index == #jobs - 1 or not is_passed(cjson.decode(jobs[job_index])) then
+            pivot = job_index
+            break
+        end
+    end
+    if pivot == nil or pivot == 1 then
+        redis.call('LPUSH', KEYS[index], job_json)
+    else
+        redis.call('LINSERT', KEYS[index], 'BEFORE', jobs[pivot], job_json)
+    end
+end
+return seq
+"""
+
+# owner usage accounting, shared by the scripts that grant and release resources.
+# the usage is updated only when the number of held resources changes, between updates it's computed from
+# the last update: usage * decay + held * decay_time * (1 - decay), decay = e^(-dt / decay_time)
+# this is the same as RedisDB.decayed_owner_usage
+# the hold time of every released resource updates the owner hold time moving average (weight 0.2 to the last one)
+OWNER_USAGE_FUNCTIONS = """
+local function owner_usage(usage_key, owner, now, decay_time)
+    local entry = {usage = 0, held = 0, time = now}
+    local entry_json = redis.call('HGET', usage_key, owner)
+    if entry_json then
+        entry = cjson.decode(entry_json)
+    end
+    local decay = math.exp(-math.max(now - entry['time'], 0) / decay_time)
+    entry['usage'] = entry['usage'] * decay + entry['held'] * decay_time * (1 - decay)
+    entry['time'] = now
+    return entry
+end
+
+local function add_owner_held(usage_key, owner, delta, now, decay_time)
+    local entry = owner_usage(usage_key, owner, now, decay_time)
+    entry['held'] = math.max(entry['held'] + delta, 0)
+    redis.call('HSET', usage_key, owner, cjson.encode(entry))
+end
+
+-- moving average of the hold time, of the owner and of all the owners ('*')
+local function add_hold_time(hold_key, owner, hold_time)
+    for _, field in ipairs({owner, '*'}) do
+        local average = tonumber(redis.call('HGET', hold_key, field))
+        if average then
+            average = average + 0.2 * (hold_time - average)
+        else
+            average = hold_time
+        end
+        redis.call('HSET', hold_key, field, average)
+    end
+end
+
+-- release the resource from its owner, token '' releases it from any token
+local function release_resource_owner(owner_key, usage_key, hold_key, resource_name, token, now, decay_time)
+    local holder_json = redis.call('HGET', owner_key, resource_name)
+    if not holder_json then
+        return 0
+    end
+    local holder = cjson.decode(holder_json)
+    if token ~= '' and holder['token'] ~= token then
+        return 0
+    end
+    redis.call('HDEL', owner_key, resource_name)
+    add_owner_held(usage_key, holder['owner'], -1, now, decay_time)
+    if holder['time'] then
+        add_hold_time(hold_key, holder['owner'], math.max(now - holder['time'], 0))
+    end
+    return 1
+end
+"""
+
+# KEYS: RESOURCE_OWNER, OWNER_USAGE, HOLD_TIME
+# ARGV: resource name, token ('' for any token), current time, usage decay time
+RELEASE_RESOURCE_OWNER_SCRIPT = OWNER_USAGE_FUNCTIONS + """
+return release_resource_owner(KEYS[1], KEYS[2], KEYS[3], ARGV[1], ARGV[2], tonumber(ARGV[3]), tonumber(ARGV[4]))
+"""
+
+# grant resource to a token in one atomic step:
+# append the resource to the token fill list, rewrite the token response and state from the fill list,
+# move the resource usage accounting to the token owner
+# and if the grant belongs to a names group, decrease the group count and remove the resource from its candidates.
+# the state update is the same as TokenState.transition to TOKEN_PARTIAL
+# with claim, the resource is granted only if the token job is the resource active job and the resource
+# isn't disabled, so instances that share the DB can't grant the same resource twice.
+# KEYS: fill list, LAST_REQ_RESP, TOKEN_STATE, TOKEN_REVISION, RESOURCE_OWNER, OWNER_USAGE, HOLD_TIME,
+# resource queue, ALL_RESOURCES, [open request counts, group candidates list]
+# ARGV: token, resource name, time, empty response json of the token, owner, usage decay time, claim (1 or 0),
+# [group index]
+# returns 1 if granted, 0 if the resource was already granted to the token, -1 if the claim failed
+GRANT_RESOURCE_SCRIPT = OWNER_USAGE_FUNCTIONS + """
+local token = ARGV[1]
+local resource_name = ARGV[2]
+if ARGV[7] == '1' then
+    local active_job_json = redis.call('LINDEX', KEYS[8], -2)
+    local resource_json = redis.call('HGET', KEYS[9], resource_name)
+    if not active_job_json or cjson.decode(active_job_json)['token'] ~= token or not resource_json or
+            cjson.decode(resource_json)['status'] == 'disabled' then
+        return -1
+    end
+end
+if redis.call('LPOS', KEYS[1], resource_name) then
+    return 0
+end
+redis.call('RPUSH', KEYS[1], resource_name)
+local fills = redis.call('LRANGE', KEYS[1], 0, -1)
+
+local rrr = cjson.decode(ARGV[4])
+rrr['names'] = fills
+redis.call('HSET', KEYS[2], token, cjson.encode(rrr))
+
+local token_state_json = redis.call('HGET', KEYS[3], token)
+local token_state = {token = token, state = '', grants = {}, timestamps = {}}
+if token_state_json then
+    token_state = cjson.decode(token_state_json)
+end
+if token_state['state'] ~= 'canceled' and token_state['state'] ~= 'invalid' then
+    token_state['state'] = 'partial'
+    token_state['grants'] = fills
+    if not token_state['timestamps']['partial'] then
+        token_state['timestamps']['partial'] = tonumber(ARGV[3])
+    end
+    redis.call('HSET', KEYS[3], token, cjson.encode(token_state))
+end
+
+local now = tonumber(ARGV[3])
+local decay_time = tonumber(ARGV[6])
+release_resource_owner(KEYS[5], KEYS[6], KEYS[7], resource_name, '', now, decay_time)
+redis.call('HSET', KEYS[5], resource_name, cjson.encode({owner = ARGV[5], token = token, time = now}))
+add_owner_held(KEYS[6], ARGV[5], 1, now, decay_time)
+
+if #KEYS == 11 and redis.call('HEXISTS', KEYS[10], ARGV[8]) == 1 then
+    redis.call('HINCRBY', KEYS[10], ARGV[8], -1)
+    redis.call('LREM', KEYS[11], 1, resource_name)
+end
+redis.call('HINCRBY', KEYS[4], token, 1)
+return 1
+"""
+
+# remove job from resource queue and release the resource usage accounting if the job token holds the resource.
+# with fair share, when the removed job was the active job, the next active job is the waiting job whose owner
+# has the lowest usage / weight, from the jobs with the highest priority.
+# owners that hold their cap are passed by owners below their cap, ties are kept in arrival order.
+# a job that waits for several queues ('queues' > 1) passes only jobs that wait for this queue alone,
+# so the jobs of several queues stay in sequence order (see ENQUEUE_JOBS_SCRIPT).
+# if one of the waiting jobs has no owner (added by older version) the queue order is kept.
+# KEYS: resource queue, RESOURCE_OWNER, OWNER_USAGE, OWNER_WEIGHTS, OWNER_CAPS, HOLD_TIME
+# ARGV: job json, resource name, token, current time, usage decay time, use fair share (1 or 0)
+REMOVE_JOB_SCRIPT = OWNER_USAGE_FUNCTIONS + """
+local now = tonumber(ARGV[4])
+local decay_time = tonumber(ARGV[5])
+local was_active = redis.call('LINDEX', KEYS[1], -2) == ARGV[1]
+if redis.call('LREM', KEYS[1], 1, ARGV[1]) == 0 then
+    return 0
+end
+release_resource_owner(KEYS[2], KEYS[3], KEYS[6], ARGV[2], ARGV[3], now, decay_time)
+if not was_active or ARGV[6] ~= '1' then
+    return 1
+end
+
+local jobs = redis.call('LRANGE', KEYS[1], 0, -1)
+-- jobs[#jobs - 1] is the new active job and jobs[#jobs] is the empty job
+if #jobs < 3 then
+    return 1
+end
+local candidates = {}
+local max_priority = nil
+local passes_single_queue_jobs = true
+for index = #jobs - 1, 1, -1 do
+    local job = cjson.decode(jobs[index])
+    if type(job['owner']) ~= 'string' then
+        return 1
+    end
+    local single_queue = job['queues'] == 1
+    if passes_single_queue_jobs or single_queue then
+        local priority = tonumber(job['priority']) or 0
+        if max_priority == nil or priority > max_priority then
+            max_priority = priority
+        end
+        table.insert(candidates, {json = jobs[index], owner = job['owner'], priority = priority})
+    end
+    passes_single_queue_jobs = passes_single_queue_jobs and single_queue
+end
+
+local best = nil
+for _, candidate in ipairs(candidates) do
+    if candidate['priority'] == max_priority then
+        local entry = owner_usage(KEYS[3], candidate['owner'], now, decay_time)
+        local weight = tonumber(redis.call('HGET', KEYS[4], candidate['owner'])) or 1
+        local cap = tonumber(redis.call('HGET', KEYS[5], candidate['owner']))
+        candidate['capped'] = cap ~= nil and entry['held'] >= cap
+        candidate['share'] = entry['usage'] / weight
+        if best == nil or (best['capped'] and not candidate['capped']) or
+                (best['capped'] == candidate['capped'] and candidate['share'] < best['share']) then
+            best = candidate
+        end
+    end
+end
+if best['json'] ~= jobs[#jobs - 1] then
+    redis.call('LREM', KEYS[1], 1, best['json'])
+    redis.call('LINSERT', KEYS[1], 'BEFORE', jobs[#jobs], best['json'])
+end
+return 1
+"""
+
+
+# move the active job of the resource behind the next job in the queue, so the next job becomes active
+# KEYS: resource queue
+# ARGV: job json
+REQUEUE_ACTIVE_JOB_SCRIPT = """
+local jobs = redis.call('LRANGE', KEYS[1], 0, -1)
+-- jobs[#jobs - 2] is the next job, jobs[#jobs - 1] is the head and jobs[#jobs] is the empty job
+if #jobs < 3 or jobs[#jobs - 1] ~= ARGV[1] then
+    return 0
+end
+redis.call('LREM', KEYS[1], 1, ARGV[1])
+redis.call('LINSERT', KEYS[1], 'BEFORE', jobs[#jobs - 2], ARGV[1])
+return 1
+"""
+
+
+# move the job in front of the active job, if the active job is still the same
+# KEYS: resource queue
+# ARGV: active job json, job json
+BACKFILL_JOB_SCRIPT = """
+local jobs = redis.call('LRANGE', KEYS[1], 0, -1)
+-- jobs[#jobs - 1] is the head and jobs[#jobs] is the empty job
+if #jobs < 3 or jobs[#jobs - 1] ~= ARGV[1] or redis.call('LREM', KEYS[1], 1, ARGV[2]) == 0 then
+    return 0
+end
+redis.call('LINSERT', KEYS[1], 'AFTER', ARGV[1], ARGV[2])
+return 1
+"""
+
+
+# extend the lease, if it's still held by the instance
+# KEYS: lease key
+# ARGV: instance id, lease time in milliseconds
+RENEW_LEASE_SCRIPT = """
+if redis.call('GET', KEYS[1]) ~= ARGV[1] then
+    return 0
+end
+redis.call('PEXPIRE', KEYS[1], ARGV[2])
+return 1
+"""
+
+
+# delete the lease, if it's still held by the instance
+# KEYS: lease key
+# ARGV: instance id
+RELEASE_LEASE_SCRIPT = """
+if redis.call('GET', KEYS[1]) ~= ARGV[1] then
+    return 0
+end
+return redis.call('DEL', KEYS[1])
+"""
+
+
+# publish the token event to the channel of the instance that runs the token worker
+# KEYS: TOKEN_INSTANCE
+# ARGV: token, event json, token events channel
+PUBLISH_TOKEN_EVENT_SCRIPT = """
+local instance = redis.call('HGET', KEYS[1], ARGV[1])
+if instance then
+    return redis.call('PUBLISH', ARGV[3] .. ':' .. instance, ARGV[2])
+end
+return redis.call('PUBLISH', ARGV[3], ARGV[2])
+"""
+
+
+# pool queues, shared by the scripts that hand pool resources to the jobs that wait for the pool.
+# a resource is free when its queue has only the empty job and the resource exists and isn't disabled,
+# a free resource is handed to a job by making the job the resource active job.
+POOL_FUNCTIONS = """
+local function is_free(queue_key, resources_key, resource_name)
+    if redis.call('LLEN', queue_key) ~= 1 then
+        return false
+    end
+    local resource_json = redis.call('HGET', resources_key, resource_name)
+    return resource_json ~= false and cjson.decode(resource_json)['status'] ~= 'disabled'
+end
+
+local function hand_over(queue_key, handed_key, resource_name, token, job_json)
+    redis.call('LPUSH', queue_key, job_json)
+    local handed = {}
+    local handed_json = redis.call('HGET', handed_key, token)
+    if handed_json then
+        handed = cjson.decode(handed_json)
+    end
+    table.insert(handed, resource_name)
+    redis.call('HSET', handed_key, token, cjson.encode(handed))
+end
+"""
+
+# add job to the pool queue, if no job waits for the pool the free pool resources are handed to the job first
+# KEYS: pool queue, pool jobs, pool counts, ALL_RESOURCES, POOL_HANDED, pool resources queues
+# ARGV: token, job json, count, pool resources names (in the order of their queues)
+# returns the names of the resources that were handed to the job
+POOL_ENQUEUE_SCRIPT = POOL_FUNCTIONS + """
+local token = ARGV[1]
+local count = tonumber(ARGV[3])
+local handed = {}
+if redis.call('LLEN', KEYS[1]) == 0 then
+    for index = 6, #KEYS do
+        if count == 0 then
+            break
+        end
+        if is_free(KEYS[index], KEYS[4], ARGV[index - 2]) then
+            hand_over(KEYS[index], KEYS[5], ARGV[index - 2], token, ARGV[2])
+            table.insert(handed, ARGV[index - 2])
+            count = count - 1
+        end
+    end
+end
+if count > 0 then
+    redis.call('RPUSH', KEYS[1], token)
+    redis.call('HSET', KEYS[2], token, ARGV[2])
+    redis.call('HSET', KEYS[3], token, count)
+end
+return handed
+"""
+
+# hand free resource to the job with the lowest sequence from the heads of the resource pools,
+# the job leaves the pool queue when it got all the resources it waits for.
+# KEYS: resource queue, ALL_RESOURCES, POOL_HANDED, (pool queue, pool jobs, pool counts) of every resource pool
+# ARGV: resource name
+# returns the token of the job or nil
+HAND_OVER_SCRIPT = POOL_FUNCTIONS + """
+if not is_free(KEYS[1], KEYS[2], ARGV[1]) then
+    return false
+end
+local best = nil
+for index = 4, #KEYS, 3 do
+    local token = redis.call('LINDEX', KEYS[index], 0)
+    local job_json = token and redis.call('HGET', KEYS[index + 1], token)
+    if job_json then
+        local seq = tonumber(cjson.decode(job_json)['seq']) or 0
+        if best == nil or seq < best['seq'] then
+            best = {index = index, token = token, json = job_json, seq = seq}
+        end
+    end
+end
+if best == nil then
+    return false
+end
+hand_over(KEYS[1], KEYS[3], ARGV[1], best['token'], best['json'])
+if redis.call('HINCRBY', KEYS[best['index'] + 2], best['token'], -1) <= 0 then
+    redis.call('LPOP', KEYS[best['index']])
+    redis.call('HDEL', KEYS[best['index'] + 1], best['token'])
+    redis.call('HDEL', KEYS[best['index'] + 2], best['token'])
+end
+return best['token']
+"""
 
 
 class RedisDB(QrmBaseDB):
     def __init__(self,
                  redis_port: int = 6379,
-                 pubsub_polling_time: float = PUBSUB_POLLING_TIME):
+                 pubsub_polling_time: float = PUBSUB_POLLING_TIME,
+                 priority_aging_time: float = PRIORITY_AGING_TIME,
+                 use_fair_share: bool = False,
+                 owner_usage_decay_time: float = OWNER_USAGE_DECAY_TIME,
+                 instance_id: str = ''):
+        """
+        :param instance_id: id of the qrm server instance, it gets the token events of its tokens only
+        """
         self.redis = aioredis.from_url(
             f"redis://localhost:{redis_port}", encoding="utf-8", decode_responses=True
         )
         self.res_status_change_event = {}  # type: Dict[str, asyncio.Event]
+        self.token_change_callbacks = []  # type: List[Callable[[str], None]]
+        self.token_event_callbacks = []  # type: List[Callable[[dict], None]]
+        self.grant_resource_script = self.redis.register_script(GRANT_RESOURCE_SCRIPT)
+        self.enqueue_jobs_script = self.redis.register_script(ENQUEUE_JOBS_SCRIPT)
+        self.remove_job_script = self.redis.register_script(REMOVE_JOB_SCRIPT)
+        self.release_resource_owner_script = self.redis.register_script(RELEASE_RESOURCE_OWNER_SCRIPT)
+        self.requeue_active_job_script = self.redis.register_script(REQUEUE_ACTIVE_JOB_SCRIPT)
+        self.backfill_job_script = self.redis.register_script(BACKFILL_JOB_SCRIPT)
+        self.pool_enqueue_script = self.redis.register_script(POOL_ENQUEUE_SCRIPT)
+        self.hand_over_script = self.redis.register_script(HAND_OVER_SCRIPT)
+        self.renew_lease_script = self.redis.register_script(RENEW_LEASE_SCRIPT)
+        self.release_lease_script = self.redis.register_script(RELEASE_LEASE_SCRIPT)
+        self.publish_token_event_script = self.redis.register_script(PUBLISH_TOKEN_EVENT_SCRIPT)
+        self.token_event_channels = [CHANNEL_TOKEN_CHANGE_EVENT]
+        if instance_id:
+            self.token_event_channels.append(self.instance_channel(instance_id))
+        self.priority_aging_time = priority_aging_time
+        self.use_fair_share = use_fair_share
+        self.owner_usage_decay_time = owner_usage_decay_time
         self.pub_sub = self.redis.pubsub()
         self.pubsub_polling_time = pubsub_polling_time
         self.all_tasks = set()  # type: [asyncio.Task]
@@ -45,12 +496,19 @@ class RedisDB(QrmBaseDB):
         self.is_running = True
 
     async def pubsub_reader(self):
-        await self.pub_sub.subscribe(CHANNEL_RES_CHANGE_EVENT)
+        await self.pub_sub.subscribe(CHANNEL_RES_CHANGE_EVENT, *self.token_event_channels)
         while self.is_running:
             try:
                 async with async_timeout.timeout(PUBSUB_POLLING_TIME):
                     message = await self.pub_sub.get_message(ignore_subscribe_messages=True)
-                    if message is not None:
+                    if message is None:
+                        # read the next messages at once, token events wake up waiting workers
+                        await asyncio.sleep(PUBSUB_POLLING_TIME)
+                    elif message.get('channel') in self.token_event_channels:
+                        token_event = json.loads(message.get('data'))
+                        for callback in self.token_event_callbacks:
+                            callback(token_event)
+                    else:
                         try:
                             res_name = message.get('data')
                             self.res_status_change_event[res_name].set()
@@ -59,10 +517,9 @@ class RedisDB(QrmBaseDB):
                         except KeyError as e:
                             self.res_status_change_event[res_name] = asyncio.Event()
                             self.res_status_change_event[res_name].set()
-                    await asyncio.sleep(PUBSUB_POLLING_TIME)
             except asyncio.TimeoutError:
                 pass
-        await self.pub_sub.unsubscribe(CHANNEL_RES_CHANGE_EVENT)
+        await self.pub_sub.unsubscribe(CHANNEL_RES_CHANGE_EVENT, *self.token_event_channels)
         logging.info('done with pubsub reader')
 
     async def init_params_blocking(self) -> None:
@@ -72,8 +529,74 @@ class RedisDB(QrmBaseDB):
     async def init_default_params(self) -> None:
         await self.set_qrm_status(status=ACTIVE_STATUS)
         await self.init_events_for_resources()
+        await self.rebuild_resource_token_map()
+        await self.rebuild_tokens_state()
+        await self.rebuild_open_requests()
         self.is_running = True
 
+    async def rebuild_resource_token_map(self) -> None:
+        """
+        build the resource -> owner token map from the resources,
+        needed for DBs that were created before the map existed
+        """
+        resources_tokens = {resource.name: resource.token for resource in await self.get_all_resources()
+                            if resource.token}
+        async with self.redis.pipeline(transaction=True) as pipe:
+            pipe.delete(RESOURCE_TOKEN_MAP)
+            if resources_tokens:
+                pipe.hset(RESOURCE_TOKEN_MAP, mapping=resources_tokens)
+            await pipe.execute()
+
+    async def rebuild_tokens_state(self) -> None:
+        """
+        build the state record of tokens from DBs that were created before the record existed
+        """
+        async with self.redis.pipeline(transaction=False) as pipe:
+            pipe.hgetall(TOKEN_STATE)
+            pipe.hgetall(TOKEN_RESOURCES_MAP)
+            pipe.hgetall(OPEN_REQUESTS)
+            pipe.hgetall(PARTIAL_FILL_REQUESTS)
+            tokens_state, tokens_map, open_requests, partial_fills = await pipe.execute()
+        legacy_tokens = (set(tokens_map) | set(open_requests) | set(partial_fills)) - set(tokens_state)
+        legacy_tokens_state = {}
+        for token in legacy_tokens:
+            token_state = self.legacy_token_state(token, tokens_map.get(token), open_requests.get(token),
+                                                  partial_fills.get(token))
+            legacy_tokens_state[token] = token_state.to_json()
+        if legacy_tokens_state:
+            logging.info(f'build state for tokens {list(legacy_tokens_state)}')
+            await self.redis.hset(TOKEN_STATE, mapping=legacy_tokens_state)
+
+    async def rebuild_open_requests(self) -> None:
+        """
+        move open requests and partial fills from DBs of older versions to the incremental structures
+        """
+        async with self.redis.pipeline(transaction=False) as pipe:
+            pipe.hgetall(OPEN_REQUESTS)
+            pipe.hgetall(PARTIAL_FILL_REQUESTS)
+            open_requests, partial_fills = await pipe.execute()
+        if open_requests:
+            async with self.redis.pipeline(transaction=False) as pipe:
+                for token in open_requests:
+                    pipe.exists(self.open_request_counts_key(token))
+                has_counts = await pipe.execute()
+            legacy_requests = [token for token, exists in zip(open_requests, has_counts) if not exists]
+        else:
+            legacy_requests = []
+        if not legacy_requests and not partial_fills:
+            return
+        logging.info(f'move open requests {legacy_requests} and partial fills {list(partial_fills)} '
+                     f'to incremental structures')
+        async with self.redis.pipeline(transaction=True) as pipe:
+            for token in legacy_requests:
+                resources_req = resource_definition.resource_request_from_json(open_requests[token])
+                self.pipe_set_open_request_groups(pipe, token, resources_req)
+            for token, partial_fill_json in partial_fills.items():
+                pipe.delete(self.fill_request_key(token))
+                pipe.rpush(self.fill_request_key(token), *json.loads(partial_fill_json))
+            pipe.delete(PARTIAL_FILL_REQUESTS)
+            await pipe.execute()
+
     async def init_events_for_resources(self) -> None:
         all_resources = await self.get_all_resources()
         for resource in all_resources:
@@ -123,6 +646,8 @@ class RedisDB(QrmBaseDB):
                 logging.warning(f'resource {resource.name} already exists')
                 return False
         await self.redis.hset(ALL_RESOURCES, resource.name, resource.to_json())
+        if resource.token:
+            await self.redis.hset(RESOURCE_TOKEN_MAP, resource.name, resource.token)
         await self.redis.rpush(resource.db_name(), json.dumps({}))
         await self.add_tags_to_map(resource)
         await self.init_event_for_resource(resource)
@@ -145,9 +670,15 @@ class RedisDB(QrmBaseDB):
         return ret_list
 
     async def remove_resource(self, resource: Resource) -> bool:
+        resource_in_db = await self.get_resource_by_name(resource.name)
         remove_step1 = await self.remove_all_tags_from_resource(resource)
         remove_step2 = await self.redis.delete(resource.db_name())
         remove_step3 = await self.redis.hdel(ALL_RESOURCES, resource.name)
+        await self.redis.hdel(RESOURCE_TOKEN_MAP, resource.name)
+        await self.release_resource_owner_script(keys=[RESOURCE_OWNER, OWNER_USAGE, HOLD_TIME],
+                                                 args=[resource.name, '', time.time(), self.owner_usage_decay_time])
+        if resource_in_db and resource_in_db.token:
+            await self.bump_token_revision(resource_in_db.token)
 
         if remove_step1 and remove_step2 and remove_step3:
             return True
@@ -204,7 +735,105 @@ class RedisDB(QrmBaseDB):
         return resource_obj.type
 
     async def add_job_to_resource(self, resource: Resource, job: dict) -> bool:
-        return await self.redis.lpush(resource.db_name(), json.dumps(job))
+        """
+        add the job to the resource queue, by default at the end of the queue.
+        job with 'priority' and 'enqueue_time' keys passes the waiting jobs with lower effective priority,
+        but never the active job.
+        """
+        if 'priority' in job:
+            ret = await self.enqueue_jobs_script(keys=[JOB_SEQUENCE, resource.db_name()],
+                                                 args=[json.dumps(job), job['priority'], time.time(),
+                                                       self.priority_aging_time, 0])
+        else:
+            ret = await self.redis.lpush(resource.db_name(), json.dumps(job))
+        await self.bump_token_revision(job.get('token'))
+        return ret
+
+    async def add_job_to_resources(self, resources: List[Resource], job: dict) -> int:
+        """
+        add the job to all the resources queues in one atomic step, the job gets the next global sequence number.
+        the job is ordered by priority like in add_job_to_resource, but a job of several queues doesn't pass
+        jobs of several queues, so these jobs are in the same sequence order in all the queues.
+        :param resources: the resources to add the job to their queues
+        :param job: dict with 'token', 'priority' and 'enqueue_time' keys
+        :return: the job sequence number, a job without resources (that waits only in pools) gets it too
+        """
+        seq = await self.enqueue_jobs_script(keys=[JOB_SEQUENCE, *[resource.db_name() for resource in resources]],
+                                             args=[json.dumps(job), job['priority'], time.time(),
+                                                   self.priority_aging_time, 1])
+        await self.bump_token_revision(job.get('token'))
+        return seq
+
+    async def add_job_to_pool(self, names: List[str], job: dict, count: int) -> Tuple[str, List[str]]:
+        """
+        add the job once to the queue of the pool of the resources, instead of adding it to all the resources queues.
+        if no other job waits for the pool, the free resources of the pool are handed to the job at once,
+        the next resources are handed to it by hand_over_to_pools when they are free.
+        :param names: the pool resources names, in the order they are handed to the job
+        :param job: dict with 'token' and 'seq' keys, the same job json is added to the handed resources queues
+        :param count: number of resources the job needs from the pool
+        :return: the pool id and the names of the resources that were handed to the job
+        """
+        names = list(dict.fromkeys(names))
+        pool_id = self.pool_id(names)
+        if await self.redis.hsetnx(POOLS, pool_id, json.dumps(sorted(names))):
+            async with self.redis.pipeline(transaction=True) as pipe:
+                for name in names:
+                    pipe.sadd(self.resource_pools_key(name), pool_id)
+                await pipe.execute()
+        keys = [self.pool_queue_key(pool_id), self.pool_jobs_key(pool_id), self.pool_counts_key(pool_id),
+                ALL_RESOURCES, POOL_HANDED, *[resource_db_name(name) for name in names]]
+        handed = await self.pool_enqueue_script(keys=keys, args=[job['token'], json.dumps(job), count, *names])
+        await self.bump_token_revision(job['token'])
+        return pool_id, handed
+
+    async def hand_over_to_pools(self, resource: Resource) -> str or None:
+        """
+        if the resource is free, hand it to the job with the lowest sequence from the heads of the resource pools
+        :return: the token of the job that the resource was handed to, None if it wasn't handed
+        """
+        pool_ids = await self.redis.smembers(self.resource_pools_key(resource.name))
+        if not pool_ids:
+            return None
+        keys = [resource.db_name(), ALL_RESOURCES, POOL_HANDED]
+        for pool_id in sorted(pool_ids):
+            keys.extend([self.pool_queue_key(pool_id), self.pool_jobs_key(pool_id), self.pool_counts_key(pool_id)])
+        token = await self.hand_over_script(keys=keys, args=[resource.name])
+        if token:
+            logging.info(f'resource {resource.name} was handed to token {token} by its pool')
+            await self.bump_token_revision(token)
+        return token
+
+    async def get_pool_queue(self, pool_id: str) -> List[str]:
+        return await self.redis.lrange(self.pool_queue_key(pool_id), 0, -1)
+
+    async def get_pool_handed(self, token: str) -> List[str]:
+        handed_json = await self.redis.hget(POOL_HANDED, token)
+        return list(json.loads(handed_json)) if handed_json else []
+
+    async def set_token_pools(self, token: str, pools: Dict[int, str]) -> None:
+        await self.redis.hset(TOKEN_POOLS, token, json.dumps(pools))
+
+    async def get_token_pools(self, token: str) -> Dict[int, str]:
+        pools_json = await self.redis.hget(TOKEN_POOLS, token)
+        if not pools_json:
+            return {}
+        return {int(req_index): pool_id for req_index, pool_id in json.loads(pools_json).items()}
+
+    async def remove_pool_jobs(self, token: str) -> None:
+        """
+        remove the token from the queues of its pools and forget the resources that its pools handed to it,
+        the jobs of the handed resources are removed with remove_job
+        """
+        pools = await self.get_token_pools(token)
+        async with self.redis.pipeline(transaction=True) as pipe:
+            for pool_id in pools.values():
+                pipe.lrem(self.pool_queue_key(pool_id), 0, token)
+                pipe.hdel(self.pool_jobs_key(pool_id), token)
+                pipe.hdel(self.pool_counts_key(pool_id), token)
+            pipe.hdel(TOKEN_POOLS, token)
+            pipe.hdel(POOL_HANDED, token)
+            await pipe.execute()
 
     async def get_resource_jobs(self, resource: Resource) -> List[Dict]:
         all_jobs = await self.redis.lrange(resource.db_name(), 0, -1)
@@ -237,12 +866,67 @@ class RedisDB(QrmBaseDB):
             job = await self.get_job_for_resource_by_id(resource, token)
             if not job:
                 continue
-            else:
-                await self.redis.lrem(resource.db_name(), 1, job)
+            keys = [resource.db_name(), RESOURCE_OWNER, OWNER_USAGE, OWNER_WEIGHTS, OWNER_CAPS, HOLD_TIME]
+            args = [job, resource.name, token, time.time(), self.owner_usage_decay_time, int(self.use_fair_share)]
+            if await self.remove_job_script(keys=keys, args=args):
                 affected_resources.append(resource)
 
+        for resource in affected_resources:
+            await self.hand_over_to_pools(resource)
+        if affected_resources:
+            # the removed job and the new active jobs of the affected resources have a new status
+            new_active_jobs = [await self.get_active_job(resource) for resource in affected_resources]
+            await self.bump_token_revision(token, *[job.get('token') for job in new_active_jobs])
         return affected_resources
 
+    async def requeue_active_job(self, token: str, resource: Resource) -> bool:
+        """
+        if the token job is the active job of the resource, move it behind the next job in the queue
+        :return: True if the job was moved
+        """
+        job = await self.get_job_for_resource_by_id(resource, token)
+        if not job or not await self.requeue_active_job_script(keys=[resource.db_name()], args=[job]):
+            return False
+        await self.bump_token_revision(token, (await self.get_active_job(resource)).get('token'))
+        return True
+
+    async def backfill_job(self, resource: Resource, active_token: str, token: str) -> bool:
+        """
+        move the token job in front of the active job of the resource, so it becomes the active job
+        :param active_token: the active job token, nothing is moved if it's no longer the active job
+        :return: True if the job was moved
+        """
+        active_job = await self.get_job_for_resource_by_id(resource, active_token)
+        job = await self.get_job_for_resource_by_id(resource, token)
+        if not active_job or not job or \
+                not await self.backfill_job_script(keys=[resource.db_name()], args=[active_job, job]):
+            return False
+        await self.bump_token_revision(active_token, token)
+        return True
+
+    async def get_resources_holders(self, resources_names: List[str]) -> Dict[str, dict]:
+        """
+        :return: {resource_name: {owner, token, time}} of the granted resources, time is the grant time
+        """
+        if not resources_names:
+            return {}
+        holders = await self.redis.hmget(RESOURCE_OWNER, resources_names)
+        return {name: json.loads(holder) for name, holder in zip(resources_names, holders) if holder}
+
+    async def get_hold_times(self, owners: List[str]) -> Dict[str, float]:
+        """
+        :return: {owner: moving average of the owner hold time}, owners without history get the average of all
+        the owners, and none if there is no history at all
+        """
+        hold_times = await self.redis.hmget(HOLD_TIME, [*owners, ALL_OWNERS_HOLD_TIME])
+        all_owners_hold_time = hold_times[-1]
+        ret = {}
+        for owner, hold_time in zip(owners, hold_times):
+            hold_time = hold_time or all_owners_hold_time
+            if hold_time is not None:
+                ret[owner] = float(hold_time)
+        return ret
+
     async def get_job_for_resource_by_id(self, resource: Resource, token: str) -> str:
         resource_jobs = await self.get_resource_jobs(resource)
         for job in resource_jobs:
@@ -266,9 +950,14 @@ class RedisDB(QrmBaseDB):
     async def set_token_for_resource(self, token: str, resource: Resource) -> None:
         resource_from_db = await self.get_resource_by_name(resource.name)
         if resource_from_db:
+            old_token = resource_from_db.token
             resource_from_db.token = token
             logging.info(f'setting token {token} for resource {resource.name}')
-            await self.redis.hset(ALL_RESOURCES, resource.name, resource_from_db.to_json())
+            async with self.redis.pipeline(transaction=True) as pipe:
+                pipe.hset(ALL_RESOURCES, resource.name, resource_from_db.to_json())
+                pipe.hset(RESOURCE_TOKEN_MAP, resource.name, token)
+                await pipe.execute()
+            await self.bump_token_revision(token, old_token)
         else:
             logging.error(f'resource {resource.name} is not in DB, so can\'t add token to it')
 
@@ -285,14 +974,39 @@ class RedisDB(QrmBaseDB):
             resources_list.append(resource.to_json())
             await self.set_token_for_resource(token, resource)
         logging.info(f'generate token {token} with {resources_list}')
-        return await self.redis.hset(TOKEN_RESOURCES_MAP, token, json.dumps(resources_list))
+        token_state = await self.get_changed_token_state(token, TOKEN_FILLED,
+                                                         grants=[resource.name for resource in resources])
+        async with self.redis.pipeline(transaction=True) as pipe:
+            pipe.hset(TOKEN_RESOURCES_MAP, token, json.dumps(resources_list))
+            if token_state:
+                pipe.hset(TOKEN_STATE, token, token_state.to_json())
+            ret, *_ = await pipe.execute()
+        await self.bump_token_revision(token)
+        return ret
 
     async def destroy_token(self, token: str) -> None:
         if not await self.redis.hget(TOKEN_RESOURCES_MAP, token):
             logging.error(f'token {token} does not exists in DB, can\'t destory it')
             return
         logging.info(f'destroying token: {token}')
-        await self.redis.hdel(TOKEN_RESOURCES_MAP, token)
+        # the token resources belong to other token, so the token is no longer valid
+        token_state = await self.get_changed_token_state(token, TOKEN_INVALID)
+        async with self.redis.pipeline(transaction=True) as pipe:
+            pipe.hdel(TOKEN_RESOURCES_MAP, token)
+            if token_state:
+                pipe.hset(TOKEN_STATE, token, token_state.to_json())
+            await pipe.execute()
+        await self.bump_token_revision(token)
+
+    async def get_resources_tokens(self, resources_names: List[str]) -> Dict[str, str]:
+        """
+        :param resources_names: list of resources names
+        :return: {resource_name: owner token}, the token is '' for resources without owner or not in DB
+        """
+        if not resources_names:
+            return {}
+        tokens = await self.redis.hmget(RESOURCE_TOKEN_MAP, resources_names)
+        return {res_name: token or '' for res_name, token in zip(resources_names, tokens)}
 
     async def get_token_resources(self, token: str) -> List[Resource]:
         resources_list = []
@@ -305,7 +1019,59 @@ class RedisDB(QrmBaseDB):
         return resources_list
 
     async def add_resources_request(self, resources_req: ResourcesRequest) -> None:
-        await self.redis.hset(OPEN_REQUESTS, resources_req.token, resources_req.to_json())
+        token_state = TokenState(token=resources_req.token)
+        token_state.transition(TOKEN_QUEUED)
+        async with self.redis.pipeline(transaction=True) as pipe:
+            pipe.hset(OPEN_REQUESTS, resources_req.token, resources_req.to_json())
+            self.pipe_set_open_request_groups(pipe, resources_req.token, resources_req)
+            pipe.hset(TOKEN_STATE, resources_req.token, token_state.to_json())
+            await pipe.execute()
+
+    def pipe_set_open_request_groups(self, pipe, token: str, resources_req: ResourcesRequest,
+                                     old_groups_count: int = 0) -> None:
+        """
+        add to the pipeline the commands that write the remaining count and candidates of every names group,
+        these are changed by every grant without rewriting the whole open request
+        :param pipe: redis pipeline
+        :param token: request token
+        :param resources_req: the open request
+        :param old_groups_count: number of names groups in the previous version of the request
+        """
+        pipe.delete(self.open_request_counts_key(token))
+        for req_index in range(max(old_groups_count, len(resources_req.names))):
+            pipe.delete(self.open_request_names_key(token, req_index))
+        if resources_req.names:
+            pipe.hset(self.open_request_counts_key(token),
+                      mapping={str(req_index): names_req.count for req_index, names_req in
+                               enumerate(resources_req.names)})
+        for req_index, names_req in enumerate(resources_req.names):
+            if names_req.names:
+                pipe.rpush(self.open_request_names_key(token, req_index), *names_req.names)
+
+    async def load_open_requests_groups(self, open_requests: Dict[str, ResourcesRequest]) -> None:
+        """
+        update the names groups of the open requests with their current remaining count and candidates
+        :param open_requests: {token: open request}, changed by reference
+        :return: None
+        """
+        if not open_requests:
+            return
+        tokens = list(open_requests)
+        async with self.redis.pipeline(transaction=False) as pipe:
+            for token in tokens:
+                pipe.hgetall(self.open_request_counts_key(token))
+            tokens_counts = await pipe.execute()
+        groups = [(token, int(req_index), int(count)) for token, counts in zip(tokens, tokens_counts)
+                  for req_index, count in counts.items() if int(req_index) < len(open_requests[token].names)]
+        if not groups:
+            return
+        async with self.redis.pipeline(transaction=False) as pipe:
+            for token, req_index, _ in groups:
+                pipe.lrange(self.open_request_names_key(token, req_index), 0, -1)
+            groups_names = await pipe.execute()
+        for (token, req_index, count), names in zip(groups, groups_names):
+            open_requests[token].names[req_index].count = count
+            open_requests[token].names[req_index].names = names
 
     async def save_orig_resources_req(self, resources_req: ResourcesRequest) -> None:
         await self.redis.hset(ORIG_REQUESTS, resources_req.token, resources_req.to_json())
@@ -315,13 +1081,16 @@ class RedisDB(QrmBaseDB):
         ret_dict = {}
         for token, req in open_requests.items():
             ret_dict[token] = resource_definition.resource_request_from_json(req)
+        await self.load_open_requests_groups(ret_dict)
         return ret_dict
 
     async def get_open_request_by_token(self, token: str) -> ResourcesRequest:
         # use this method if you know the token request since it's much faster than get_open_requests
         open_req = await self.redis.hget(OPEN_REQUESTS, token)
         if open_req:
-            return resource_definition.resource_request_from_json(open_req)
+            open_request = resource_definition.resource_request_from_json(open_req)
+            await self.load_open_requests_groups({token: open_request})
+            return open_request
         else:
             return ResourcesRequest()
 
@@ -333,57 +1102,184 @@ class RedisDB(QrmBaseDB):
             return ResourcesRequest()
 
     async def update_open_request(self, token: str, updated_request: ResourcesRequest) -> bool:
-        if await self.redis.hget(OPEN_REQUESTS, token):
-            await self.redis.hset(OPEN_REQUESTS, token, updated_request.to_json())
+        # rewrites the whole request, grants update the request with partial_fill_request
+        open_req = await self.redis.hget(OPEN_REQUESTS, token)
+        if open_req:
+            old_groups_count = len(json.loads(open_req).get('names', []))
+            async with self.redis.pipeline(transaction=True) as pipe:
+                pipe.hset(OPEN_REQUESTS, token, updated_request.to_json())
+                self.pipe_set_open_request_groups(pipe, token, updated_request, old_groups_count)
+                await pipe.execute()
             return True
         else:
             logging.error(f'request with token {token} is not in DB!')
             return False
 
     async def remove_open_request(self, token: str) -> None:
-        if await self.redis.hget(OPEN_REQUESTS, token):
-            await self.redis.hdel(OPEN_REQUESTS, token)
+        open_req = await self.redis.hget(OPEN_REQUESTS, token)
+        if open_req:
+            # all the resources were granted, the token is waiting for them to be active
+            token_state = await self.get_changed_token_state(token, TOKEN_WAITING_ACTIVE)
+            async with self.redis.pipeline(transaction=True) as pipe:
+                pipe.hdel(OPEN_REQUESTS, token)
+                pipe.delete(self.open_request_counts_key(token),
+                            *[self.open_request_names_key(token, req_index)
+                              for req_index in range(len(json.loads(open_req).get('names', [])))])
+                if token_state:
+                    pipe.hset(TOKEN_STATE, token, token_state.to_json())
+                await pipe.execute()
+            await self.bump_token_revision(token)
         else:
             logging.warning(f'request with token {token} is not in DB!')
 
-    async def partial_fill_request(self, token: str, resource: Resource) -> None:
-        partial_fill_req = await self.redis.hget(PARTIAL_FILL_REQUESTS, token)
-        if partial_fill_req:
-            partial_fill_list = json.loads(partial_fill_req)
-            if resource.name in partial_fill_list:
-                return
-            partial_fill_list.append(resource.name)
-            await self.redis.hset(PARTIAL_FILL_REQUESTS, token, json.dumps(partial_fill_list))
-            rrr = ResourcesRequestResponse(
-                token=token,
-                names=partial_fill_list
-            )
-            await self.set_req_resp(rrr)
-        else:
-            await self.redis.hset(PARTIAL_FILL_REQUESTS, token, json.dumps([resource.name]))
-            rrr = ResourcesRequestResponse(
-                token=token,
-                names=[resource.name]
-            )
-            await self.set_req_resp(rrr)
+    async def partial_fill_request(self, token: str, resource: Resource, req_index: int = None,
+                                   owner: str = '', claim: bool = False) -> bool:
+        """
+        grant the resource to the token, the grant is one atomic update that doesn't depend on the request size
+        :param token: request token
+        :param resource: the granted resource
+        :param req_index: index of the names group of the open request that the resource was granted for,
+        the group remaining count and candidates are updated with the grant
+        :param owner: the request owner, the resource usage is accounted to it until the resource is released
+        :param claim: grant only if the token job is the resource active job and the resource isn't disabled
+        :return: False if the claim failed, True if the resource is granted to the token
+        """
+        keys, args = self.grant_resource_keys_args(token, resource, req_index, owner, claim)
+        granted = await self.grant_resource_script(keys=keys, args=args)
+        if granted == 1:
+            self.notify_token_change(token)
+        elif granted == -1:
+            logging.info(f'token {token} failed to claim resource {resource.name}')
+        return granted != -1
+
+    async def fill_request_at_once(self, token: str, grants: List[Tuple[Resource, int]], owner: str = '') -> bool:
+        """
+        grant all the resources to the token in one transaction, so the token never holds part of them.
+        the transaction is done only if the token job is the active job of all the resources,
+        and none of the queues was changed until the transaction
+        :param token: request token
+        :param grants: [(resource, index of the names group it was granted for)]
+        :param owner: the request owner
+        :return: True if the resources were granted
+        """
+        queues = [resource.db_name() for resource, _ in grants]
+        async with self.redis.pipeline(transaction=True) as pipe:
+            await pipe.watch(*queues)
+            for queue in queues:
+                active_job_json = await pipe.lindex(queue, -2)
+                if not active_job_json or json.loads(active_job_json).get('token') != token:
+                    logging.info(f'token {token} is no longer the active job of {queue}')
+                    return False
+            pipe.multi()
+            for resource, req_index in grants:
+                keys, args = self.grant_resource_keys_args(token, resource, req_index, owner, claim=True)
+                await self.grant_resource_script(keys=keys, args=args, client=pipe)
+            try:
+                granted = await pipe.execute()
+            except aioredis.WatchError:
+                logging.info(f'the queues of token {token} were changed while it was granted')
+                return False
+        if any(ret == 1 for ret in granted):
+            self.notify_token_change(token)
+        return all(ret != -1 for ret in granted)
+
+    def grant_resource_keys_args(self, token: str, resource: Resource, req_index: int = None,
+                                 owner: str = '', claim: bool = False) -> Tuple[list, list]:
+        keys = [self.fill_request_key(token), LAST_REQ_RESP, TOKEN_STATE, TOKEN_REVISION, RESOURCE_OWNER, OWNER_USAGE,
+                HOLD_TIME, resource.db_name(), ALL_RESOURCES]
+        args = [token, resource.name, time.time(), ResourcesRequestResponse(token=token).to_json(), owner,
+                self.owner_usage_decay_time, int(claim)]
+        if req_index is not None:
+            keys.extend([self.open_request_counts_key(token), self.open_request_names_key(token, req_index)])
+            args.append(req_index)
+        return keys, args
 
     async def get_partial_fill(self, token: str) -> ResourcesRequestResponse:
-        partial_fill_req = await self.redis.hget(PARTIAL_FILL_REQUESTS, token)
-        if partial_fill_req:
-            return ResourcesRequestResponse(json.loads(partial_fill_req), token)
+        partial_fill = await self.redis.lrange(self.fill_request_key(token), 0, -1)
+        if partial_fill:
+            return ResourcesRequestResponse(partial_fill, token)
         else:
             return ResourcesRequestResponse()
 
     async def remove_partially_fill_request(self, token: str) -> None:
-        await self.redis.hdel(PARTIAL_FILL_REQUESTS, token)
+        await self.redis.delete(self.fill_request_key(token))
 
     async def is_request_filled(self, token: str) -> bool:
-        token_in_map = await self.redis.hget(TOKEN_RESOURCES_MAP, token)
-        token_in_open_req = await self.redis.hget(OPEN_REQUESTS, token)
-        logging.debug(f'token_in_map: {token_in_map}, token_in_open_req: {token_in_open_req}')
-        if token_in_map and not token_in_open_req:
-            return True
-        return False
+        token_state = await self.get_token_state(token)
+        logging.debug(f'state of token {token}: {token_state}')
+        return bool(token_state) and token_state.state == TOKEN_FILLED
+
+    async def get_token_state(self, token: str) -> TokenState or None:
+        """
+        :param token: request token
+        :return: the token state record, None for unknown token
+        """
+        token_state_json = await self.redis.hget(TOKEN_STATE, token)
+        if token_state_json:
+            return TokenState.from_json(token_state_json)
+        # token from a DB that was created before the state record existed
+        async with self.redis.pipeline(transaction=False) as pipe:
+            pipe.hget(TOKEN_RESOURCES_MAP, token)
+            pipe.hget(OPEN_REQUESTS, token)
+            pipe.hget(PARTIAL_FILL_REQUESTS, token)
+            token_json, open_req_json, partial_fill_json = await pipe.execute()
+        return self.legacy_token_state(token, token_json, open_req_json, partial_fill_json)
+
+    async def get_all_tokens_state(self) -> Dict[str, TokenState]:
+        tokens_state = await self.redis.hgetall(TOKEN_STATE)
+        return {token: TokenState.from_json(token_state) for token, token_state in tokens_state.items()}
+
+    async def scan_hash(self, name: str, batch_size: int) -> AsyncIterator[Dict[str, str]]:
+        """
+        read the hash in batches of about batch_size fields (HSCAN), a field may be returned in more than one batch
+        """
+        cursor = 0
+        while True:
+            cursor, fields = await self.redis.hscan(name, cursor=cursor, count=batch_size)
+            if fields:
+                yield fields
+            if cursor == 0:
+                return
+
+    async def scan_tokens_state(self, batch_size: int) -> AsyncIterator[Dict[str, TokenState]]:
+        async for tokens_state in self.scan_hash(TOKEN_STATE, batch_size):
+            yield {token: TokenState.from_json(token_state) for token, token_state in tokens_state.items()}
+
+    async def scan_open_requests_tokens(self, batch_size: int) -> AsyncIterator[List[str]]:
+        async for open_requests in self.scan_hash(OPEN_REQUESTS, batch_size):
+            yield list(open_requests)
+
+    async def get_changed_token_state(self, token: str, state: str, grants: List[str] = None) -> TokenState or None:
+        """
+        :return: the token state record after the transition, None if the transition doesn't change the record
+        """
+        token_state = await self.get_token_state(token)
+        if token_state is None:
+            token_state = TokenState(token=token)
+            token_state.transition(state, grants)
+            return token_state
+        return token_state if token_state.transition(state, grants) else None
+
+    async def set_token_state(self, token: str, state: str, grants: List[str] = None,
+                              rrr: ResourcesRequestResponse = None) -> None:
+        """
+        move the token to a new state, the response of the token is saved with the state in the same transaction
+        :param token: request token
+        :param state: the new state
+        :param grants: the granted resources names, None keeps the current grants
+        :param rrr: optional new response for the token
+        """
+        token_state = await self.get_changed_token_state(token, state, grants)
+        if not token_state and not rrr:
+            return
+        async with self.redis.pipeline(transaction=True) as pipe:
+            if token_state:
+                pipe.hset(TOKEN_STATE, token, token_state.to_json())
+            if rrr:
+                pipe.hset(LAST_REQ_RESP, token, rrr.to_json())
+            pipe.hincrby(TOKEN_REVISION, token, 1)
+            await pipe.execute()
+        self.notify_token_change(token)
 
     async def get_req_resp_for_token(self, token: str) -> ResourcesRequestResponse:
         rrr = await self.redis.hget(LAST_REQ_RESP, token)
@@ -393,24 +1289,186 @@ class RedisDB(QrmBaseDB):
         return resp
 
     async def set_req_resp(self, rrr: ResourcesRequestResponse) -> None:
-        await self.redis.hset(LAST_REQ_RESP, rrr.token, rrr.to_json())
+        async with self.redis.pipeline(transaction=True) as pipe:
+            pipe.hset(LAST_REQ_RESP, rrr.token, rrr.to_json())
+            pipe.hincrby(TOKEN_REVISION, rrr.token, 1)
+            await pipe.execute()
+        self.notify_token_change(rrr.token)
 
-    async def get_all_open_tokens(self) -> List[str]:
-        # these are the tokens used for recovery.
-        # it contains both active requests waiting in queues and
-        # the totally filled requests
-        tokens_list = list()
+    async def bump_token_revision(self, *tokens: str) -> None:
+        """
+        increase the revision of tokens whose status was changed.
+        always call it after the change itself, so a reader that got the new revision
+        will also get the new status
+        :param tokens: the changed tokens, empty tokens are ignored
+        """
+        tokens = set(token for token in tokens if token)
+        if not tokens:
+            return
+        async with self.redis.pipeline(transaction=False) as pipe:
+            for token in tokens:
+                pipe.hincrby(TOKEN_REVISION, token, 1)
+            await pipe.execute()
+        self.notify_token_change(*tokens)
+
+    def add_token_change_callback(self, callback: Callable[[str], None]) -> None:
+        """
+        :param callback: called with the token after every change in the token status
+        """
+        self.token_change_callbacks.append(callback)
+
+    def add_token_event_callback(self, callback: Callable[[dict], None]) -> None:
+        """
+        :param callback: called with every token event that was published by publish_token_event
+        """
+        self.token_event_callbacks.append(callback)
+
+    async def publish_token_event(self, token: str, reason: str = None, resources: List[str] = None,
+                                  instance_id: str = '') -> None:
+        """
+        publish token event to the qrm server instance that runs the token worker,
+        or to all the instances that share the DB if no instance runs it
+        :param token: request token
+        :param reason: the event reason
+        :param resources: names of the resources that changed, None if the change isn't of specific resources
+        :param instance_id: the publishing instance
+        """
+        token_event = json.dumps({'token': token, 'reason': reason, 'resources': resources, 'instance': instance_id})
+        await self.publish_token_event_script(keys=[TOKEN_INSTANCE], args=[token, token_event,
+                                                                         CHANNEL_TOKEN_CHANGE_EVENT])
+
+    async def set_token_instance(self, token: str, instance_id: str) -> None:
+        await self.redis.hset(TOKEN_INSTANCE, token, instance_id)
+
+    async def get_tokens_instance(self, tokens: List[str] = None) -> Dict[str, str]:
+        """
+        :param tokens: the tokens to get, None for all the tokens
+        :return: {token: instance id} of the tokens that have instance
+        """
+        if tokens is None:
+            return await self.redis.hgetall(TOKEN_INSTANCE)
+        if not tokens:
+            return {}
+        instances = await self.redis.hmget(TOKEN_INSTANCE, tokens)
+        return {token: instance for token, instance in zip(tokens, instances) if instance is not None}
+
+    async def remove_token_instance(self, token: str) -> None:
+        await self.redis.hdel(TOKEN_INSTANCE, token)
+
+    async def set_tokens_instance(self, tokens: List[str], instance_id: str) -> None:
+        if tokens:
+            await self.redis.hset(TOKEN_INSTANCE, mapping={token: instance_id for token in tokens})
+
+    async def acquire_lease(self, instance_id: str, lease_time: float) -> bool:
+        """
+        take the leader lease if no instance holds it, or extend it if this instance already holds it
+        :param instance_id: the instance that takes the lease
+        :param lease_time: seconds, the lease expires if it's not renewed in this time
+        :return: True if the instance holds the lease
+        """
+        if await self.redis.set(LEADER_LEASE, instance_id, nx=True, px=int(lease_time * 1000)):
+            return True
+        return await self.renew_lease(instance_id, lease_time)
+
+    async def renew_lease(self, instance_id: str, lease_time: float) -> bool:
+        """
+        :return: False if the lease expired or is held by another instance
+        """
+        return bool(await self.renew_lease_script(keys=[LEADER_LEASE], args=[instance_id, int(lease_time * 1000)]))
+
+    async def release_lease(self, instance_id: str) -> None:
+        await self.release_lease_script(keys=[LEADER_LEASE], args=[instance_id])
 
-        token_res_map = await self.redis.hgetall(TOKEN_RESOURCES_MAP)
-        tokens_list.extend(token_res_map.keys())
+    async def get_leader(self) -> str or None:
+        return await self.redis.get(LEADER_LEASE)
 
-        open_req = await self.redis.hgetall(OPEN_REQUESTS)
-        tokens_list.extend(open_req.keys())
+    def notify_token_change(self, *tokens: str) -> None:
+        for token in tokens:
+            for callback in self.token_change_callbacks:
+                callback(token)
 
-        part_fill = await self.redis.hgetall(PARTIAL_FILL_REQUESTS)
-        tokens_list.extend(part_fill.keys())
+    async def get_token_revision(self, token: str) -> int:
+        revision = await self.redis.hget(TOKEN_REVISION, token)
+        return int(revision) if revision else 0
 
-        return list(set(tokens_list))
+    async def get_tokens_status_snapshot(self, tokens: List[str]) -> dict:
+        """
+        read everything needed for the status of several tokens with two pipelined round trips,
+        the first one reads the tokens hashes and the second one reads the resources and the active
+        jobs of all the resources in the tokens responses.
+        the cost depends only on the tokens and their resources and not on the number of resources in the DB.
+        :param tokens: list of tokens
+        :return: {'tokens': {token: {'is_filled': bool,
+                                     'state': TokenState or None,
+                                     'req_resp': ResourcesRequestResponse,
+                                     'token_resources': List[Resource]}},
+                  'owners': {resource_name: owner token},
+                  'active_jobs': {resource_name: dict}}
+        """
+        snapshot = {'tokens': {}, 'owners': {}, 'active_jobs': {}}
+        if not tokens:
+            return snapshot
+
+        async with self.redis.pipeline(transaction=False) as pipe:
+            pipe.hmget(TOKEN_RESOURCES_MAP, tokens)
+            pipe.hmget(TOKEN_STATE, tokens)
+            pipe.hmget(LAST_REQ_RESP, tokens)
+            tokens_map, tokens_state, req_resps = await pipe.execute()
+
+        resources_names = set()
+        active_jobs_names = set()
+        for token, token_json, token_state_json, rrr_json in zip(tokens, tokens_map, tokens_state, req_resps):
+            if rrr_json:
+                rrr = ResourcesRequestResponse.from_json(rrr_json)
+            else:
+                rrr = ResourcesRequestResponse(token=token, message='no response for token')
+            token_resources = []
+            if token_json:
+                token_resources = [Resource.from_json(res_json) for res_json in json.loads(token_json)]
+            token_state = TokenState.from_json(token_state_json) if token_state_json else None
+            snapshot['tokens'][token] = {
+                'is_filled': bool(token_state) and token_state.state == TOKEN_FILLED,
+                'state': token_state,
+                'req_resp': rrr,
+                'token_resources': token_resources
+            }
+            if rrr.names:
+                active_jobs_names.update(rrr.names)
+                resources_names.update(resource.name for resource in token_resources)
+
+        if not active_jobs_names:
+            return snapshot
+
+        resources_names = list(resources_names)
+        active_jobs_names = list(active_jobs_names)
+        async with self.redis.pipeline(transaction=False) as pipe:
+            if resources_names:
+                pipe.hmget(RESOURCE_TOKEN_MAP, resources_names)
+            for res_name in active_jobs_names:
+                pipe.lindex(resource_db_name(res_name), -2)
+            results = await pipe.execute()
+
+        if resources_names:
+            owners = results.pop(0)
+            snapshot['owners'] = {res_name: owner or '' for res_name, owner in zip(resources_names, owners)}
+        for res_name, active_job in zip(active_jobs_names, results):
+            snapshot['active_jobs'][res_name] = json.loads(active_job) if active_job else {}
+        return snapshot
+
+    async def set_req_resps(self, rrrs: List[ResourcesRequestResponse]) -> None:
+        if rrrs:
+            await self.redis.hset(LAST_REQ_RESP, mapping={rrr.token: rrr.to_json() for rrr in rrrs})
+            await self.bump_token_revision(*[rrr.token for rrr in rrrs])
+
+    async def update_tokens_last_update_time(self, tokens_last_update: Dict[str, str]) -> None:
+        if tokens_last_update:
+            await self.redis.hset(TOKEN_LAST_UPDATE, mapping=tokens_last_update)
+
+    async def get_all_open_tokens(self) -> List[str]:
+        # these are the tokens used for recovery.
+        # it contains both active requests waiting in queues and
+        # the totally filled requests
+        return await self.redis.hkeys(TOKEN_STATE)
 
     async def get_resources_names_by_tags(self, tags: List[str]) -> List[str]:
         ret_list = []
@@ -493,6 +1551,40 @@ class RedisDB(QrmBaseDB):
                 resources_for_tag = list(set(resources_for_tag))
                 await self.redis.hset(TAGS_RES_NAME_MAP, tag, json.dumps(resources_for_tag))
 
+    async def set_owner_share(self, owner: str, weight: float = None, max_held: int = None) -> None:
+        """
+        :param owner: the requests owner
+        :param weight: the owner share of the resources relative to the other owners, None keeps the current weight
+        :param max_held: the owner cap of concurrently held resources, 0 removes the cap, None keeps the current cap
+        """
+        async with self.redis.pipeline(transaction=True) as pipe:
+            if weight is not None:
+                pipe.hset(OWNER_WEIGHTS, owner, weight)
+            if max_held == 0:
+                pipe.hdel(OWNER_CAPS, owner)
+            elif max_held is not None:
+                pipe.hset(OWNER_CAPS, owner, max_held)
+            await pipe.execute()
+
+    async def get_owners_usage(self) -> Dict[str, dict]:
+        """
+        :return: {owner: {usage, held, weight, max_held}}, usage is in resource-seconds, decayed to the current time
+        """
+        async with self.redis.pipeline(transaction=True) as pipe:
+            pipe.hgetall(OWNER_USAGE)
+            pipe.hgetall(OWNER_WEIGHTS)
+            pipe.hgetall(OWNER_CAPS)
+            all_usage, weights, caps = await pipe.execute()
+        now = time.time()
+        owners_usage = {}
+        for owner in set(all_usage).union(weights, caps):
+            entry = json.loads(all_usage[owner]) if owner in all_usage else {'usage': 0, 'held': 0, 'time': now}
+            owners_usage[owner] = {'usage': self.decayed_owner_usage(entry, now, self.owner_usage_decay_time),
+                                   'held': entry['held'],
+                                   'weight': float(weights.get(owner, DEFAULT_OWNER_WEIGHT)),
+                                   'max_held': int(caps[owner]) if owner in caps else None}
+        return owners_usage
+
     async def close(self) -> None:
         self.is_running = False
         await asyncio.sleep(2 * self.pubsub_polling_time)  # to allow gracefully shutdown
@@ -508,6 +1600,67 @@ class RedisDB(QrmBaseDB):
         await self.redis.close()
         return
 
+    @staticmethod
+    def instance_channel(instance_id: str) -> str:
+        return f'{CHANNEL_TOKEN_CHANGE_EVENT}:{instance_id}'
+
+    @staticmethod
+    def fill_request_key(token: str) -> str:
+        return f'{FILL_REQUEST}:{token}'
+
+    @staticmethod
+    def open_request_counts_key(token: str) -> str:
+        return f'{OPEN_REQUEST_COUNTS}:{token}'
+
+    @staticmethod
+    def open_request_names_key(token: str, req_index: int) -> str:
+        return f'{OPEN_REQUEST_NAMES}:{token}:{req_index}'
+
+    @staticmethod
+    def pool_id(names: List[str]) -> str:
+        return hashlib.sha1(','.join(sorted(set(names))).encode()).hexdigest()[:16]
+
+    @staticmethod
+    def pool_queue_key(pool_id: str) -> str:
+        return f'{POOL_QUEUE}:{pool_id}'
+
+    @staticmethod
+    def pool_jobs_key(pool_id: str) -> str:
+        return f'{POOL_JOBS}:{pool_id}'
+
+    @staticmethod
+    def pool_counts_key(pool_id: str) -> str:
+        return f'{POOL_COUNTS}:{pool_id}'
+
+    @staticmethod
+    def resource_pools_key(resource_name: str) -> str:
+        return f'{RESOURCE_POOLS}:{resource_name}'
+
+    @staticmethod
+    def decayed_owner_usage(entry: dict, now: float, decay_time: float) -> float:
+        decay = math.exp(-max(now - entry['time'], 0) / decay_time)
+        return entry['usage'] * decay + entry['held'] * decay_time * (1 - decay)
+
+    @staticmethod
+    def legacy_token_state(token: str, token_json: str or None, open_req_json: str or None,
+                           partial_fill_json: str or None) -> TokenState or None:
+        """
+        build the token state from the hashes that held the token state before the state record
+        """
+        partial_fill = json.loads(partial_fill_json) if partial_fill_json else []
+        if token_json and not open_req_json:
+            state = TOKEN_FILLED
+            partial_fill = [Resource.from_json(res_json).name for res_json in json.loads(token_json)]
+        elif open_req_json:
+            state = TOKEN_PARTIAL if partial_fill else TOKEN_QUEUED
+        elif partial_fill:
+            state = TOKEN_WAITING_ACTIVE
+        else:
+            return None
+        token_state = TokenState(token=token)
+        token_state.transition(state, grants=partial_fill)
+        return token_state
+
     @staticmethod
     def validate_allowed_server_status(status: str) -> bool:
         if status not in ALLOWED_SERVER_STATUSES:
@@ -1,16 +1,23 @@
 import asyncio
+import copy
 import logging
 import json
+import random
 import requests
 import time
 
-from typing import Union
+from http import HTTPStatus
+from typing import Union, List, Dict
 from qrm_defs.resource_definition import ResourcesRequest, ResourcesByName, ResourceStatus, is_token_format, \
     generate_token_from_seed
 from qrm_defs.qrm_urls import URL_POST_NEW_REQUEST, URL_GET_TOKEN_STATUS, URL_POST_CANCEL_TOKEN, URL_GET_ROOT, \
-    URL_GET_IS_SERVER_UP, MGMT_STATUS_API, SET_RESOURCE_STATUS
+    URL_GET_IS_SERVER_UP, MGMT_STATUS_API, SET_RESOURCE_STATUS, URL_POST_TOKENS_STATUS
 from requests.adapters import HTTPAdapter, Retry
 
+MAX_POLLING_SLEEP_TIME = 30
+POLLING_BACKOFF_FACTOR = 1.5
+POLLING_JITTER = 0.2
+
 
 def json_to_dict(json_str: str or dict) -> dict:
     if isinstance(json_str, str):
@@ -33,7 +40,8 @@ def post_to_url(full_url: str, data_json: dict or str, *args, **kwargs) -> reque
     return _resp
 
 
-def get_from_url(full_url: str, params: dict = None, *args, **kwargs) -> requests.Response or None:
+def get_from_url(full_url: str, params: dict = None, headers: dict = None,
+                 *args, **kwargs) -> requests.Response or None:
     if params is None:
         params = {}
         logging.debug(f'send to url {full_url}')
@@ -47,13 +55,13 @@ def get_from_url(full_url: str, params: dict = None, *args, **kwargs) -> request
                         status_forcelist=[500, 502, 503, 504])
         s.mount('http://', HTTPAdapter(max_retries=retries))
 
-        _resp = s.get(full_url, params=params)
+        _resp = s.get(full_url, params=params, headers=headers)
         logging.debug(f'full url by requests {_resp.url}')
     except Exception as e:
         logging.critical(f'{e}')
         return
 
-    if _resp.status_code != 200:
+    if _resp.status_code not in [HTTPStatus.OK, HTTPStatus.NOT_MODIFIED]:
         logging.critical(f'there is an critical error: {str(_resp)}')
     return _resp
 
@@ -71,6 +79,30 @@ def return_response(res: requests.Response, *args, **kwargs) -> requests.Respons
         return res
 
 
+class PollingBackoff(object):
+    """
+    adaptive polling interval, the sleep time grows while the polled status doesn't change
+    and goes back to the minimal sleep time once it changes.
+    every sleep time gets a random jitter, so clients that started together don't poll together
+    """
+    def __init__(self, min_sleep_time: float,
+                 max_sleep_time: float = MAX_POLLING_SLEEP_TIME,
+                 factor: float = POLLING_BACKOFF_FACTOR,
+                 jitter: float = POLLING_JITTER):
+        self.min_sleep_time = min_sleep_time
+        self.max_sleep_time = max(min_sleep_time, max_sleep_time)
+        self.factor = factor
+        self.jitter = jitter
+        self.sleep_time = min_sleep_time
+
+    def next_sleep_time(self, status_changed: bool) -> float:
+        if status_changed:
+            self.sleep_time = self.min_sleep_time
+        else:
+            self.sleep_time = min(self.sleep_time * self.factor, self.max_sleep_time)
+        return self.sleep_time * random.uniform(1 - self.jitter, 1 + self.jitter)
+
+
 class QrmClient(object):
     def __init__(self, server_ip: str,
                  server_port: str,
@@ -84,6 +116,8 @@ class QrmClient(object):
         self.user_name: str = user_name
         self.token: str = ''
         self.user_password: str = user_password
+        self.tokens_etag: Dict[str, str] = {}
+        self.tokens_status: Dict[str, dict] = {}
         if not loop:
             self.loop: Union[asyncio.AbstractEventLoop] = asyncio.get_event_loop()
         self.init_log_massage()
@@ -144,6 +178,8 @@ class QrmClient(object):
         }
         """
         data_json = self.get_token_from_seed_or_str(data_json)
+        if not data_json.get('owner'):
+            data_json['owner'] = self.user_name
         _resp = self._new_request(data_json=json.dumps(data_json))
         resp_json = _resp.json()
         resp_data = json_to_dict(resp_json)
@@ -175,36 +211,78 @@ class QrmClient(object):
         else:
             return data_json
 
-    def _get_token_status(self, token: str, *args, **kwargs):  # #type:  requests.Response:
+    def _get_token_status(self, token: str, etag: str = None, *args, **kwargs):  # #type:  requests.Response:
         full_url = self.full_url(URL_GET_TOKEN_STATUS)
         logging.debug(f'send get token status token= {token} to url {full_url}')
-        _resp = get_from_url(full_url=full_url, params={'token': token})
+        headers = {'If-None-Match': etag} if etag else None
+        _resp = get_from_url(full_url=full_url, params={'token': token}, headers=headers)
         return _resp
 
     def get_token_status(self, token: str, *args, **kwargs):  # #type:  dict:
-        _resp = self._get_token_status(token)
+        # send the etag of the last status we got, if the status didn't change the server answers 304 without body
+        _resp = self._get_token_status(token, etag=self.tokens_etag.get(token))
+        if _resp.status_code == HTTPStatus.NOT_MODIFIED and token in self.tokens_status:
+            return copy.deepcopy(self.tokens_status[token])
         resp_data = _resp.json()
         if isinstance(resp_data, str):
             resp_data = json.loads(resp_data)
+        etag = _resp.headers.get('ETag')
+        if etag:
+            self.tokens_etag[token] = etag
+            self.tokens_status[token] = copy.deepcopy(resp_data)
         return resp_data
 
+    def _get_tokens_status(self, tokens: List[str], *args, **kwargs):  # #type:  requests.Response:
+        full_url = self.full_url(URL_POST_TOKENS_STATUS)
+        logging.debug(f'send get tokens status for {len(tokens)} tokens to url {full_url}')
+        _resp = post_to_url(full_url=full_url, data_json={'tokens': tokens})
+        return _resp
+
+    def get_tokens_status(self, tokens: List[str], *args, **kwargs):  # #type:  dict:
+        """
+        get the status of several tokens with one http call
+        :param tokens: list of tokens
+        :return: {token: token status dict (same as get_token_status returns)}
+        """
+        _resp = self._get_tokens_status(tokens)
+        return json_to_dict(_resp.json())
+
     def wait_for_token_ready(self, token: str, timeout: float = float('Inf'), polling_sleep_time: float = 5,
+                             max_polling_sleep_time: float = MAX_POLLING_SLEEP_TIME,
                              *args, **kwargs):  # #type:  dict:
+        """
+        :param polling_sleep_time: the minimal time between two status polls
+        :param max_polling_sleep_time: while the token status doesn't change, the time between polls grows
+        up to this value
+        """
         logging.info(f'token ready timeout set to {timeout}')
         resp_data = self.get_token_status(token=token)
-        return self.polling_api_status(resp_data, timeout, token, polling_sleep_time=polling_sleep_time)
+        return self.polling_api_status(resp_data, timeout, token, polling_sleep_time=polling_sleep_time,
+                                       max_polling_sleep_time=max_polling_sleep_time)
 
     async def async_wait_for_token_ready(self, token: str, timeout: float = float('Inf'), polling_sleep_time: float = 5,
+                                         max_polling_sleep_time: float = MAX_POLLING_SLEEP_TIME,
                                          *args, **kwargs):  # #type:  dict:
         logging.info(f'token ready timeout set to {timeout}')
         resp_data = self.get_token_status(token=token)
-        return await self.async_polling_api_status(resp_data, timeout, token, polling_sleep_time=polling_sleep_time)
+        return await self.async_polling_api_status(resp_data, timeout, token, polling_sleep_time=polling_sleep_time,
+                                                   max_polling_sleep_time=max_polling_sleep_time)
+
+    @staticmethod
+    def limit_sleep_to_timeout(sleep_time: float, start_time: float, timeout: float,
+                               polling_sleep_time: float) -> float:
+        # don't sleep far beyond the timeout because of the polling backoff
+        time_to_timeout = timeout - (time.time() - start_time)
+        return min(sleep_time, max(time_to_timeout, polling_sleep_time))
 
     async def async_polling_api_status(self, resp_data: dict,
                                        timeout: float, token: str,
-                                       polling_sleep_time: float = 5):  # #type:  dict:
+                                       polling_sleep_time: float = 5,
+                                       max_polling_sleep_time: float = MAX_POLLING_SLEEP_TIME):  # #type:  dict:
         start_time = time.time()
         last_log_time = start_time  # Initialize the last log time
+        backoff = PollingBackoff(polling_sleep_time, max_polling_sleep_time)
+        status_changed = True
 
         while not resp_data.get('request_complete'):
             current_time = time.time()
@@ -221,13 +299,19 @@ class QrmClient(object):
                 _resp = self.send_cancel(token)  # On timeout, cancel the token
                 raise TimeoutError(f'got timeout while waiting for token {token} status complete')
 
-            await asyncio.sleep(polling_sleep_time)
+            sleep_time = backoff.next_sleep_time(status_changed)
+            await asyncio.sleep(self.limit_sleep_to_timeout(sleep_time, start_time, timeout, polling_sleep_time))
+            prev_resp_data = resp_data
             resp_data = self.get_token_status(token=token)
+            status_changed = resp_data != prev_resp_data
         return resp_data
 
     def polling_api_status(self, resp_data: dict, timeout: float, token: str,
-                           polling_sleep_time: float = 5):  # #type:  dict:
+                           polling_sleep_time: float = 5,
+                           max_polling_sleep_time: float = MAX_POLLING_SLEEP_TIME):  # #type:  dict:
         start_time = time.time()
+        backoff = PollingBackoff(polling_sleep_time, max_polling_sleep_time)
+        status_changed = True
         while not resp_data.get('request_complete'):
             time_d = int(time.time() - start_time)
             logging.info(f'waiting for token {token} to be ready. wait for {time_d} sec, {resp_data}')
@@ -237,8 +321,11 @@ class QrmClient(object):
                 _resp = self.send_cancel(token)  # on timeout cancel the token
                 resp_data = json.loads(_resp.json())
                 raise TimeoutError(f'got timeout while waiting for token {token} status complete')
-            time.sleep(polling_sleep_time)
+            sleep_time = backoff.next_sleep_time(status_changed)
+            time.sleep(self.limit_sleep_to_timeout(sleep_time, start_time, timeout, polling_sleep_time))
+            prev_resp_data = resp_data
             resp_data = self.get_token_status(token=token)
+            status_changed = resp_data != prev_resp_data
         return resp_data
 
     def wait_for_server_up(self):  # #type:  dict:
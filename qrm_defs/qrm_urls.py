@@ -1,10 +1,12 @@
 URL_API_VERSION = '/v1'
 URL_POST_NEW_REQUEST = f'/new_request{URL_API_VERSION}'
 URL_GET_TOKEN_STATUS = f'/get_token_status{URL_API_VERSION}'
+URL_POST_TOKENS_STATUS = f'/get_tokens_status{URL_API_VERSION}'
 URL_POST_CANCEL_TOKEN = f'/cancel_token{URL_API_VERSION}'
 URL_GET_ROOT = '/'
 URL_GET_UPTIME = f'/uptime'
 URL_GET_IS_SERVER_UP = '/is_server_up'
+URL_GET_METRICS = '/metrics'
 MGMT_STATUS_API = '/status'
 SET_SERVER_STATUS = '/set_server_status'
 REMOVE_RESOURCES = '/remove_resources'
@@ -12,3 +14,4 @@ ADD_RESOURCES = '/add_resources'
 SET_RESOURCE_STATUS = '/set_resource_status'
 ADD_TAG_TO_RESOURCE = '/add_tag_to_resource'
 REMOVE_TAG_FROM_RESOURCE = '/remove_tag_from_resource'
+SET_OWNER_SHARE = '/set_owner_share'
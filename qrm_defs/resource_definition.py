@@ -1,7 +1,8 @@
 import json
 import pickle
+import time
 from dataclasses import dataclass, asdict, field
-from typing import List
+from typing import Dict, List
 from datetime import datetime
 from dataclasses_json import dataclass_json
 
@@ -12,6 +13,17 @@ RESOURCE_NAME_PREFIX = 'resource_name'
 ALLOWED_SERVER_STATUSES = [ACTIVE_STATUS, DISABLED_STATUS, PENDING_STATUS]
 DATE_FMT = '%Y_%m_%d_%H_%M_%S'
 RESOURCES_REQUEST_RESPONSE_VERSION = 1
+DEFAULT_PRIORITY = 0
+
+# token states, a token moves forward in this order until it's filled.
+# canceled and invalid are final, every state can move to them
+TOKEN_QUEUED = 'queued'  # jobs were added to the resources queues, nothing granted yet
+TOKEN_PARTIAL = 'partial'  # some of the resources were granted
+TOKEN_WAITING_ACTIVE = 'waiting_active'  # all resources granted, waiting for all of them to be active
+TOKEN_FILLED = 'filled'
+TOKEN_CANCELED = 'canceled'
+TOKEN_INVALID = 'invalid'
+TOKEN_FINAL_STATES = [TOKEN_CANCELED, TOKEN_INVALID]
 
 
 def json_to_dict(json_str: str or dict) -> dict:
@@ -33,6 +45,10 @@ def generate_token_from_seed(seed: str) -> str:
     return f'{seed}_{datetime.now().strftime(DATE_FMT)}'
 
 
+def resource_db_name(resource_name: str) -> str:
+    return f'{RESOURCE_NAME_PREFIX}_{resource_name}'
+
+
 def is_token_format(token: str) -> bool:
     # token format is: seed_DATE_FMT
     try:
@@ -51,9 +67,10 @@ class Resource:
     status: str = ''
     token: str = ''
     tags: List[str] = field(default_factory=list)
+    shard: str = ''  # the shard of the resource for the shard router, the resource type if it's empty
 
     def db_name(self) -> str:
-        return f'{RESOURCE_NAME_PREFIX}_{self.name}'
+        return resource_db_name(self.name)
 
 
     def as_pickle(self) -> bytes:
@@ -67,6 +84,9 @@ class Resource:
     def __str__(self) -> str:
         return f'{self.type}_{self.name}'
 
+    def get_shard(self) -> str:
+        return self.shard or self.type
+
 
 @dataclass
 class ResourcesByName:
@@ -98,6 +118,9 @@ class ResourcesRequest:
     tags: List[ResourcesByTags] = field(default_factory=list)
     token: str = ''
     auto_managed: bool = False
+    priority: int = DEFAULT_PRIORITY  # higher priority jobs pass lower priority jobs waiting in the queues
+    owner: str = ''  # the user or team that the request is accounted to in fair share scheduling
+    gang: bool = False  # all or nothing, no resource is granted until all the names groups can be granted at once
 
     def validate(self) -> None:
         self.validate_not_empty()
@@ -127,6 +150,36 @@ class ResourcesRequest:
         self.token = token
 
 
+@dataclass_json
+@dataclass
+class TokenState:
+    token: str = ''
+    state: str = TOKEN_QUEUED
+    grants: List[str] = field(default_factory=list)  # names of the resources granted to the token
+    timestamps: Dict[str, float] = field(default_factory=dict)  # {state: time the token entered the state}
+
+    def is_final(self) -> bool:
+        return self.state in TOKEN_FINAL_STATES
+
+    def transition(self, state: str, grants: List[str] = None, now: float = None) -> bool:
+        """
+        move the token to a new state, a token in final state doesn't change anymore
+        :param state: the new state
+        :param grants: the granted resources names, None keeps the current grants
+        :param now: transition time, default is the current time
+        :return: True if the state or the grants were changed
+        """
+        if self.is_final():
+            return False
+        changed = state != self.state
+        if grants is not None and grants != self.grants:
+            self.grants = list(grants)
+            changed = True
+        self.state = state
+        self.timestamps.setdefault(state, time.time() if now is None else now)
+        return changed
+
+
 @dataclass_json
 @dataclass
 class ResourceStatus:
@@ -139,6 +192,9 @@ def resource_request_from_json(resource_req_as_json: str) -> ResourcesRequest:
     res_dict = json_to_dict(resource_req_as_json)
     if res_dict.get('auto_managed'):
         res_req.auto_managed = True
+    res_req.priority = res_dict.get('priority') or DEFAULT_PRIORITY
+    res_req.owner = res_dict.get('owner') or ''
+    res_req.gang = bool(res_dict.get('gang'))
     res_req.add_request_by_token(res_dict.get('token'))
     for name_req in res_dict['names']:
         res_req.add_request_by_names(**name_req)
@@ -7,11 +7,13 @@ from aiohttp import web
 from db_adapters.redis_adapter import RedisDB
 from http import HTTPStatus
 from qrm_defs.qrm_urls import MGMT_STATUS_API, SET_SERVER_STATUS, REMOVE_RESOURCES, ADD_RESOURCES, \
-    SET_RESOURCE_STATUS, ADD_TAG_TO_RESOURCE, REMOVE_TAG_FROM_RESOURCE
+    SET_RESOURCE_STATUS, ADD_TAG_TO_RESOURCE, REMOVE_TAG_FROM_RESOURCE, SET_OWNER_SHARE
 from qrm_defs.resource_definition import Resource
 from pathlib import Path
 
 AUTO_MANAGED_TOKENS = 'auto_managed_tokens'
+TOKENS_STATE = 'tokens_state'
+OWNERS_USAGE = 'owners_usage'
 
 LAST_UPDATE_TIME = 'token_last_update_time'
 LISTEN_PORT = 8080
@@ -123,7 +125,13 @@ async def build_status_dict():
             await redis.get_all_tokens_last_update(),
 
         AUTO_MANAGED_TOKENS:
-            await redis.get_all_auto_managed_tokens()
+            await redis.get_all_auto_managed_tokens(),
+
+        TOKENS_STATE:
+            {token: token_state.to_dict() for token, token_state in (await redis.get_all_tokens_state()).items()},
+
+        OWNERS_USAGE:
+            await redis.get_owners_usage()
     }
 
     for resource in await redis.get_all_resources():
@@ -238,6 +246,29 @@ async def remove_tag_from_resource(request):
                             text=f'Error: must specify both tag and resource_name in your request: {req_dict}\n')
 
 
+async def set_owner_share(request):
+    # {owner: str, weight: float, max_held: int}, weight and max_held are optional, max_held 0 removes the cap
+    global redis
+    req_dict = await request.json()
+    logging.info(f'got request to set owner share: {req_dict}')
+    try:
+        owner = req_dict['owner']
+        weight = req_dict.get('weight')
+        max_held = req_dict.get('max_held')
+        if weight is not None and (not isinstance(weight, (int, float)) or weight <= 0):
+            return web.Response(status=HTTPStatus.BAD_REQUEST,
+                                text=f'Error: weight must be a positive number: {weight}\n')
+        if max_held is not None and (not isinstance(max_held, int) or max_held < 0):
+            return web.Response(status=HTTPStatus.BAD_REQUEST,
+                                text=f'Error: max_held must be a non negative integer: {max_held}\n')
+        await redis.set_owner_share(owner=owner, weight=weight, max_held=max_held)
+        return web.Response(status=HTTPStatus.OK,
+                            text=f'owner {owner} share is: weight {weight}, max_held {max_held}\n')
+    except KeyError as e:
+        return web.Response(status=HTTPStatus.BAD_REQUEST,
+                            text=f'Error: must specify owner in your request: {req_dict}\n')
+
+
 def config_log(path_to_log_file: str = LOG_FILE_PATH, loglevel=None):
     print(f'log file path is: {path_to_log_file}')
     if loglevel is None:
@@ -293,7 +324,8 @@ def main(redis_port: int = REDIS_PORT, listen_port: int = LISTEN_PORT, path_to_l
                     web.get(f'/', status),
                     web.post(f'{SET_RESOURCE_STATUS}', set_resource_status),
                     web.post(f'{ADD_TAG_TO_RESOURCE}', add_tag_to_resource),
-                    web.post(f'{REMOVE_TAG_FROM_RESOURCE}', remove_tag_from_resource)])
+                    web.post(f'{REMOVE_TAG_FROM_RESOURCE}', remove_tag_from_resource),
+                    web.post(f'{SET_OWNER_SHARE}', set_owner_share)])
     app.on_shutdown.append(close_redis)
     web.run_app(app, port=listen_port)
 
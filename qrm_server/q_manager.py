@@ -2,16 +2,33 @@ import asyncio
 import copy
 import datetime
 import logging
+import os
+import socket
+import time
 from db_adapters.redis_adapter import RedisDB
+from qrm_server.resource_locks import ResourceLocks
 from qrm_defs.resource_definition import Resource, ResourcesRequest, ResourcesRequestResponse, ResourcesByName, \
-    generate_token_from_seed, ACTIVE_STATUS, DISABLED_STATUS, PENDING_STATUS
-from typing import List, Dict
+    generate_token_from_seed, ACTIVE_STATUS, DISABLED_STATUS, PENDING_STATUS, TOKEN_CANCELED, TOKEN_INVALID, \
+    TOKEN_FILLED, DEFAULT_PRIORITY
+from typing import Callable, List, Dict, Set
 from abc import ABC, abstractmethod
 
 NOT_VALID = 'not_valid'
 CANCELED = "canceled"
+# the token change event reason of tokens in final state
+TOKEN_STATE_EVENT_REASON = {TOKEN_CANCELED: CANCELED, TOKEN_INVALID: NOT_VALID}
 
 REDIS_PORT = 6379
+LAST_SEEN_FLUSH_INTERVAL = 1  # seconds, the last_seen time resolution is 1 second
+GANG_HOLD_WINDOW = 60  # seconds, a gang request that is active in some queues longer than this lets the next jobs go
+POOL_MIN_NAMES = 16  # names groups with at least this number of candidates wait once in the queue of their pool
+FULL_RECHECK_INTERVAL = 30  # seconds, a waiting worker checks all its candidates at least once in this time
+LEASE_CHECKS = 4  # number of times per lease time the leader renews the lease and the standby tries to take it
+RECOVERY_BATCH_SIZE = 1000  # number of tokens read from the DB in one batch during recovery
+RECOVERY_CONCURRENCY = 100  # max recovered workers that do their first resources check at the same time
+RECOVERY_IDLE = 'idle'
+RECOVERY_RUNNING = 'running'
+RECOVERY_DONE = 'done'
 ResourcesListType = List[Resource]
 
 
@@ -19,11 +36,32 @@ class QRMEvent(asyncio.Event):
     def __init__(self):
         super().__init__()
         self.reason = None
+        self.generation = 0  # number of times the event was set, so a waiter knows about signals it missed
+        self.full_generation = 0  # generation of the last set without resources, anything may have changed
+        self.changes = {}  # type: Dict[str, int]  # resource name -> generation of its last change
 
-    def set(self, reason=None):
+    def set(self, reason=None, resources: List[str] = None):
+        """
+        :param reason: CANCELED or NOT_VALID, None for a change in the token resources
+        :param resources: names of the resources that changed, None if the change isn't of specific resources
+        """
         self.reason = reason
+        self.generation += 1
+        if resources is None:
+            self.full_generation = self.generation
+        else:
+            for resource_name in resources:
+                self.changes[resource_name] = self.generation
         asyncio.Event.set(self)
 
+    def changed_since(self, generation: int) -> List[str] or None:
+        """
+        :return: names of the resources that changed since the generation, None if all of them should be checked
+        """
+        if self.full_generation > generation:
+            return None
+        return [resource_name for resource_name, changed in self.changes.items() if changed > generation]
+
 
 class QrmIfc(ABC):
     # this class is the interface between the QueueManagerBackEnd and the qrm_http_server
@@ -48,6 +86,30 @@ class QrmIfc(ABC):
     async def get_resource_req_resp(self, token: str) -> ResourcesRequestResponse:
         pass
 
+    @abstractmethod
+    async def get_tokens_status(self, tokens: List[str]) -> Dict[str, ResourcesRequestResponse]:
+        pass
+
+    @abstractmethod
+    async def get_token_revision(self, token: str) -> int:
+        pass
+
+    @abstractmethod
+    async def touch_token(self, token: str) -> None:
+        pass
+
+    @abstractmethod
+    def add_token_change_callback(self, callback: Callable[[str], None]) -> None:
+        pass
+
+    @abstractmethod
+    def get_metrics(self) -> dict:
+        pass
+
+    @abstractmethod
+    def is_standby(self) -> bool:
+        pass
+
     @abstractmethod
     async def init_backend(self) -> None:
         pass
@@ -60,52 +122,228 @@ class QrmIfc(ABC):
 class QueueManagerBackEnd(QrmIfc):
     def __init__(self,
                  redis_port: int = REDIS_PORT,
-                 use_pending_logic: bool = False):
+                 use_pending_logic: bool = False,
+                 last_seen_flush_interval: float = LAST_SEEN_FLUSH_INTERVAL,
+                 use_fair_share: bool = False,
+                 gang_hold_window: float = GANG_HOLD_WINDOW,
+                 use_backfill: bool = False,
+                 pool_min_names: int = POOL_MIN_NAMES,
+                 full_recheck_interval: float = FULL_RECHECK_INTERVAL,
+                 instance_id: str = '',
+                 ha_lease_time: float = 0,
+                 background_recovery: bool = False,
+                 recovery_batch_size: int = RECOVERY_BATCH_SIZE,
+                 recovery_concurrency: int = RECOVERY_CONCURRENCY):
         """
         :Params:
         redis_port - redis server port to connect
         use_pending_logic - qrm will remove the server to PENDING after remove the active job
         and will consider job as active only if the server change state to ACTIVE
+        last_seen_flush_interval - tokens last_seen updates from status polls are kept in memory
+        and written to the DB in one batch every interval
+        use_fair_share - when the active job of a resource is removed, the next active job is the waiting job
+        of the owner with the lowest recent usage relative to its weight
+        gang_hold_window - a gang request that is the active job of some of its resources but can't get all of them
+        for this time, moves its jobs behind the next jobs in these queues
+        use_backfill - a request for one resource may take a resource that a waiting gang request is active on,
+        if by its hold time history it will release the resource before the gang request can start
+        pool_min_names - a names group with at least this number of candidates that requests only part of them,
+        waits once in the queue of the pool of its candidates instead of in all the candidates queues,
+        and every candidate that is free is handed to the head of the pool queue. 0 disables the pools
+        full_recheck_interval - a waiting worker checks only the resources that were signaled as changed,
+        and all its candidates at least once in this time, in case a change was missed
+        instance_id - id of this instance when several qrm server instances share the DB ('' for one instance),
+        the token events are published to the instance that runs the token worker.
+        a restarted instance starts the workers of its own open requests only
+        ha_lease_time - active/standby mode (0 disables it), only the instance that holds the leader lease runs
+        workers, the other instances are standbys that serve status requests. when the leader stops renewing
+        the lease, a standby takes it within this time and resumes the workers of all the open requests
+        background_recovery - init_backend returns before the open requests are recovered, so the server answers
+        requests during the recovery (the recovery progress is in the recovery metrics)
+        recovery_batch_size - number of tokens read from the DB in one batch during recovery
+        recovery_concurrency - max number of recovered workers that do their first resources check at the same time
         """
-        self.redis = RedisDB(redis_port)
+        self.ha_lease_time = ha_lease_time
+        self.instance_id = instance_id or (f'{socket.gethostname()}_{os.getpid()}' if ha_lease_time else '')
+        self.redis = RedisDB(redis_port, use_fair_share=use_fair_share, instance_id=self.instance_id)
         self.use_pending_logic = use_pending_logic
         self.tokens_change_event = {}  # type: Dict[str, QRMEvent]
-        self.lock = asyncio.Lock()
+        self.resource_locks = ResourceLocks()  # allocation checks of a resource are done under its lock
+        self.last_seen_flush_interval = last_seen_flush_interval
+        self.pending_last_seen = {}  # type: Dict[str, str]
+        self.last_seen_lock = asyncio.Lock()
+        self.last_seen_flush_task = None  # type: asyncio.Task or None
+        self.last_seen_metrics = {'updates': 0, 'flushes': 0, 'written': 0}
+        self.gang_hold_window = gang_hold_window
+        self.use_backfill = use_backfill
+        self.pool_min_names = pool_min_names
+        self.full_recheck_interval = full_recheck_interval
+        self.recheck_metrics = {'wakeups': 0, 'full_checks': 0, 'checked': 0}
+        if self.instance_id:
+            self.redis.add_token_event_callback(self.on_token_event)
+        self.is_leader = not ha_lease_time
+        self.lease_task = None  # type: asyncio.Task or None
+        self.worker_tasks = set()  # type: Set[asyncio.Task]
+        self.ha_metrics = {'takeovers': 0, 'lost': 0, 'takeover_time': 0.0}
+        self.background_recovery = background_recovery
+        self.recovery_batch_size = recovery_batch_size
+        self.recovery_concurrency = recovery_concurrency
+        self.recovery_task = None  # type: asyncio.Task or None
+        self.recovery_slots = None  # type: asyncio.Semaphore or None
+        self.starting_workers = set()  # type: Set[str]  # recovered workers before their first resources check
+        self.recovery_metrics = {'state': RECOVERY_IDLE, 'tokens': 0, 'open_requests': 0, 'workers': 0,
+                                 'duration': 0.0}
 
     # Recovery from DB
     async def init_backend(self) -> None:
         """
         this method handles recovery from DB, it handles db initialization
-        and then init all backend data structures during DB recovery
+        and then init all backend data structures during DB recovery.
+        with background_recovery it returns before the open requests are recovered
         :return: None
         """
+        if self.ha_lease_time:
+            if await self.redis.acquire_lease(self.instance_id, self.ha_lease_time):
+                await self.take_over(wait=not self.background_recovery)
+            else:
+                logging.info(f'instance {self.instance_id} is standby, the leader is {await self.redis.get_leader()}')
+            self.lease_task = asyncio.ensure_future(self.lease_worker())
+            return
         await self.redis.init_default_params()
+        await self.start_recovery(wait=not self.background_recovery)
+
+    async def start_recovery(self, take_over: bool = False, wait: bool = True) -> None:
+        """
+        :param take_over: the open requests of all the instances are moved to this instance
+        :param wait: wait until the recovery is done
+        """
+        # the state is running from now, also before the recovery task runs
+        self.recovery_metrics.update(state=RECOVERY_RUNNING, tokens=0, open_requests=0, workers=0, duration=0.0)
+        self.recovery_task = asyncio.ensure_future(self.recover(take_over))
+        if wait:
+            await self.recovery_task
+
+    async def recover(self, take_over: bool = False) -> None:
+        """
+        recover the tokens events and then the workers of the open requests, reading the DB in batches
+        """
+        start = time.monotonic()
         await self.init_open_tokens_events()
-        await self.init_workers_with_open_requests()
+        await self.init_workers_with_open_requests(take_over)
+        self.recovery_metrics['state'] = RECOVERY_DONE
+        self.recovery_metrics['duration'] = time.monotonic() - start
+        if take_over:
+            self.ha_metrics['takeover_time'] = self.recovery_metrics['duration']
+        logging.info(f'recovered {self.recovery_metrics["tokens"]} tokens and started '
+                     f'{self.recovery_metrics["workers"]} workers in {self.recovery_metrics["duration"]:.3f} seconds')
+
+    async def take_over(self, wait: bool = True) -> None:
+        """
+        this instance got the leader lease: recover from the DB like a restarted server
+        and run the workers of all the open requests, including the requests of the previous leader
+        :param wait: wait until the recovery is done
+        """
+        logging.info(f'instance {self.instance_id} is the leader')
+        self.is_leader = True
+        self.ha_metrics['takeovers'] += 1
+        await self.redis.init_default_params()
+        await self.start_recovery(take_over=True, wait=wait)
+
+    def step_down(self) -> None:
+        """
+        this instance lost the leader lease, its workers stop as if it crashed and the new leader resumes them
+        """
+        logging.error(f'instance {self.instance_id} lost the leader lease, stopping {len(self.worker_tasks)} workers')
+        self.is_leader = False
+        self.ha_metrics['lost'] += 1
+        if self.recovery_task:
+            self.recovery_task.cancel()
+        for task in list(self.worker_tasks):
+            task.cancel()
+
+    async def lease_worker(self) -> None:
+        # the leader renews its lease and the standby tries to take it, LEASE_CHECKS times per lease time
+        while True:
+            await asyncio.sleep(self.ha_lease_time / LEASE_CHECKS)
+            try:
+                if self.is_leader:
+                    if not await self.redis.renew_lease(self.instance_id, self.ha_lease_time):
+                        self.step_down()
+                elif await self.redis.acquire_lease(self.instance_id, self.ha_lease_time):
+                    # recover in the background, so the lease is renewed meanwhile
+                    await self.take_over(wait=False)
+            except Exception as e:
+                logging.error(f'failed to check the leader lease: {e}')
 
     async def init_open_tokens_events(self) -> None:
         """
-        init all tokens_change_events data structure for open requests
+        init all tokens_change_events data structure for open requests,
+        tokens that already have events (new requests during the recovery) keep them
         :return: None
         """
         logging.info('start init open tokens')
-        all_tokens = await self.redis.get_all_open_tokens()
-        logging.info(f'all tokens in db are {all_tokens}')
-        for token in all_tokens:
-            logging.info(f'init events for token {token}')
-            self.tokens_change_event[token] = QRMEvent()
-            self.tokens_change_event[token].set()
+        async for tokens_state in self.redis.scan_tokens_state(self.recovery_batch_size):
+            for token, token_state in tokens_state.items():
+                if token in self.tokens_change_event:
+                    continue
+                self.tokens_change_event[token] = QRMEvent()
+                self.tokens_change_event[token].set(reason=TOKEN_STATE_EVENT_REASON.get(token_state.state))
+            self.recovery_metrics['tokens'] += len(tokens_state)
+            logging.info(f'init events for {len(tokens_state)} tokens')
 
-    async def init_workers_with_open_requests(self) -> None:
+    async def init_workers_with_open_requests(self, take_over: bool = False) -> None:
         """
-        for every open request, init it's worker
+        for every open request, init it's worker.
+        at most recovery_concurrency workers do their first resources check at the same time
+        :param take_over: the open requests of all the instances are moved to this instance
         :return: None
         """
-        open_requests = await self.redis.get_open_requests()
-        for token in open_requests.keys():
-            asyncio.ensure_future(self.names_worker(token))
+        self.recovery_slots = asyncio.Semaphore(self.recovery_concurrency)
+        self.starting_workers = set()
+        started_tokens = set()
+        async for tokens in self.redis.scan_open_requests_tokens(self.recovery_batch_size):
+            tokens = [token for token in tokens if token not in started_tokens]
+            started_tokens.update(tokens)
+            self.recovery_metrics['open_requests'] += len(tokens)
+            if take_over:
+                await self.redis.set_tokens_instance(tokens, self.instance_id)
+            tokens_instance = await self.redis.get_tokens_instance(tokens) if self.instance_id else {}
+            for token in tokens:
+                if tokens_instance.get(token, self.instance_id) != self.instance_id:
+                    logging.info(f'token {token} belongs to instance {tokens_instance[token]}, '
+                                 f'won\'t start it\'s worker')
+                    continue
+                token_event = self.tokens_change_event.get(token)
+                if token_event is not None and token_event.reason in [CANCELED, NOT_VALID]:
+                    logging.info(f'token {token} is no longer active, won\'t start it\'s worker')
+                    continue
+                await self.recovery_slots.acquire()
+                self.starting_workers.add(token)
+                self.recovery_metrics['workers'] += 1
+                asyncio.ensure_future(self.names_worker(token))
+        # the recovery is done when all the workers did their first check
+        for _ in range(self.recovery_concurrency):
+            await self.recovery_slots.acquire()
+
+    def worker_started(self, token: str) -> None:
+        # the recovered worker did its first resources check (or it's done), the next worker may start
+        if token in self.starting_workers:
+            self.starting_workers.discard(token)
+            self.recovery_slots.release()
 
     async def stop_backend(self) -> None:
+        if self.recovery_task:
+            self.recovery_task.cancel()
+            self.recovery_task = None
+        if self.lease_task:
+            self.lease_task.cancel()
+            self.lease_task = None
+            if self.is_leader:  # let the standby take over now
+                await self.redis.release_lease(self.instance_id)
+        if self.last_seen_flush_task:
+            self.last_seen_flush_task.cancel()
+            self.last_seen_flush_task = None
+        await self.flush_last_seen()
         await self.redis.close()
 
     async def names_worker(self, token: str) -> ResourcesRequestResponse:
@@ -117,9 +355,25 @@ class QueueManagerBackEnd(QrmIfc):
         :param token: request token
         :return: returns the resources response
         """
+        # the workers are stopped when the instance loses the leader lease
+        worker_task = asyncio.current_task()
+        self.worker_tasks.add(worker_task)
+        try:
+            return await self.handle_names_worker(token)
+        finally:
+            self.worker_tasks.discard(worker_task)
+            self.worker_started(token)
 
+    async def handle_names_worker(self, token: str) -> ResourcesRequestResponse:
         user_req = await self.redis.get_open_request_by_token(token)
+        if user_req.gang:
+            ret = await self.gang_worker(token, user_req)
+            if isinstance(ret, ResourcesRequestResponse):
+                return ret
+            return await self.finalize_names_worker(token)
+
         updated_req = copy.deepcopy(user_req)
+        pools = await self.redis.get_token_pools(token)
 
         tasks = []
 
@@ -130,7 +384,8 @@ class QueueManagerBackEnd(QrmIfc):
                         resources_list_request,
                         token,
                         updated_req,
-                        req_index
+                        req_index,
+                        req_index in pools
                     )
                 )
             )
@@ -140,38 +395,207 @@ class QueueManagerBackEnd(QrmIfc):
             if isinstance(ret, ResourcesRequestResponse):
                 return ret
 
+        return await self.finalize_names_worker(token)
+
+    async def finalize_names_worker(self, token: str) -> ResourcesRequestResponse:
         logging.info(f'done handling token: {token}')
+        self.worker_started(token)
 
         if self.use_pending_logic:
             await self.move_resources_to_pending(token=token)
 
         return await self.finalize_filled_request(token)
 
+    async def gang_worker(self, token: str, user_req: ResourcesRequest) -> ResourcesRequestResponse or None:
+        """
+        the worker of all or nothing request, waits until all the names groups can be granted at once.
+        while it waits it doesn't hold any resource, but its job is the active job of some queues,
+        if it can't get all the resources for gang_hold_window, its jobs move behind the next jobs of these queues
+        :param token: request token
+        :param user_req: the open request
+        :return: ResourcesRequestResponse if the request was cancelled or not valid, None when it's filled
+        """
+        active_since = None
+        while True:
+            generation = self.tokens_change_event[token].generation
+            active_resources = await self.find_gang_resources(user_req, token)
+            if active_resources is None:
+                return
+            if not active_resources:
+                active_since = None
+            elif active_since is None:
+                active_since = time.monotonic()
+            elif time.monotonic() - active_since >= self.gang_hold_window:
+                await self.requeue_gang_jobs(token, active_resources)
+                active_since = None
+                continue
+            if active_resources and self.use_backfill:
+                await self.backfill(user_req, token, active_resources)
+
+            logging.info(f'waiting for signal on gang token: {token}')
+            try:
+                timeout = None if active_since is None else self.gang_hold_window - (time.monotonic() - active_since)
+                reason = await asyncio.wait_for(self.worker_wait_for_continue_event(token, generation), timeout)
+            except asyncio.TimeoutError:
+                continue
+            if reason == CANCELED:
+                return ResourcesRequestResponse()
+            if reason == NOT_VALID:
+                logging.error(f'request {token} is not valid')
+                rrr = ResourcesRequestResponse(token=token, message='request not valid')
+                await self.redis.set_token_state(token, TOKEN_INVALID, rrr=rrr)
+                return rrr
+
+    async def find_gang_resources(self, user_req: ResourcesRequest, token: str) -> List[Resource] or None:
+        """
+        if the token job is the active job of enough resources for all the names groups, grant them all at once
+        and remove the jobs from the other resources
+        :return: None if all the resources were granted, else the resources the token job is active on
+        """
+        all_names = {name for names_req in user_req.names for name in names_req.names}
+        async with self.resource_locks.hold(all_names):
+            active_resources = []
+            for resource_name in all_names:
+                resource = await self.redis.get_resource_by_name(resource_name)
+                if resource and resource.status != DISABLED_STATUS and \
+                        (await self.redis.get_active_job(resource)).get('token') == token:
+                    active_resources.append(resource)
+
+            grants = []
+            granted_names = set()
+            for req_index, names_req in enumerate(user_req.names):
+                group_resources = [resource for resource in active_resources
+                                   if resource.name in names_req.names and resource.name not in granted_names]
+                if len(group_resources) < names_req.count:
+                    return active_resources
+                for resource in group_resources[:names_req.count]:
+                    grants.append((resource, req_index))
+                    granted_names.add(resource.name)
+
+            for resource, _ in grants:
+                if resource.token:
+                    await self.cancel_request(resource.token)
+            if not await self.redis.fill_request_at_once(token, grants, owner=user_req.owner):
+                return active_resources
+            logging.info(f'gang token {token} got all its resources: {sorted(granted_names)}')
+
+        unused_names = all_names - granted_names
+        await self.remove_job_from_unused_resources(sorted(unused_names), token)
+        return None
+
+    async def backfill(self, user_req: ResourcesRequest, token: str, active_resources: List[Resource]) -> None:
+        """
+        the gang request can't use the resources it's active on until it gets the rest,
+        so a later request for one resource may use them, if by the hold time history it ends before the
+        earliest time the gang request can start.
+        :param user_req: the gang open request
+        :param token: the gang request token
+        :param active_resources: the resources the gang request is active on
+        """
+        earliest_start = await self.estimate_earliest_start(user_req, active_resources)
+        for resource in active_resources:
+            waiting_jobs = (await self.redis.get_resource_jobs(resource))[-3::-1]  # from the next job to the last
+            candidates = [job for job in waiting_jobs if job.get('queues') == 1]
+            hold_times = await self.redis.get_hold_times(list({job.get('owner', '') for job in candidates}))
+            for job in candidates:
+                hold_time = hold_times.get(job.get('owner', ''))
+                if hold_time is None or time.time() + hold_time > earliest_start:
+                    continue
+                if await self.redis.backfill_job(resource, token, job['token']):
+                    logging.info(f'backfill: job {job["token"]} takes resource {resource.name} from gang '
+                                 f'token {token}, expected hold time {hold_time:.1f}s')
+                    await self.signal_due_to_job_removal(resource)
+                break
+
+    async def estimate_earliest_start(self, user_req: ResourcesRequest, active_resources: List[Resource]) -> float:
+        """
+        estimate the earliest time that the request can get the resources it's not active on, a busy resource
+        is released when its holder reaches its average hold time. the estimate is the current time
+        when it can't be estimated, so nothing is backfilled.
+        """
+        now = time.time()
+        active_names = {resource.name for resource in active_resources}
+        missing_names = list({name for names_req in user_req.names for name in names_req.names} - active_names)
+        holders = await self.redis.get_resources_holders(missing_names)
+        hold_times = await self.redis.get_hold_times(list({holder['owner'] for holder in holders.values()}))
+        remaining_time = {}
+        for resource_name, holder in holders.items():
+            resource = await self.redis.get_resource_by_name(resource_name)
+            active_job = await self.redis.get_active_job(resource) if resource else {}
+            hold_time = hold_times.get(holder['owner'])
+            if active_job.get('token') == holder['token'] and hold_time is not None:
+                remaining_time[resource_name] = max(hold_time - (now - holder['time']), 0)
+
+        earliest_start = now
+        for names_req in user_req.names:
+            missing_count = names_req.count - len(active_names.intersection(names_req.names))
+            if missing_count <= 0:
+                continue
+            group_remaining_time = sorted(remaining_time.get(name, 0) for name in names_req.names
+                                          if name not in active_names)
+            if len(group_remaining_time) < missing_count:
+                return now
+            earliest_start = max(earliest_start, now + group_remaining_time[missing_count - 1])
+        return earliest_start
+
+    async def requeue_gang_jobs(self, token: str, active_resources: List[Resource]) -> None:
+        logging.info(f'gang token {token} can\'t get all its resources, '
+                     f'moving its jobs behind the next jobs of {[resource.name for resource in active_resources]}')
+        for resource in active_resources:
+            if await self.redis.requeue_active_job(token, resource):
+                await self.signal_due_to_job_removal(resource)
+
     async def single_resource_by_name_worker(
             self,
             resources_list_request: ResourcesByName,
             token: str,
             updated_req: ResourcesRequest,
-            req_index: int
+            req_index: int,
+            pooled: bool = False
     ) -> ResourcesRequestResponse:
 
+        checked_generation = None
+        last_full_check = 0
         while resources_list_request.count > 0:
             logging.info(f'remaining resources for token: {token} is: {resources_list_request.count}')
-            await self.find_available_resources_by_names(resources_list_request, token)
+            # signals that arrive while the resources are checked must not be lost
+            token_event = self.tokens_change_event[token]
+            generation = token_event.generation
+            # after a wake up only the signaled resources are checked, all of them in the first check
+            # and once in full_recheck_interval
+            candidates = None
+            if checked_generation is not None and \
+                    time.monotonic() - last_full_check < self.full_recheck_interval:
+                candidates = token_event.changed_since(checked_generation)
+            if candidates is None:
+                self.recheck_metrics['full_checks'] += 1
+                last_full_check = time.monotonic()
+            checked_generation = generation
+            if pooled:
+                # a group that waits in a pool can be active only on the resources that the pool handed to it
+                handed = await self.redis.get_pool_handed(token)
+                candidates = handed if candidates is None else [name for name in candidates if name in handed]
+            # every grant updates the open request in DB with the group remaining count and candidates
+            await self.find_available_resources_by_names(resources_list_request, token, req_index, candidates)
             updated_req.names[req_index] = resources_list_request  # this DS is changed by reference
-            logging.info(f'update open request for token: {token} with: {resources_list_request}')
-            await self.redis.update_open_request(token, updated_req)
+            logging.info(f'open request for token: {token} is: {resources_list_request}')
             if resources_list_request.count != 0:
                 logging.info(f'waiting for signal on token: {token}')
-                reason = await self.worker_wait_for_continue_event(token)
+                reason = await self.worker_wait_for_continue_event(token, generation, self.full_recheck_interval)
+                self.recheck_metrics['wakeups'] += 1
                 logging.info(f'received signal for {token}')
                 if reason == CANCELED:
                     return ResourcesRequestResponse()
                 if reason == NOT_VALID:
                     logging.error(f'request {token} is not valid')
                     rrr = ResourcesRequestResponse(token=token, message='request not valid')
-                    await self.redis.set_req_resp(rrr)
+                    await self.redis.set_token_state(token, TOKEN_INVALID, rrr=rrr)
+                    await self.redis.remove_pool_jobs(token)
                     return rrr
+            elif pooled:
+                handed = await self.redis.get_pool_handed(token)
+                await self.remove_job_from_unused_resources(
+                    [res_name for res_name in resources_list_request.names if res_name in handed], token)
             else:
                 await self.remove_job_from_unused_resources(resources_list_request.names, token)
 
@@ -192,10 +616,31 @@ class QueueManagerBackEnd(QrmIfc):
 
     async def signal_due_to_job_removal(self, resource):
         active_job = await self.redis.get_active_job(resource)
-        try:
-            self.tokens_change_event[active_job['token']].set()
-        except KeyError:
-            pass
+        if 'token' in active_job:
+            await self.signal_token(active_job['token'], resources=[resource.name])
+
+    async def signal_token(self, token: str, reason: str = None, resources: List[str] = None) -> bool:
+        """
+        set the token change event, with several instances the event is published to the other instances too
+        :param token: request token
+        :param reason: CANCELED or NOT_VALID, None for a change in the token resources
+        :param resources: names of the resources that changed, None if the change isn't of specific resources
+        :return: True if the token is known to this instance
+        """
+        token_event = self.tokens_change_event.get(token)
+        if token_event is not None:
+            token_event.set(reason=reason, resources=resources)
+        if self.instance_id:
+            await self.redis.publish_token_event(token, reason, resources, self.instance_id)
+        return token_event is not None
+
+    def on_token_event(self, token_event: dict) -> None:
+        # token event that was published by another instance
+        if token_event['instance'] == self.instance_id:
+            return
+        local_event = self.tokens_change_event.get(token_event['token'])
+        if local_event is not None:
+            local_event.set(reason=token_event['reason'], resources=token_event['resources'])
 
     async def finalize_filled_request(self, token: str):
         """
@@ -204,6 +649,8 @@ class QueueManagerBackEnd(QrmIfc):
         :param token: request token
         :return: ResourcesRequestResponse
         """
+        await self.redis.remove_pool_jobs(token)
+        await self.redis.remove_token_instance(token)
         await self.redis.remove_open_request(token)
         response = await self.redis.get_partial_fill(token)
         logging.info(f'fill for token {token} is {response}')
@@ -257,34 +704,49 @@ class QueueManagerBackEnd(QrmIfc):
                 logging.info(f'done waiting for active state on resource {resource.name}')
         return
 
-    async def worker_wait_for_continue_event(self, token: str) -> str:
+    async def worker_wait_for_continue_event(self, token: str, generation: int = None,
+                                             timeout: float = None) -> str:
         """
         wait for continue event which signal some change on the relevant token.
         once the event is set it means that one of the resources related to this
         token had some change in it's queue
         :param token: request token
-        :return: None
+        :param generation: the event generation when the worker last checked the resources,
+        if the event was set since then, returns without waiting
+        :param timeout: max time to wait, None waits until the event is set
+        :return: the event reason
         """
-        self.tokens_change_event[token].clear()
-        await self.tokens_change_event[token].wait()
+        self.worker_started(token)
+        token_event = self.tokens_change_event[token]
+        if generation is None or token_event.generation == generation:
+            token_event.clear()
+            try:
+                await asyncio.wait_for(token_event.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
 
-        return self.tokens_change_event[token].reason
+        return token_event.reason
 
     async def find_available_resources_by_names(self, resources_list_request: ResourcesByName,
-                                                token: str) -> None:
+                                                token: str, req_index: int = None,
+                                                candidates: List[str] = None) -> None:
         """
         for each resource in the request, check if the active job is the
         one with the requested token and if the resource is not disabled.
         :param resources_list_request: ResourceByName, this is actually
         the one of the items in the list of requests of ResourcesRequest.names
         :param token: request token
-        :param lock: lock object to lock the redis access
+        :param req_index: index of resources_list_request in the open request names groups
+        :param candidates: check only these names of the request, None checks all of them
         :return: None, changes by reference the resources_list_request
         """
 
         matched_resources = []
         for resource_name in resources_list_request.names:
-            async with self.lock:
+            if candidates is not None and resource_name not in candidates:
+                continue
+            self.recheck_metrics['checked'] += 1
+            async with self.resource_locks.hold([resource_name]):
                 resource = await self.redis.get_resource_by_name(resource_name)
                 active_job = await self.redis.get_active_job(resource)
                 logging.info(f'active job for resource {resource_name} is: {active_job.get("token")}')
@@ -294,7 +756,9 @@ class QueueManagerBackEnd(QrmIfc):
                         and resources_list_request.count > 0:
                     if resource.token:
                         await self.cancel_request(resource.token)
-                    await self.redis.partial_fill_request(token, resource)
+                    if not await self.redis.partial_fill_request(token, resource, req_index,
+                                                                 owner=active_job.get('owner', ''), claim=True):
+                        continue
                     logging.debug(f'resource {resource.name} is now belongs to token {token}')
                     matched_resources.append(resource_name)
                     resources_list_request.count -= 1
@@ -311,14 +775,35 @@ class QueueManagerBackEnd(QrmIfc):
         """
 
         user_req = await self.redis.get_open_request_by_token(token)
-
-        for req_by_name in user_req.names:
+        pools = self.get_pool_groups(user_req)
+        resources = []
+        for req_index, req_by_name in enumerate(user_req.names):
+            if req_index in pools:
+                continue
             for res_name in req_by_name.names:
                 resource = await self.redis.get_resource_by_name(res_name)
-                if resource.status != DISABLED_STATUS:
-                    await self.generate_job(resource, user_req.token)
-                else:
+                if resource.status == DISABLED_STATUS:
                     logging.info(f'doesn\'t add job {token} for resource {resource.name}')
+                elif resource not in resources:
+                    resources.append(resource)
+
+        # the job is added to all the queues at once, so all the requests jobs have the same order in all the queues
+        # a job that waits in pools holds its handed resources while it waits for the others
+        queues = len(resources) + sum(user_req.names[req_index].count for req_index in pools)
+        job = self.build_job(user_req.token, user_req.priority, owner=user_req.owner, queues=queues)
+        seq = await self.redis.add_job_to_resources(resources, job)
+        logging.info(f'added job {token} with sequence {seq} to resources {resources}')
+        if pools:
+            await self.redis.set_token_pools(token, pools)
+            job['seq'] = seq
+            for req_index in pools:
+                req_by_name = user_req.names[req_index]
+                pool_id, handed = await self.redis.add_job_to_pool(req_by_name.names, job, req_by_name.count)
+                logging.info(f'added job {token} to pool {pool_id}, handed resources {handed}')
+        if self.use_backfill:
+            # a waiting gang request that is active on these resources may let the new job use them
+            for resource in resources:
+                await self.signal_due_to_job_removal(resource)
 
     async def cancel_request(self, token: str) -> None:
         """
@@ -327,13 +812,18 @@ class QueueManagerBackEnd(QrmIfc):
         :return: None, just remove the request and handle resources cleanup (pending)
         """
 
+        await self.flush_last_seen(exclude_token=token)
         await self.redis.delete_token_last_update_time(token)
         await self.redis.delete_auto_managed_token(token)
         rrr = await self.redis.get_req_resp_for_token(token)
         if not rrr.is_token_active_in_queue:
             rrr.is_valid = False
-            await self.redis.set_req_resp(rrr)
+            await self.redis.set_token_state(token, TOKEN_CANCELED, rrr=rrr)
+        else:
+            await self.redis.set_token_state(token, TOKEN_CANCELED)
 
+        # first leave the pools, so no pool hands the token a resource after its jobs were removed
+        await self.redis.remove_pool_jobs(token)
         affected_resources = await self.redis.remove_job(token=token)
         logging.info(f'resources {affected_resources} were affected by cancel on token {token}')
 
@@ -344,12 +834,12 @@ class QueueManagerBackEnd(QrmIfc):
 
             affected_token = ret["token"]
             # release coros
-            self.tokens_change_event[affected_token].set()
-        try:
-            logging.debug(f'setting token change event for {token}')
-            self.tokens_change_event[token].set(reason=CANCELED)
-        except KeyError as e:
+            await self.signal_token(affected_token, resources=[resource.name])
+        logging.debug(f'setting token change event for {token}')
+        if not await self.signal_token(token, reason=CANCELED) and not self.instance_id:
             logging.error(f'got request to cancel unknown token {token}')
+        await self.redis.remove_token_instance(token)
+        await self.redis.bump_token_revision(token)
 
     async def move_resources_to_pending(self, token: str) -> None:
         """
@@ -433,9 +923,12 @@ class QueueManagerBackEnd(QrmIfc):
         if resources_request.auto_managed:
             await self.redis.add_auto_managed_token(active_token)
 
-        await self.update_last_token_req_time(active_token)
+        # write through, the token must have last_seen time from the moment it's created
+        await self.redis.update_token_last_update_time(active_token, last_update=self.get_request_time_str())
 
         await self.init_event_for_token(active_token)
+        if self.instance_id:
+            await self.redis.set_token_instance(active_token, self.instance_id)
 
         await self.redis.save_orig_resources_req(resources_request)
 
@@ -517,22 +1010,17 @@ class QueueManagerBackEnd(QrmIfc):
         await self.update_last_token_req_time(token)
         return resources_request_resp
 
-    async def generate_job(self, resource, token):
-        logging.info(f'add job {token} for resource {resource}')
-        await self.redis.add_job_to_resource(resource, {'token': token})
+    async def generate_job(self, resource, token, priority: int = DEFAULT_PRIORITY, enqueue_time: float = None,
+                           owner: str = ''):
+        logging.info(f'add job {token} of owner {owner} with priority {priority} for resource {resource}')
+        await self.redis.add_job_to_resource(resource, self.build_job(token, priority, enqueue_time, owner))
 
     async def is_request_active(self, token: str) -> bool:
         # request is active if it's not filled, or it's already cancelled:
-        try:
-            is_filled = await self.redis.is_request_filled(token)
-            is_cancelled = self.tokens_change_event[token].reason == CANCELED
-            if not is_cancelled:  # don't update last_seen for cancelled tokens
-                await self.update_last_token_req_time(token)
-            is_not_valid = self.tokens_change_event[token].reason == NOT_VALID
-            logging.info(f'request for token: {token} cancelled: {is_cancelled}, '
-                         f'filled: {is_filled}, not_valid: {is_not_valid}')
-            return not (is_filled or is_cancelled or is_not_valid)
-        except KeyError as e:
+        token_event = self.tokens_change_event.get(token)
+        token_state = await self.redis.get_token_state(token)
+        # the token of another instance is known only from its state
+        if token_event is None and token_state is None:
             logging.info(f'got request for unknown token {token}')
             rrr = ResourcesRequestResponse()
             rrr.token = token
@@ -540,10 +1028,90 @@ class QueueManagerBackEnd(QrmIfc):
             rrr.message = f'unknown token in qrm {token}'
             await self.redis.set_req_resp(rrr)
             return False
+        reason = token_event.reason if token_event else None
+        state = token_state.state if token_state else ''
+        is_filled = state == TOKEN_FILLED
+        is_cancelled = reason == CANCELED or state == TOKEN_CANCELED
+        if not is_cancelled:  # don't update last_seen for cancelled tokens
+            await self.update_last_token_req_time(token)
+        is_not_valid = reason == NOT_VALID or state == TOKEN_INVALID
+        logging.info(f'request for token: {token} cancelled: {is_cancelled}, '
+                     f'filled: {is_filled}, not_valid: {is_not_valid}')
+        return not (is_filled or is_cancelled or is_not_valid)
+
+    async def get_token_revision(self, token: str) -> int:
+        """
+        the revision changes on every change in the token status,
+        so a client that already has the status of this revision doesn't need it again
+        """
+        return await self.redis.get_token_revision(token)
+
+    async def touch_token(self, token: str) -> None:
+        """
+        update the token last_seen time without building its status
+        """
+        token_event = self.tokens_change_event.get(token)
+        if token_event is not None and token_event.reason != CANCELED:
+            await self.update_last_token_req_time(token)
+
+    def add_token_change_callback(self, callback: Callable[[str], None]) -> None:
+        self.redis.add_token_change_callback(callback)
+
+    def get_metrics(self) -> dict:
+        last_seen_metrics = dict(self.last_seen_metrics)
+        last_seen_metrics['pending'] = len(self.pending_last_seen)
+        last_seen_metrics['writes_saved'] = last_seen_metrics['updates'] - last_seen_metrics['written']
+        metrics = {'last_seen': last_seen_metrics, 'workers': dict(self.recheck_metrics),
+                   'locks': self.resource_locks.get_metrics(), 'recovery': dict(self.recovery_metrics)}
+        if self.ha_lease_time:
+            metrics['ha'] = dict(self.ha_metrics, leader=self.is_leader)
+        return metrics
+
+    def is_standby(self) -> bool:
+        return not self.is_leader
 
     async def update_last_token_req_time(self, token: str) -> None:
-        request_time = datetime.datetime.now().strftime('%m/%d/%Y, %H:%M:%S')
-        await self.redis.update_token_last_update_time(token, last_update=request_time)
+        self.update_tokens_last_seen({token: self.get_request_time_str()})
+
+    def update_tokens_last_seen(self, tokens_last_update: Dict[str, str]) -> None:
+        """
+        keep the last_seen time in memory, it's written to the DB by the flush task.
+        the last_seen time in the DB may be behind by up to last_seen_flush_interval
+        :param tokens_last_update: {token: last_seen time}
+        :return: None
+        """
+        if not tokens_last_update:
+            return
+        self.pending_last_seen.update(tokens_last_update)
+        self.last_seen_metrics['updates'] += len(tokens_last_update)
+        if self.last_seen_flush_task is None or self.last_seen_flush_task.done():
+            self.last_seen_flush_task = asyncio.ensure_future(self.last_seen_flush_worker())
+
+    async def last_seen_flush_worker(self) -> None:
+        while True:
+            await asyncio.sleep(self.last_seen_flush_interval)
+            try:
+                await self.flush_last_seen()
+            except Exception as e:
+                logging.error(f'failed to flush tokens last_seen time: {e}')
+
+    async def flush_last_seen(self, exclude_token: str = '') -> None:
+        """
+        write all the pending last_seen updates to the DB in one batch
+        :param exclude_token: token that its pending update should be dropped (cancelled token)
+        :return: None
+        """
+        async with self.last_seen_lock:
+            self.pending_last_seen.pop(exclude_token, None)
+            # tokens that were cancelled since the update shouldn't get last_seen time again
+            pending = {token: last_update for token, last_update in self.pending_last_seen.items()
+                       if getattr(self.tokens_change_event.get(token), 'reason', None) != CANCELED}
+            self.pending_last_seen = {}
+            if not pending:
+                return
+            await self.redis.update_tokens_last_update_time(pending)
+            self.last_seen_metrics['flushes'] += 1
+            self.last_seen_metrics['written'] += len(pending)
 
     async def get_new_token(self, token: str) -> str:
         new_token = await self.redis.get_active_token_from_user_token(token)
@@ -559,25 +1127,62 @@ class QueueManagerBackEnd(QrmIfc):
     async def get_resource_req_resp(self, token: str) -> ResourcesRequestResponse:
         # if the request is not totally filled, you will get the current partial fill.
         # in case you want only totally filled, first check is_request_active method
-        rrr = await self.redis.get_req_resp_for_token(token)
-        if not rrr.names:
-            return rrr
-        for resource_name in rrr.names:
-            resource = await self.redis.get_resource_by_name(resource_name)
-            res_job = await self.redis.get_active_job(resource)
-            all_resources_dict = await self.redis.get_all_resources_dict()
-            resources_token_list = await self.redis.get_token_resources(token)
+        # the cost depends only on the number of the token resources, not on the resources in the DB
+        snapshot = await self.redis.get_tokens_status_snapshot([token])
+        token_snapshot = snapshot['tokens'][token]
+        rrr = token_snapshot['req_resp']
+        self.update_req_resp_queue_state(token=token,
+                                         rrr=rrr,
+                                         token_resources=token_snapshot['token_resources'],
+                                         owners=snapshot['owners'],
+                                         active_jobs=snapshot['active_jobs'])
+        return rrr
 
-            if self.is_token_valid(token=token,
-                                   resources_dict=all_resources_dict,
-                                   original_resources_token_list=resources_token_list):
-                rrr.is_valid = True
+    async def get_tokens_status(self, tokens: List[str]) -> Dict[str, ResourcesRequestResponse]:
+        """
+        batch version of is_request_active + get_resource_req_resp.
+        all the tokens are evaluated from one DB snapshot, so the number of redis round trips
+        doesn't depend on the number of tokens
+        :param tokens: list of requests tokens
+        :return: {token: ResourcesRequestResponse}, request_complete is set for every token
+        """
+        tokens = list(dict.fromkeys(tokens))  # remove duplicates, keep order
+        snapshot = await self.redis.get_tokens_status_snapshot(tokens)
+        request_time = self.get_request_time_str()
+        tokens_last_update = {}
+        unknown_tokens_resp = []
+        tokens_status = {}
+
+        for token in tokens:
+            token_snapshot = snapshot['tokens'][token]
+            token_event = self.tokens_change_event.get(token)
+            # the token of another instance is known only from its state
+            if token_event is None and token_snapshot['state'] is None:
+                logging.info(f'got request for unknown token {token}')
+                rrr = ResourcesRequestResponse(token=token, is_valid=False, message=f'unknown token in qrm {token}')
+                unknown_tokens_resp.append(copy.deepcopy(rrr))
+                rrr.request_complete = True
+                tokens_status[token] = rrr
+                continue
 
-            if res_job.get('token') != token:
-                rrr.is_token_active_in_queue = False
-                return rrr
-        rrr.is_token_active_in_queue = True  # all resources jobs are active in queues
-        return rrr
+            state = token_snapshot['state'].state if token_snapshot['state'] else ''
+            reason = token_event.reason if token_event else None
+            is_cancelled = reason == CANCELED or state == TOKEN_CANCELED
+            is_not_valid = reason == NOT_VALID or state == TOKEN_INVALID
+            if not is_cancelled:  # don't update last_seen for cancelled tokens
+                tokens_last_update[token] = request_time
+            rrr = token_snapshot['req_resp']
+            self.update_req_resp_queue_state(token=token,
+                                             rrr=rrr,
+                                             token_resources=token_snapshot['token_resources'],
+                                             owners=snapshot['owners'],
+                                             active_jobs=snapshot['active_jobs'])
+            rrr.request_complete = token_snapshot['is_filled'] or is_cancelled or is_not_valid
+            tokens_status[token] = rrr
+
+        await self.redis.set_req_resps(unknown_tokens_resp)
+        self.update_tokens_last_seen(tokens_last_update)
+        return tokens_status
 
     async def validate_new_request(self, resources_request: ResourcesRequest) -> bool:
         all_validations = list()
@@ -594,10 +1199,11 @@ class QueueManagerBackEnd(QrmIfc):
                 message=msg,
                 is_valid=False
             )
-            await self.redis.set_req_resp(rrr)
             logging.error(f'request for token {resources_request.token} is not valid: {msg}')
+            # set the reason before the response is saved, since saving it changes the token revision:
             self.tokens_change_event[resources_request.token].set()
             self.tokens_change_event[resources_request.token].reason = NOT_VALID
+            await self.redis.set_token_state(resources_request.token, TOKEN_INVALID, rrr=rrr)
             return False
         return True
 
@@ -640,13 +1246,88 @@ class QueueManagerBackEnd(QrmIfc):
                     logging.info(f'resource {resource_obj.name} is no longer belongs to token: {token}')
                     return False
             else:
-                logging.info(f'resource {resource_obj.name} is no longer exists in the system, therefore token '
+                logging.info(f'resource {orig_resource_in_group.name} is no longer exists in the system, therefore token '
                              f'{token} is not valid')
                 return False
 
         logging.info(f'token {token} is still valid')
         return True
 
+    @staticmethod
+    def is_token_valid_by_owners(token: str, owners: Dict[str, str],
+                                 original_resources_token_list: List[Resource]) -> bool:
+        """
+        same as is_token_valid, but uses only the owner token of each resource
+        :param token: request token
+        :param owners: {resource_name: owner token}, resources that are not in the DB has no owner
+        :param original_resources_token_list: the resources of the filled token
+        :return: True if all the token resources still belong to the token
+        """
+        if not original_resources_token_list:
+            return False
+        for orig_resource_in_group in original_resources_token_list:
+            owner = owners.get(orig_resource_in_group.name)
+            if not owner:
+                logging.info(f'resource {orig_resource_in_group.name} is no longer exists in the system '
+                             f'or has no token, therefore token {token} is not valid')
+                return False
+            if owner != token:  # token expired
+                logging.info(f'resource {orig_resource_in_group.name} is no longer belongs to token: {token}')
+                return False
+
+        logging.info(f'token {token} is still valid')
+        return True
+
+    @staticmethod
+    def update_req_resp_queue_state(token: str, rrr: ResourcesRequestResponse, token_resources: List[Resource],
+                                    owners: Dict[str, str], active_jobs: Dict[str, dict]) -> None:
+        """
+        update the validity and the queue state of the token response from data that was already read from the DB
+        :param token: request token
+        :param rrr: the last response of the token, changed by reference
+        :param token_resources: the resources of the filled token
+        :param owners: {resource_name: owner token} for all the resources in token_resources
+        :param active_jobs: {resource_name: active job} for all the resources in rrr
+        :return: None
+        """
+        if not rrr.names:
+            return
+        if QueueManagerBackEnd.is_token_valid_by_owners(token=token,
+                                                        owners=owners,
+                                                        original_resources_token_list=token_resources):
+            rrr.is_valid = True
+        rrr.is_token_active_in_queue = all(active_jobs.get(resource_name, {}).get('token') == token
+                                           for resource_name in rrr.names)
+
+    def get_pool_groups(self, user_req: ResourcesRequest) -> Dict[int, str]:
+        """
+        :return: {names group index: pool id} of the request groups that wait in pool queues, these are groups of
+        at least pool_min_names candidates that request only part of them and don't share candidates with
+        the other groups of the request. gang requests don't wait in pools
+        """
+        if not self.pool_min_names or user_req.gang:
+            return {}
+        pools = {}
+        for req_index, req_by_name in enumerate(user_req.names):
+            names = set(req_by_name.names)
+            other_names = set(name for other in user_req.names if other is not req_by_name for name in other.names)
+            if len(names) >= self.pool_min_names and req_by_name.count < len(names) and names.isdisjoint(other_names):
+                pools[req_index] = RedisDB.pool_id(req_by_name.names)
+        return pools
+
+    @staticmethod
+    def build_job(token: str, priority: int = DEFAULT_PRIORITY, enqueue_time: float = None, owner: str = '',
+                  queues: int = 1) -> dict:
+        """
+        :param queues: the number of resources queues the job is added to
+        """
+        return {'token': token, 'priority': priority, 'enqueue_time': enqueue_time or time.time(), 'owner': owner,
+                'queues': queues}
+
+    @staticmethod
+    def get_request_time_str() -> str:
+        return datetime.datetime.now().strftime('%m/%d/%Y, %H:%M:%S')
+
     @staticmethod
     def get_resources_names_from_resources_list(resources: List[Resource]) -> List[str]:
         res_names_list = []
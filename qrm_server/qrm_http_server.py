@@ -3,6 +3,8 @@ import json
 import logging
 import datetime
 import asyncio
+import multiprocessing
+import socket
 import aiohttp_jinja2
 import jinja2
 import sys
@@ -10,15 +12,18 @@ from logging.handlers import TimedRotatingFileHandler
 from aiohttp import web
 from http import HTTPStatus
 from qrm_defs.qrm_urls import URL_POST_NEW_REQUEST, URL_GET_TOKEN_STATUS, URL_POST_CANCEL_TOKEN, URL_GET_ROOT, \
-    URL_GET_UPTIME, URL_GET_IS_SERVER_UP
-from qrm_server.q_manager import QueueManagerBackEnd, QrmIfc
+    URL_GET_UPTIME, URL_GET_IS_SERVER_UP, URL_POST_TOKENS_STATUS, URL_GET_METRICS
+from qrm_server.q_manager import QueueManagerBackEnd, QrmIfc, POOL_MIN_NAMES
+from qrm_server.token_status_cache import TokenStatusCache
 from qrm_defs.resource_definition import resource_request_from_json, ResourcesRequestResponse
 from pathlib import Path
+from typing import Tuple
 
 LOG_FILE_PATH = '/tmp/log/qrm-server/qrm_server.txt'
 VERSION_FILE_NAME = 'qrm_server_ver.yaml'
 HTTP_LISTEN_PORT = 5555
 global qrm_back_end
+global token_status_cache
 global_number: int = 0
 
 here = Path(__file__).resolve().parent
@@ -31,13 +36,20 @@ def canceled_token_msg(token):
 
 def init_qrm_back_end(qrm_back_end_obj: QrmIfc) -> None:
     global qrm_back_end
+    global token_status_cache
     qrm_back_end = qrm_back_end_obj
+    token_status_cache = TokenStatusCache()
+    qrm_back_end.add_token_change_callback(token_status_cache.invalidate)
 
 
 async def new_request(request) -> web.json_response:
     global qrm_back_end  # type: QueueManagerBackEnd
     request_json = await request.json()
     logging.info(f'new request {request_json}')
+    if qrm_back_end.is_standby():
+        logging.info('standby instance, the new request should be sent to the leader')
+        rrr_obj = ResourcesRequestResponse(is_valid=False, message='standby qrm server, send the request to the leader')
+        return web.json_response(rrr_obj.to_json(), status=HTTPStatus.SERVICE_UNAVAILABLE)
     resource_request = resource_request_from_json(request_json)
     asyncio.ensure_future(qrm_back_end.new_request(resources_request=resource_request))
     active_token = await qrm_back_end.get_new_token(resource_request.token)
@@ -49,23 +61,66 @@ async def new_request(request) -> web.json_response:
     return web.json_response(rrr_json, status=HTTPStatus.OK)
 
 
-# noinspection PyUnusedLocal
-async def get_token_status(request) -> web.json_response:
+def token_etag(revision: int) -> str:
+    return f'"{revision}"'
+
+
+async def build_token_status(token: str) -> Tuple[str, str]:
+    """
+    :return: (etag, token status json)
+    """
     global qrm_back_end  # type: QueueManagerBackEnd
-    logging.info(f'in url get_token_status {request.rel_url}')
-    token = request.rel_url.query['token']
+    # the revision is read before the status, so in the worst case the client will get the next one again:
+    etag = token_etag(await qrm_back_end.get_token_revision(token=token))
     if await qrm_back_end.is_request_active(token=token):
         rrr_obj = await qrm_back_end.get_resource_req_resp(token=token)
         rrr_obj.request_complete = False
-        rrr_json = rrr_obj.to_json()
-        logging.debug(f'sending to client: {rrr_json}')
-        return web.json_response(rrr_json, status=HTTPStatus.OK)
     else:
         rrr_obj = await qrm_back_end.get_resource_req_resp(token=token)
         rrr_obj.request_complete = True
-        rrr_json = rrr_obj.to_json()
-        logging.debug(f'sending to client: {rrr_json}')
-        return web.json_response(rrr_json, status=HTTPStatus.OK)
+    return etag, rrr_obj.to_json()
+
+
+# noinspection PyUnusedLocal
+async def get_token_status(request) -> web.json_response:
+    global qrm_back_end  # type: QueueManagerBackEnd
+    global token_status_cache  # type: TokenStatusCache
+    logging.info(f'in url get_token_status {request.rel_url}')
+    token = request.rel_url.query['token']
+    if_none_match = request.headers.get('If-None-Match')
+    cached_status = token_status_cache.lookup(token)
+    if cached_status:
+        etag, rrr_json = cached_status
+        await qrm_back_end.touch_token(token=token)
+    else:
+        etag = token_etag(await qrm_back_end.get_token_revision(token=token))
+        if if_none_match == etag:
+            await qrm_back_end.touch_token(token=token)
+        else:
+            # concurrent lookups of the same token share one status evaluation
+            (etag, rrr_json), computed = await token_status_cache.single_flight(token, build_token_status)
+            if not computed:
+                await qrm_back_end.touch_token(token=token)
+    if if_none_match == etag:
+        logging.debug(f'token {token} status not modified since revision {etag}')
+        return web.Response(status=HTTPStatus.NOT_MODIFIED, headers={'ETag': etag})
+    logging.debug(f'sending to client: {rrr_json}')
+    return web.json_response(rrr_json, status=HTTPStatus.OK, headers={'ETag': etag})
+
+
+async def get_tokens_status(request) -> web.json_response:
+    # expected request: {"tokens": ["token1", "token2", ...]}
+    # response: {"token1": ResourcesRequestResponse as dict, "token2": ...}
+    global qrm_back_end  # type: QueueManagerBackEnd
+    req_dict = await request.json()
+    if isinstance(req_dict, str):
+        req_dict = json.loads(req_dict)
+    tokens = req_dict.get('tokens', [])
+    logging.info(f'in url get_tokens_status for {len(tokens)} tokens')
+    tokens_status = await qrm_back_end.get_tokens_status(tokens=tokens)
+    resp_dict = {token: rrr_obj.to_dict() for token, rrr_obj in tokens_status.items()}
+    logging.debug(f'sending to client: {resp_dict}')
+    return web.json_response(resp_dict, status=HTTPStatus.OK)
 
 
 # noinspection PyUnusedLocal
@@ -94,6 +149,17 @@ async def cancel_token(request) -> web.Response:
     return web.json_response(rrr_json, status=HTTPStatus.OK)
 
 
+# noinspection PyUnusedLocal
+async def metrics(request) -> web.json_response:
+    global token_status_cache  # type: TokenStatusCache
+    global qrm_back_end  # type: QrmIfc
+    metrics_dict = {
+        'token_status_cache': token_status_cache.get_metrics()
+    }
+    metrics_dict.update(qrm_back_end.get_metrics())
+    return web.json_response(metrics_dict, status=HTTPStatus.OK)
+
+
 # noinspection PyUnusedLocal
 @aiohttp_jinja2.template('base.html')
 async def root_url(request) -> web.Response:
@@ -139,8 +205,15 @@ async def close_qrm_backend(request) -> web.Response:
                         text=f'stop qrm backend')
 
 
-async def main(use_pending_logic: bool = False):
-    init_qrm_back_end(qrm_back_end_obj=QueueManagerBackEnd(use_pending_logic=use_pending_logic))
+async def main(use_pending_logic: bool = False, use_fair_share: bool = False, use_backfill: bool = False,
+               pool_min_names: int = POOL_MIN_NAMES, instance_id: str = '', ha_lease_time: float = 0):
+    init_qrm_back_end(qrm_back_end_obj=QueueManagerBackEnd(use_pending_logic=use_pending_logic,
+                                                           use_fair_share=use_fair_share,
+                                                           use_backfill=use_backfill,
+                                                           pool_min_names=pool_min_names,
+                                                           instance_id=instance_id,
+                                                           ha_lease_time=ha_lease_time,
+                                                           background_recovery=True))
     app = web.Application()
     aiohttp_jinja2.setup(app, loader=jinja2.FileSystemLoader(f'{here}/templates'))
     app.router.add_post(URL_POST_CANCEL_TOKEN, cancel_token)
@@ -148,7 +221,9 @@ async def main(use_pending_logic: bool = False):
     app.router.add_get(URL_GET_UPTIME, uptime_url)
     app.router.add_get(URL_GET_ROOT, root_url)
     app.router.add_get(URL_GET_TOKEN_STATUS, get_token_status)
+    app.router.add_post(URL_POST_TOKENS_STATUS, get_tokens_status)
     app.router.add_get(URL_GET_IS_SERVER_UP, is_server_up)
+    app.router.add_get(URL_GET_METRICS, metrics)
     app.on_startup.append(init_qrm_backend)
     app.on_shutdown.append(close_qrm_backend)
     return app
@@ -172,14 +247,50 @@ def config_log(path_to_log_file: str = LOG_FILE_PATH, loglevel: int = None):
 
 
 def run_server(listen_port: int = HTTP_LISTEN_PORT, use_pending_logic: bool = False,
-               path_to_log_file: str = LOG_FILE_PATH, loglevel=None) -> None:
+               path_to_log_file: str = LOG_FILE_PATH, loglevel=None, use_fair_share: bool = False,
+               use_backfill: bool = False, pool_min_names: int = POOL_MIN_NAMES, workers: int = 1,
+               instance_id: str = '', reuse_port: bool = False, ha_lease_time: float = 0) -> None:
+    """
+    :param workers: number of server processes that listen on the same port (SO_REUSEPORT),
+    every process is an instance with id <instance_id>_<index> and its own log file
+    :param instance_id: id of this server instance when several instances share the redis DB
+    :param reuse_port: listen with SO_REUSEPORT
+    :param ha_lease_time: active/standby mode, a standby server takes over this time after the leader stopped
+    """
+    if workers > 1:
+        instance_id = instance_id or f'{socket.gethostname()}_{listen_port}'
+        log_path = Path(path_to_log_file)
+        processes = [multiprocessing.Process(target=run_server,
+                                             kwargs={'listen_port': listen_port,
+                                                     'use_pending_logic': use_pending_logic,
+                                                     'path_to_log_file': str(log_path.with_name(
+                                                         f'{log_path.stem}_{index}{log_path.suffix}')),
+                                                     'loglevel': loglevel,
+                                                     'use_fair_share': use_fair_share,
+                                                     'use_backfill': use_backfill,
+                                                     'pool_min_names': pool_min_names,
+                                                     'instance_id': f'{instance_id}_{index}',
+                                                     'reuse_port': True,
+                                                     'ha_lease_time': ha_lease_time})
+                     for index in range(workers)]
+        for process in processes:
+            process.start()
+        for process in processes:
+            process.join()
+        return
     if loglevel is None:
         loglevel = logging.INFO
     config_log(path_to_log_file=path_to_log_file, loglevel=loglevel)
     print_version_str()
     logging.info(f'listening on port {listen_port}')
     logging.info(f'use_pending_logic: {use_pending_logic}')
-    web.run_app(main(use_pending_logic), port=listen_port)
+    logging.info(f'use_fair_share: {use_fair_share}')
+    logging.info(f'use_backfill: {use_backfill}')
+    logging.info(f'pool_min_names: {pool_min_names}')
+    logging.info(f'instance_id: {instance_id}')
+    logging.info(f'ha_lease_time: {ha_lease_time}')
+    web.run_app(main(use_pending_logic, use_fair_share, use_backfill, pool_min_names, instance_id, ha_lease_time),
+                port=listen_port, reuse_port=reuse_port or None)
 
 
 def get_version_str() -> str:
@@ -214,6 +325,33 @@ def create_parser() -> argparse.ArgumentParser.parse_args:
                         help='move resource to pending when resource change owners',
                         default=False,
                         action='store_true')
+    parser.add_argument('--use_fair_share',
+                        help='the next active job of a resource is chosen by the owners weighted fair share',
+                        default=False,
+                        action='store_true')
+    parser.add_argument('--use_backfill',
+                        help='requests for one resource may use the resources a waiting gang request can\'t use yet',
+                        default=False,
+                        action='store_true')
+    parser.add_argument('--pool_min_names',
+                        help='names groups with at least this number of candidates wait once in a pool queue, '
+                             '0 disables the pools',
+                        type=int,
+                        default=POOL_MIN_NAMES)
+    parser.add_argument('--workers',
+                        help='number of server processes that listen on the same port',
+                        type=int,
+                        default=1)
+    parser.add_argument('--instance_id',
+                        help='id of this server when several servers share the redis DB, '
+                             'with --workers every process id is <instance_id>_<index>',
+                        default='')
+    parser.add_argument('--ha_lease_time',
+                        help='active/standby mode, only the server that holds the leader lease runs the requests, '
+                             'a standby server takes over this number of seconds after the leader stopped. '
+                             '0 disables it',
+                        type=float,
+                        default=0)
 
     parser.add_argument('--log_file_path',
                         help='path to text log file',
@@ -239,7 +377,10 @@ if __name__ == "__main__":
     try:
         run_args = create_parser()
         run_server(int(run_args.listen_port), run_args.use_pending_logic, path_to_log_file=run_args.log_file_path,
-                   loglevel=run_args.loglevel)
+                   loglevel=run_args.loglevel, use_fair_share=run_args.use_fair_share,
+                   use_backfill=run_args.use_backfill, pool_min_names=run_args.pool_min_names,
+                   workers=run_args.workers, instance_id=run_args.instance_id,
+                   ha_lease_time=run_args.ha_lease_time)
     except KeyboardInterrupt:
         print('\n\nProgram terminated by user. Exiting...')
         try:
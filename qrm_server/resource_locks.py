@@ -0,0 +1,98 @@
+import asyncio
+import time
+from typing import Dict, Iterable, List
+
+
+class ResourceLocks(object):
+    """
+    asyncio locks keyed by resource name, so the allocation checks of unrelated resources don't wait for each other.
+    several resources are locked in sorted names order, so holders of overlapping resources can't deadlock.
+    the lock of a resource is dropped when no one holds it or waits for it
+    """
+    def __init__(self):
+        self.locks = {}  # type: Dict[str, asyncio.Lock]
+        self.users = {}  # type: Dict[str, int]  # number of holders and waiters of every lock
+        self.metrics = {
+            'acquired': 0,
+            'contended': 0,
+            'wait_time': 0.0,
+            'max_wait_time': 0.0,
+            'hold_time': 0.0,
+            'max_hold_time': 0.0,
+        }
+
+    def hold(self, names: Iterable[str]) -> 'LockedResources':
+        """
+        async with resource_locks.hold(names): ...
+        :param names: the resources names to lock
+        """
+        return LockedResources(self, sorted(set(names)))
+
+    async def acquire(self, names: List[str]) -> float:
+        """
+        :param names: sorted resources names
+        :return: the time the locks were acquired
+        """
+        for name in names:
+            self.users[name] = self.users.get(name, 0) + 1
+            if name not in self.locks:
+                self.locks[name] = asyncio.Lock()
+        start = time.monotonic()
+        contended = False
+        locked = []
+        try:
+            for name in names:
+                lock = self.locks[name]
+                contended = contended or lock.locked()
+                await lock.acquire()
+                locked.append(name)
+        except BaseException:
+            self.release(names, locked)
+            raise
+        acquired_time = time.monotonic()
+        wait_time = acquired_time - start
+        self.metrics['acquired'] += 1
+        self.metrics['contended'] += int(contended)
+        self.metrics['wait_time'] += wait_time
+        self.metrics['max_wait_time'] = max(self.metrics['max_wait_time'], wait_time)
+        return acquired_time
+
+    def release(self, names: List[str], locked: List[str] = None, acquired_time: float = None) -> None:
+        """
+        :param names: the resources names that were passed to acquire
+        :param locked: the names that were locked, None if all of them were locked
+        :param acquired_time: the time the locks were acquired, updates the hold time metrics
+        """
+        for name in names if locked is None else locked:
+            self.locks[name].release()
+        for name in names:
+            self.users[name] -= 1
+            if not self.users[name]:
+                del self.users[name]
+                del self.locks[name]
+        if acquired_time is not None:
+            hold_time = time.monotonic() - acquired_time
+            self.metrics['hold_time'] += hold_time
+            self.metrics['max_hold_time'] = max(self.metrics['max_hold_time'], hold_time)
+
+    def get_metrics(self) -> dict:
+        metrics = dict(self.metrics)
+        acquired = self.metrics['acquired']
+        metrics['mean_wait_time'] = self.metrics['wait_time'] / acquired if acquired else 0.0
+        metrics['mean_hold_time'] = self.metrics['hold_time'] / acquired if acquired else 0.0
+        metrics['locks'] = len(self.locks)
+        return metrics
+
+
+class LockedResources(object):
+    def __init__(self, resource_locks: ResourceLocks, names: List[str]):
+        self.resource_locks = resource_locks
+        self.names = names
+        self.acquired_time = None  # type: float or None
+
+    async def __aenter__(self) -> 'LockedResources':
+        self.acquired_time = await self.resource_locks.acquire(self.names)
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb) -> None:
+        self.resource_locks.release(self.names, acquired_time=self.acquired_time)
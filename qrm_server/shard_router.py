@@ -0,0 +1,152 @@
+import argparse
+import logging
+import sys
+import time
+import aiohttp
+from aiohttp import web
+from db_adapters.redis_adapter import RedisDB
+from qrm_defs.qrm_urls import URL_POST_NEW_REQUEST, URL_GET_TOKEN_STATUS, URL_POST_CANCEL_TOKEN, \
+    URL_GET_IS_SERVER_UP, URL_POST_TOKENS_STATUS, URL_GET_METRICS
+from qrm_defs.resource_definition import json_to_dict
+from typing import Dict, Set
+
+LISTEN_PORT = 5555
+REDIS_PORT = 6379
+RESOURCES_REFRESH_TIME = 5  # seconds, the resources shards are reloaded from the DB after this time
+FORWARDED_REQUEST_HEADERS = ['Content-Type', 'If-None-Match']
+FORWARDED_RESPONSE_HEADERS = ['Content-Type', 'ETag']
+
+
+class ShardRouter(object):
+    """
+    forwards the qrm clients requests to the qrm servers that share the redis DB, a server per shard of resources.
+    the shard of a resource is its shard attribute, or its type if it has no shard.
+    a new request for resources of one shard is sent to the server of the shard, so every server runs the
+    workers of its shard requests only. requests for resources of several shards, or of shards without server,
+    are sent to the default server, they are safe to run next to the shards requests since the resources are
+    granted in the redis scripts, in the global sequence order of the requests of several resources.
+    the tokens status is read from the DB, so all the other requests are sent to the default server
+    """
+    def __init__(self, shards_urls: Dict[str, str], default_url: str, redis_port: int = REDIS_PORT,
+                 resources_refresh_time: float = RESOURCES_REFRESH_TIME):
+        """
+        :param shards_urls: {shard: url of the qrm server of the shard}
+        :param default_url: url of the qrm server for the other requests
+        """
+        self.shards_urls = shards_urls
+        self.default_url = default_url
+        self.redis_port = redis_port
+        self.redis = None  # type: RedisDB or None
+        self.resources_refresh_time = resources_refresh_time
+        self.resources_shard = {}  # type: Dict[str, str]  # resource name -> shard
+        self.resources_load_time = 0.0
+        self.session = None  # type: aiohttp.ClientSession or None
+        self.metrics = {'forwarded': {}, 'cross_shard': 0}
+
+    async def start(self, app: web.Application = None) -> None:
+        self.redis = RedisDB(self.redis_port)
+        self.session = aiohttp.ClientSession()
+
+    async def stop(self, app: web.Application = None) -> None:
+        await self.session.close()
+        await self.redis.close()
+
+    async def load_resources_shard(self) -> None:
+        if time.monotonic() - self.resources_load_time < self.resources_refresh_time:
+            return
+        all_resources = await self.redis.get_all_resources_dict()
+        self.resources_shard = {name: resource.get_shard() for name, resource in all_resources.items()}
+        self.resources_load_time = time.monotonic()
+
+    async def request_shards(self, request_dict: dict) -> Set[str]:
+        """
+        :param request_dict: the new request json as dict
+        :return: the shards of all the request candidates, an unknown resource is in shard ''
+        """
+        await self.load_resources_shard()
+        names = set()
+        for names_request in request_dict.get('names') or []:
+            names.update(names_request['names'])
+        for tags_request in request_dict.get('tags') or []:
+            names.update(await self.redis.get_resources_names_by_tags(tags_request['tags']))
+        return {self.resources_shard.get(name, '') for name in names}
+
+    async def new_request_url(self, request_dict: dict) -> str:
+        shards = await self.request_shards(request_dict)
+        if len(shards) > 1:
+            self.metrics['cross_shard'] += 1
+        if len(shards) == 1:
+            return self.shards_urls.get(shards.pop(), self.default_url)
+        return self.default_url
+
+    async def forward(self, request: web.Request, url: str) -> web.Response:
+        body = await request.read()
+        headers = {name: request.headers[name] for name in FORWARDED_REQUEST_HEADERS if name in request.headers}
+        self.metrics['forwarded'][url] = self.metrics['forwarded'].get(url, 0) + 1
+        async with self.session.request(request.method, f'{url}{request.path_qs}', data=body,
+                                        headers=headers) as resp:
+            resp_body = await resp.read()
+            resp_headers = {name: resp.headers[name] for name in FORWARDED_RESPONSE_HEADERS if name in resp.headers}
+            return web.Response(body=resp_body, status=resp.status, headers=resp_headers)
+
+    async def new_request(self, request: web.Request) -> web.Response:
+        request_dict = json_to_dict(await request.json())
+        url = await self.new_request_url(request_dict)
+        logging.info(f'forward new request of token {request_dict.get("token")} to {url}')
+        return await self.forward(request, url)
+
+    async def forward_to_default(self, request: web.Request) -> web.Response:
+        return await self.forward(request, self.default_url)
+
+    # noinspection PyUnusedLocal
+    async def get_metrics(self, request: web.Request) -> web.Response:
+        return web.json_response(self.metrics)
+
+
+def create_app(router: ShardRouter) -> web.Application:
+    app = web.Application()
+    app.router.add_post(URL_POST_NEW_REQUEST, router.new_request)
+    app.router.add_post(URL_POST_CANCEL_TOKEN, router.forward_to_default)
+    app.router.add_get(URL_GET_TOKEN_STATUS, router.forward_to_default)
+    app.router.add_post(URL_POST_TOKENS_STATUS, router.forward_to_default)
+    app.router.add_get(URL_GET_IS_SERVER_UP, router.forward_to_default)
+    app.router.add_get(URL_GET_METRICS, router.get_metrics)
+    app.on_startup.append(router.start)
+    app.on_cleanup.append(router.stop)
+    return app
+
+
+def create_parser() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description='QRM SHARD ROUTER')
+    parser.add_argument('--listen_port',
+                        help='shard router listen port',
+                        type=int,
+                        default=LISTEN_PORT)
+    parser.add_argument('--redis_port',
+                        help='redis server listen port',
+                        type=int,
+                        default=REDIS_PORT)
+    parser.add_argument('--shard',
+                        help='<shard>=<url> of the qrm server of the shard, can be repeated',
+                        action='append',
+                        default=[])
+    parser.add_argument('--default_url',
+                        help='url of the qrm server for requests of several shards and the tokens requests',
+                        required=True)
+    return parser.parse_args()
+
+
+def main() -> None:
+    logging.basicConfig(level=logging.INFO, format='[%(asctime)s] [%(levelname)s] [%(module)s] [%(message)s]')
+    args = create_parser()
+    shards_urls = dict(shard_url.split('=', 1) for shard_url in args.shard)
+    logging.info(f'shards: {shards_urls}, default: {args.default_url}')
+    web.run_app(create_app(ShardRouter(shards_urls, args.default_url, args.redis_port)), port=args.listen_port)
+
+
+if __name__ == '__main__':
+    try:
+        main()
+    except KeyboardInterrupt:
+        print('\n\nProgram terminated by user. Exiting...')
+        sys.exit(0)
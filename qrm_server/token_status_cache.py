@@ -0,0 +1,96 @@
+import asyncio
+import logging
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, Tuple
+
+TOKEN_STATUS_CACHE_TTL = 1.0
+TOKEN_STATUS_CACHE_MAX_SIZE = 10000
+
+
+class TokenStatusCache(object):
+    """
+    short TTL cache for token status lookups in the qrm http server.
+    concurrent lookups of the same token share one computation (single flight),
+    and every change in the token status invalidates the cached value.
+    the TTL is only a safety net for changes done by other processes (the management server for example)
+    """
+    def __init__(self, ttl: float = TOKEN_STATUS_CACHE_TTL, max_size: int = TOKEN_STATUS_CACHE_MAX_SIZE):
+        self.ttl = ttl
+        self.max_size = max_size
+        self.entries = OrderedDict()  # type: OrderedDict[str, Tuple[float, Any]]
+        self.in_flight = {}  # type: Dict[str, asyncio.Future]
+        self.invalidated_in_flight = set()
+        self.metrics = {
+            'hits': 0,
+            'misses': 0,
+            'coalesced': 0,
+            'computed': 0,
+            'invalidations': 0,
+        }
+
+    def lookup(self, token: str) -> Any:
+        """
+        :param token: request token
+        :return: the cached value, None if the token is not cached or its value expired
+        """
+        entry = self.entries.get(token)
+        if entry is not None:
+            expiration_time, value = entry
+            if expiration_time > time.monotonic():
+                self.entries.move_to_end(token)
+                self.metrics['hits'] += 1
+                return value
+            del self.entries[token]
+        self.metrics['misses'] += 1
+        return None
+
+    async def single_flight(self, token: str, compute: Callable[[str], Awaitable[Any]]) -> Tuple[Any, bool]:
+        """
+        compute the token value, if the same token is already computed by another lookup, wait for its result.
+        the value is cached unless the token was invalidated while it was computed
+        :param token: request token
+        :param compute: coroutine function that gets the token and returns its value
+        :return: (value, True if this call computed the value)
+        """
+        if token in self.in_flight:
+            self.metrics['coalesced'] += 1
+            return await asyncio.shield(self.in_flight[token]), False
+
+        future = asyncio.get_event_loop().create_future()
+        self.in_flight[token] = future
+        try:
+            value = await compute(token)
+        except Exception as e:
+            future.set_exception(e)
+            future.exception()  # mark the exception as retrieved in case no one else waits for it
+            raise
+        else:
+            future.set_result(value)
+            self.metrics['computed'] += 1
+            if token not in self.invalidated_in_flight:
+                self.store(token, value)
+        finally:
+            del self.in_flight[token]
+            self.invalidated_in_flight.discard(token)
+        return value, True
+
+    def store(self, token: str, value: Any) -> None:
+        self.entries[token] = (time.monotonic() + self.ttl, value)
+        self.entries.move_to_end(token)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    def invalidate(self, token: str) -> None:
+        if token in self.in_flight:
+            self.invalidated_in_flight.add(token)
+        if self.entries.pop(token, None) is not None:
+            logging.debug(f'invalidate cached status of token {token}')
+            self.metrics['invalidations'] += 1
+
+    def get_metrics(self) -> dict:
+        lookups = self.metrics['hits'] + self.metrics['misses']
+        metrics = dict(self.metrics)
+        metrics['size'] = len(self.entries)
+        metrics['hit_rate'] = (self.metrics['hits'] + self.metrics['coalesced']) / lookups if lookups else 0.0
+        return metrics
@@ -0,0 +1,81 @@
+# compare the resources utilisation and the requests wait time with and without all or nothing (gang) requests.
+# runs against a local redis server, the DB is flushed at the start of every run!
+# sudo docker run -p 6379:6379 --name new-redis -d redis
+# python scripts/bench_gang.py --redis_port 6379 --resources 6 --requests 40
+
+import argparse
+import asyncio
+import random
+import statistics
+import time
+
+from qrm_defs.resource_definition import Resource, ResourcesRequest, ACTIVE_STATUS
+from qrm_server.q_manager import QueueManagerBackEnd
+
+MAX_REQUEST_SIZE = 3
+HOLD_TIME = (0.05, 0.2)  # seconds, min and max time a filled request holds its resources
+ARRIVAL_TIME = 0.02  # seconds, mean time between requests
+
+
+async def build_db(qrm_be: QueueManagerBackEnd, resources_count: int) -> list:
+    await qrm_be.redis.redis.flushall()
+    resources = [Resource(name=f'bench_res_{i}', type='server', status=ACTIVE_STATUS)
+                 for i in range(resources_count)]
+    for resource in resources:
+        await qrm_be.redis.add_resource(resource)
+    return resources
+
+
+async def client(qrm_be: QueueManagerBackEnd, index: int, names: list, hold_time: float, gang: bool,
+                 results: list) -> None:
+    request = ResourcesRequest(token=f'bench_{index}', gang=gang)
+    request.add_request_by_names(names, count=len(names))
+    start = time.monotonic()
+    rrr = await qrm_be.new_request(request)
+    results.append({'wait': time.monotonic() - start, 'busy': hold_time * len(names)})
+    await asyncio.sleep(hold_time)
+    await qrm_be.cancel_request(rrr.token)
+
+
+async def run(redis_port: int, resources_count: int, requests_count: int, gang: bool, seed: int,
+              gang_hold_window: float) -> dict:
+    qrm_be = QueueManagerBackEnd(redis_port=redis_port, gang_hold_window=gang_hold_window)
+    resources = await build_db(qrm_be, resources_count)
+    rand = random.Random(seed)
+    results = []
+    tasks = []
+    start = time.monotonic()
+    for index in range(requests_count):
+        size = rand.randint(1, min(MAX_REQUEST_SIZE, resources_count))
+        names = [resource.name for resource in rand.sample(resources, size)]
+        tasks.append(asyncio.ensure_future(client(qrm_be, index, names, rand.uniform(*HOLD_TIME), gang, results)))
+        await asyncio.sleep(rand.expovariate(1 / ARRIVAL_TIME))
+    await asyncio.gather(*tasks)
+    makespan = time.monotonic() - start
+    await qrm_be.redis.redis.flushall()
+    await qrm_be.stop_backend()
+    waits = sorted(result['wait'] for result in results)
+    return {'utilisation': sum(result['busy'] for result in results) / (resources_count * makespan),
+            'mean_wait': statistics.mean(waits),
+            'p95_wait': waits[int(0.95 * (len(waits) - 1))],
+            'makespan': makespan}
+
+
+async def main(redis_port: int, resources_count: int, requests_count: int, seed: int,
+               gang_hold_window: float) -> None:
+    print(f'{"mode":>8} {"utilisation":>12} {"mean wait [s]":>14} {"p95 wait [s]":>13} {"makespan [s]":>13}')
+    for gang in [False, True]:
+        result = await run(redis_port, resources_count, requests_count, gang, seed, gang_hold_window)
+        print(f'{"gang" if gang else "partial":>8} {result["utilisation"]:>12.2f} {result["mean_wait"]:>14.3f} '
+              f'{result["p95_wait"]:>13.3f} {result["makespan"]:>13.2f}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='gang requests benchmark')
+    parser.add_argument('--redis_port', type=int, default=6379)
+    parser.add_argument('--resources', type=int, default=6)
+    parser.add_argument('--requests', type=int, default=40)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--gang_hold_window', type=float, default=0.1)
+    args = parser.parse_args()
+    asyncio.run(main(args.redis_port, args.resources, args.requests, args.seed, args.gang_hold_window))
@@ -0,0 +1,81 @@
+# measure the requests throughput of several qrm backend instances (processes) that share one redis server.
+# every instance runs clients that request resources from a shared pool, hold them and cancel them.
+# runs against a local redis server, the DB is flushed at the start of every run!
+# sudo docker run -p 6379:6379 --name new-redis -d redis
+# python scripts/bench_instances.py --redis_port 6379 --instances 1 2 4 --resources 32 --duration 10
+
+import argparse
+import asyncio
+import multiprocessing
+import random
+import time
+
+from qrm_defs.resource_definition import Resource, ResourcesRequest, ACTIVE_STATUS
+from qrm_server.q_manager import QueueManagerBackEnd
+
+CLIENTS_PER_INSTANCE = 16
+CANDIDATES = 4  # every request asks for one resource of this number of random candidates
+HOLD_TIME = 0.01  # seconds a filled request holds its resource
+
+
+async def build_db(redis_port: int, resources_count: int) -> None:
+    qrm_be = QueueManagerBackEnd(redis_port=redis_port)
+    await qrm_be.redis.redis.flushall()
+    for index in range(resources_count):
+        await qrm_be.redis.add_resource(Resource(name=f'bench_res_{index}', type='server', status=ACTIVE_STATUS))
+    await qrm_be.stop_backend()
+
+
+async def client(qrm_be: QueueManagerBackEnd, name: str, resources_count: int, end_time: float,
+                 rand: random.Random) -> int:
+    filled = 0
+    while time.monotonic() < end_time:
+        request = ResourcesRequest(token=f'{name}_{filled}')
+        names = [f'bench_res_{index}' for index in rand.sample(range(resources_count), CANDIDATES)]
+        request.add_request_by_names(names, count=1)
+        rrr = await qrm_be.new_request(request)
+        await asyncio.sleep(HOLD_TIME)
+        await qrm_be.cancel_request(rrr.token)
+        filled += 1
+    return filled
+
+
+async def instance(redis_port: int, instance_index: int, resources_count: int, duration: float) -> int:
+    qrm_be = QueueManagerBackEnd(redis_port=redis_port, instance_id=f'bench_{instance_index}')
+    await qrm_be.init_backend()
+    rand = random.Random(instance_index)
+    end_time = time.monotonic() + duration
+    filled = await asyncio.gather(*[client(qrm_be, f'bench_{instance_index}_{index}', resources_count, end_time,
+                                           rand) for index in range(CLIENTS_PER_INSTANCE)])
+    await qrm_be.stop_backend()
+    return sum(filled)
+
+
+def run_instance(args: tuple) -> int:
+    return asyncio.run(instance(*args))
+
+
+def run(redis_port: int, instances: int, resources_count: int, duration: float) -> float:
+    asyncio.run(build_db(redis_port, resources_count))
+    with multiprocessing.Pool(instances) as pool:
+        filled = pool.map(run_instance, [(redis_port, index, resources_count, duration) for index in range(instances)])
+    return sum(filled) / duration
+
+
+def main(redis_port: int, instances_counts: list, resources_count: int, duration: float) -> None:
+    print(f'{"instances":>10} {"requests/s":>11} {"speedup":>8}')
+    base = None
+    for instances in instances_counts:
+        throughput = run(redis_port, instances, resources_count, duration)
+        base = base or throughput
+        print(f'{instances:>10} {throughput:>11.1f} {throughput / base:>8.2f}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='qrm instances throughput benchmark')
+    parser.add_argument('--redis_port', type=int, default=6379)
+    parser.add_argument('--instances', type=int, nargs='+', default=[1, 2, 4])
+    parser.add_argument('--resources', type=int, default=32)
+    parser.add_argument('--duration', type=float, default=10)
+    args = parser.parse_args()
+    main(args.redis_port, args.instances, args.resources, args.duration)
@@ -0,0 +1,71 @@
+# measure the qrm backend restart time with many open requests.
+# the requests wait for resources that are held by other tokens, the recovery starts their workers
+# and every worker checks its resources once and waits.
+# runs against a local redis server, the DB is flushed at the start of every run!
+# sudo docker run -p 6379:6379 --name new-redis -d redis
+# python scripts/bench_recovery.py --redis_port 6379 --requests 20000 --resources 100 --concurrency 10 100 1000
+
+import argparse
+import asyncio
+import time
+
+from qrm_defs.resource_definition import Resource, ResourcesRequest, ACTIVE_STATUS
+from qrm_server.q_manager import QueueManagerBackEnd
+
+CANDIDATES = 2  # every request asks for one resource of this number of candidates
+
+
+async def build_db(redis_port: int, requests_count: int, resources_count: int) -> None:
+    qrm_be = QueueManagerBackEnd(redis_port=redis_port)
+    await qrm_be.redis.redis.flushall()
+    for index in range(resources_count):
+        resource = Resource(name=f'bench_res_{index}', type='server', status=ACTIVE_STATUS)
+        await qrm_be.redis.add_resource(resource)
+        await qrm_be.redis.add_job_to_resource(resource, {'token': f'bench_holder_{index}'})
+    for index in range(requests_count):
+        request = ResourcesRequest(token=f'bench_{index}')
+        request.add_request_by_names([f'bench_res_{(index + offset) % resources_count}'
+                                      for offset in range(CANDIDATES)], count=1)
+        await qrm_be.redis.add_resources_request(request)
+        await qrm_be.generate_jobs_from_names_request(request.token)
+    await qrm_be.stop_backend()
+
+
+async def restart(redis_port: int, concurrency: int) -> dict:
+    qrm_be = QueueManagerBackEnd(redis_port=redis_port, background_recovery=True, recovery_concurrency=concurrency)
+    start = time.monotonic()
+    await qrm_be.init_backend()
+    ready = time.monotonic() - start
+    # the server answers requests during the recovery, measure the status latency meanwhile
+    latencies = []
+    while not qrm_be.recovery_task.done():
+        request_start = time.monotonic()
+        await qrm_be.get_tokens_status(['bench_0'])
+        latencies.append(time.monotonic() - request_start)
+        await asyncio.sleep(0.05)
+    recovered = time.monotonic() - start
+    workers = qrm_be.get_metrics()['recovery']['workers']
+    for task in list(qrm_be.worker_tasks):
+        task.cancel()
+    await qrm_be.stop_backend()
+    return {'ready': ready, 'recovered': recovered, 'workers': workers,
+            'max_latency': max(latencies) if latencies else 0.0}
+
+
+async def main(redis_port: int, requests_count: int, resources_count: int, concurrency_values: list) -> None:
+    await build_db(redis_port, requests_count, resources_count)
+    print(f'{"concurrency":>12} {"workers":>8} {"ready [s]":>10} {"recovered [s]":>14} {"max status latency [s]":>23}')
+    for concurrency in concurrency_values:
+        result = await restart(redis_port, concurrency)
+        print(f'{concurrency:>12} {result["workers"]:>8} {result["ready"]:>10.3f} {result["recovered"]:>14.2f} '
+              f'{result["max_latency"]:>23.3f}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='qrm backend recovery benchmark')
+    parser.add_argument('--redis_port', type=int, default=6379)
+    parser.add_argument('--requests', type=int, default=20000)
+    parser.add_argument('--resources', type=int, default=100)
+    parser.add_argument('--concurrency', type=int, nargs='+', default=[10, 100, 1000])
+    args = parser.parse_args()
+    asyncio.run(main(args.redis_port, args.requests, args.resources, args.concurrency))
@@ -0,0 +1,74 @@
+# benchmark the token status computation as function of the number of resources in the DB.
+# runs against a local redis server, the DB is flushed at the start of every step!
+# sudo docker run -p 6379:6379 --name new-redis -d redis
+# python scripts/bench_token_status.py --redis_port 6379 --sizes 100 1000 10000
+
+import argparse
+import asyncio
+import time
+
+from qrm_defs.resource_definition import Resource, ResourcesRequestResponse
+from qrm_server.q_manager import QueueManagerBackEnd
+
+TOKEN = 'bench_token'
+TOKEN_RESOURCES = 4
+REPEATS = 20
+
+
+async def legacy_get_resource_req_resp(qrm_be: QueueManagerBackEnd, token: str) -> ResourcesRequestResponse:
+    # the implementation before the resource -> token map, reads all the resources for every token resource
+    rrr = await qrm_be.redis.get_req_resp_for_token(token)
+    for resource_name in rrr.names:
+        resource = await qrm_be.redis.get_resource_by_name(resource_name)
+        res_job = await qrm_be.redis.get_active_job(resource)
+        all_resources_dict = await qrm_be.redis.get_all_resources_dict()
+        resources_token_list = await qrm_be.redis.get_token_resources(token)
+        if qrm_be.is_token_valid(token=token,
+                                 resources_dict=all_resources_dict,
+                                 original_resources_token_list=resources_token_list):
+            rrr.is_valid = True
+        if res_job.get('token') != token:
+            rrr.is_token_active_in_queue = False
+            return rrr
+    rrr.is_token_active_in_queue = True
+    return rrr
+
+
+async def build_db(qrm_be: QueueManagerBackEnd, size: int) -> None:
+    await qrm_be.redis.redis.flushall()
+    resources = [Resource(name=f'bench_res_{i}', type='server') for i in range(size)]
+    for resource in resources:
+        await qrm_be.redis.add_resource(resource)
+    token_resources = resources[:TOKEN_RESOURCES]
+    for resource in token_resources:
+        await qrm_be.redis.add_job_to_resource(resource, {'token': TOKEN})
+    await qrm_be.redis.generate_token(TOKEN, token_resources)
+    await qrm_be.redis.set_req_resp(ResourcesRequestResponse(names=[res.name for res in token_resources],
+                                                             token=TOKEN))
+
+
+async def time_it(func, qrm_be: QueueManagerBackEnd) -> float:
+    start = time.perf_counter()
+    for _ in range(REPEATS):
+        await func(qrm_be, TOKEN)
+    return (time.perf_counter() - start) / REPEATS * 1000
+
+
+async def main(redis_port: int, sizes: list) -> None:
+    qrm_be = QueueManagerBackEnd(redis_port=redis_port)
+    print(f'{"resources":>10} {"legacy [ms]":>12} {"current [ms]":>13}')
+    for size in sizes:
+        await build_db(qrm_be, size)
+        legacy_ms = await time_it(legacy_get_resource_req_resp, qrm_be)
+        current_ms = await time_it(QueueManagerBackEnd.get_resource_req_resp, qrm_be)
+        print(f'{size:>10} {legacy_ms:>12.2f} {current_ms:>13.2f}')
+    await qrm_be.redis.redis.flushall()
+    await qrm_be.stop_backend()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='token status benchmark')
+    parser.add_argument('--redis_port', type=int, default=6379)
+    parser.add_argument('--sizes', type=int, nargs='+', default=[100, 1000, 10000])
+    args = parser.parse_args()
+    asyncio.run(main(args.redis_port, args.sizes))
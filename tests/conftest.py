@@ -19,6 +19,7 @@ from pytest_httpserver import HTTPServer
 from qrm_client.qrm_http_client import QrmClient, ManagementClient
 from werkzeug.wrappers import Request, Response
 from multiprocessing import Process
+from typing import List, Dict
 
 
 TEST_TOKEN = 'token1234'
@@ -57,6 +58,8 @@ def json_to_dict(json_str: str or dict) -> dict:
 class QueueManagerBackEndMock(QrmIfc):
     for_test_is_request_active: bool = False
     get_filled_request_obj: ResourcesRequestResponse = ResourcesRequestResponse()
+    for_test_token_revision: int = 0
+    for_test_is_standby: bool = False
 
     async def cancel_request(self, token: str) -> None:
         print('#######  using cancel_request in QueueManagerBackEndMock ####### ')
@@ -76,6 +79,30 @@ class QueueManagerBackEndMock(QrmIfc):
     async def get_resource_req_resp(self, token: str) -> ResourcesRequestResponse:
         return self.get_filled_request_obj
 
+    async def get_tokens_status(self, tokens: List[str]) -> Dict[str, ResourcesRequestResponse]:
+        tokens_status = {}
+        for token in tokens:
+            rrr_obj = ResourcesRequestResponse.from_json(self.get_filled_request_obj.to_json())
+            rrr_obj.token = token
+            rrr_obj.request_complete = not self.for_test_is_request_active
+            tokens_status[token] = rrr_obj
+        return tokens_status
+
+    async def get_token_revision(self, token: str) -> int:
+        return self.for_test_token_revision
+
+    async def touch_token(self, token: str) -> None:
+        pass
+
+    def get_metrics(self) -> dict:
+        return {}
+
+    def is_standby(self) -> bool:
+        return self.for_test_is_standby
+
+    def add_token_change_callback(self, callback) -> None:
+        pass
+
     async def init_backend(self) -> None:
         pass
 
@@ -114,6 +141,8 @@ def qrm_server_mock_for_client(httpserver: HTTPServer, default_test_token: str)
         f'{qrm_defs.qrm_urls.URL_POST_CANCEL_TOKEN}').respond_with_data(qrm_http_server.canceled_token_msg(TEST_TOKEN))
     httpserver.expect_request(qrm_defs.qrm_urls.URL_POST_NEW_REQUEST).respond_with_handler(new_request_handler)
     httpserver.expect_request(qrm_defs.qrm_urls.URL_GET_TOKEN_STATUS).respond_with_json(rrr_json)
+    httpserver.expect_request(qrm_defs.qrm_urls.URL_POST_TOKENS_STATUS).respond_with_json(
+        {default_test_token: rrr_obj.to_dict()})
     httpserver.expect_request(qrm_defs.qrm_urls.URL_GET_IS_SERVER_UP).respond_with_json({'status': True})
     return httpserver
 
@@ -236,6 +265,7 @@ def post_to_mgmt_server(event_loop, aiohttp_client):
     app.router.add_post(qrm_defs.qrm_urls.SET_RESOURCE_STATUS, management_server.set_resource_status)
     app.router.add_post(qrm_defs.qrm_urls.ADD_TAG_TO_RESOURCE, management_server.add_tag_to_resource)
     app.router.add_post(qrm_defs.qrm_urls.REMOVE_TAG_FROM_RESOURCE, management_server.remove_tag_from_resource)
+    app.router.add_post(qrm_defs.qrm_urls.SET_OWNER_SHARE, management_server.set_owner_share)
     app.on_shutdown.append(management_server.close_redis)
     yield event_loop.run_until_complete(aiohttp_client(app))
 
@@ -247,6 +277,8 @@ def post_to_http_server(event_loop, aiohttp_client):
     app.router.add_post(qrm_defs.qrm_urls.URL_POST_NEW_REQUEST, qrm_http_server.new_request)
     app.router.add_post(qrm_defs.qrm_urls.URL_POST_CANCEL_TOKEN, qrm_http_server.cancel_token)
     app.router.add_get(qrm_defs.qrm_urls.URL_GET_TOKEN_STATUS, qrm_http_server.get_token_status)
+    app.router.add_post(qrm_defs.qrm_urls.URL_POST_TOKENS_STATUS, qrm_http_server.get_tokens_status)
+    app.router.add_get(qrm_defs.qrm_urls.URL_GET_METRICS, qrm_http_server.metrics)
     yield event_loop.run_until_complete(aiohttp_client(app))
 
 
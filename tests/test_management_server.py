@@ -5,7 +5,7 @@ import pytest
 import qrm_defs.qrm_urls
 
 from qrm_defs.resource_definition import Resource
-from qrm_server.management_server import LAST_UPDATE_TIME, AUTO_MANAGED_TOKENS
+from qrm_server.management_server import LAST_UPDATE_TIME, AUTO_MANAGED_TOKENS, OWNERS_USAGE
 
 
 async def test_add_resource(post_to_mgmt_server, redis_db_object, resource_dict_1):
@@ -286,3 +286,15 @@ async def test_get_all_managed_tokens(redis_db_object, post_to_mgmt_server):
     resp = await post_to_mgmt_server.get(qrm_defs.qrm_urls.MGMT_STATUS_API)
     qrm_status_dict = await resp.json()
     assert token1 and token2 in qrm_status_dict[AUTO_MANAGED_TOKENS]
+
+
+async def test_set_owner_share(redis_db_object, post_to_mgmt_server):
+    resp = await post_to_mgmt_server.post(qrm_defs.qrm_urls.SET_OWNER_SHARE,
+                                          data=json.dumps({'owner': 'team_a', 'weight': 2, 'max_held': 3}))
+    assert resp.status == 200
+    resp = await post_to_mgmt_server.post(qrm_defs.qrm_urls.SET_OWNER_SHARE,
+                                          data=json.dumps({'owner': 'team_a', 'weight': 0}))
+    assert resp.status == 400
+    resp = await post_to_mgmt_server.get(qrm_defs.qrm_urls.MGMT_STATUS_API)
+    qrm_status_dict = await resp.json()
+    assert qrm_status_dict[OWNERS_USAGE]['team_a'] == {'usage': 0, 'held': 0, 'weight': 2, 'max_held': 3}
@@ -1,12 +1,14 @@
 import asyncio
 import logging
+import multiprocessing
 import pytest
+import random
 import time
 
 from qrm_defs.resource_definition import Resource, ResourcesRequest, ResourcesRequestResponse, ResourcesByName, \
-    PENDING_STATUS, ACTIVE_STATUS, DISABLED_STATUS, ResourcesByTags
-from qrm_server.q_manager import QueueManagerBackEnd
-from db_adapters.redis_adapter import RedisDB
+    PENDING_STATUS, ACTIVE_STATUS, DISABLED_STATUS, ResourcesByTags, TOKEN_FILLED
+from qrm_server.q_manager import QueueManagerBackEnd, CANCELED
+from db_adapters.redis_adapter import RedisDB, HOLD_TIME
 from typing import List
 
 
@@ -575,6 +577,33 @@ async def test_recovery_jobs_in_queue(redis_db_object, qrm_backend_with_db):
     assert res_1.name and res_2.name in result.names
 
 
+@pytest.mark.asyncio
+async def test_recovery_cancelled_token(redis_db_object, qrm_backend_with_db):
+    job1 = {'token': 'job_1_token'}
+    res_1 = Resource(name='res1', type='type1', status=ACTIVE_STATUS)
+    await redis_db_object.add_resource(res_1)
+    await redis_db_object.add_job_to_resource(res_1, {'token': 'other_token'})
+    await qrm_backend_with_db.init_event_for_token('other_token')
+
+    user_request = ResourcesRequest()
+    user_request.add_request_by_token(job1["token"])
+    user_request.add_request_by_names([res_1.name], count=1)
+    task = asyncio.ensure_future(qrm_backend_with_db.new_request(user_request))
+    new_token_job_1 = await qrm_backend_with_db.get_new_token(job1['token'])
+    await qrm_backend_with_db.cancel_request(new_token_job_1)
+    await cancel_all_open_tasks([task])
+
+    # remove the old QrmBackend and init a new instance:
+    await qrm_backend_with_db.stop_backend()
+    new_qrm = QueueManagerBackEnd()
+    await new_qrm.init_backend()
+
+    # the token state record keeps the token cancelled after recovery:
+    assert new_qrm.tokens_change_event[new_token_job_1].reason == CANCELED
+    assert not await new_qrm.is_request_active(new_token_job_1)
+    await new_qrm.stop_backend()
+
+
 @pytest.mark.asyncio
 async def test_cancel_move_pending_status(redis_db_object, qrm_backend_with_db):
     # use the pending logic:
@@ -1215,7 +1244,8 @@ async def test_managed_token_last_update_time(redis_db_object, qrm_backend_with_
 
     await asyncio.sleep(1.01)  # this sleep is bc out time resolution is 1 second
     await qrm_backend_with_db.is_request_active(new_token)
-    # after is_request_active called, the update_time must be changed:
+    # after is_request_active called and the last_seen flushed, the update_time must be changed:
+    await qrm_backend_with_db.flush_last_seen()
     token_last_update_dict = await redis_db_object.get_all_tokens_last_update()
     new_update_time = token_last_update_dict[new_token]
     assert new_update_time != old_update_time
@@ -1223,10 +1253,50 @@ async def test_managed_token_last_update_time(redis_db_object, qrm_backend_with_
     await asyncio.sleep(1.01)  # this sleep is bc out time resolution is 1 second
     await qrm_backend_with_db.is_request_active(new_token)
 
+    await qrm_backend_with_db.flush_last_seen()
     token_last_update_dict = await redis_db_object.get_all_tokens_last_update()
     assert new_update_time != token_last_update_dict[new_token]
 
 
+async def test_last_seen_writes_are_batched(redis_db_object, qrm_backend_with_db):
+    job1 = {'token': 'job_1_token'}
+    res_1 = Resource(name='res1', type='type1', status=ACTIVE_STATUS, tags=['server'])
+    await redis_db_object.add_resource(res_1)
+    user_request = ResourcesRequest(auto_managed=True)
+    user_request.add_request_by_token(job1["token"])
+    user_request.add_request_by_tags(['server'], count=1)
+    await qrm_backend_with_db.new_request(user_request)
+    new_token = await qrm_backend_with_db.get_new_token(job1['token'])
+    old_update_time = (await redis_db_object.get_all_tokens_last_update())[new_token]
+
+    await asyncio.sleep(1.01)  # this sleep is bc out time resolution is 1 second
+    for _ in range(10):
+        await qrm_backend_with_db.is_request_active(new_token)
+    # not written yet, only after the flush interval:
+    assert (await redis_db_object.get_all_tokens_last_update())[new_token] == old_update_time
+    await asyncio.sleep(qrm_backend_with_db.last_seen_flush_interval + 0.5)
+    assert (await redis_db_object.get_all_tokens_last_update())[new_token] != old_update_time
+    last_seen_metrics = qrm_backend_with_db.get_metrics()['last_seen']
+    assert last_seen_metrics['updates'] == 10
+    assert last_seen_metrics['written'] == 1
+    assert last_seen_metrics['writes_saved'] == 9
+
+
+async def test_cancel_drops_pending_last_seen(redis_db_object, qrm_backend_with_db):
+    job1 = {'token': 'job_1_token'}
+    res_1 = Resource(name='res1', type='type1', status=ACTIVE_STATUS, tags=['server'])
+    await redis_db_object.add_resource(res_1)
+    user_request = ResourcesRequest(auto_managed=True)
+    user_request.add_request_by_token(job1["token"])
+    user_request.add_request_by_tags(['server'], count=1)
+    await qrm_backend_with_db.new_request(user_request)
+    new_token = await qrm_backend_with_db.get_new_token(job1['token'])
+    await qrm_backend_with_db.is_request_active(new_token)
+    await qrm_backend_with_db.cancel_request(new_token)
+    await qrm_backend_with_db.flush_last_seen()
+    assert new_token not in await redis_db_object.get_all_tokens_last_update()
+
+
 async def test_cancel_request_remove_token_last_update_and_managed(redis_db_object, qrm_backend_with_db):
     job1 = {'token': 'job_1_token'}
     res_1 = Resource(name='res1', type='type1', status=ACTIVE_STATUS, tags=['server'])
@@ -1425,3 +1495,432 @@ async def test_get_response_by_request_backward_compatible_order(redis_db_object
     await fut2
     resp2 = await qrm_backend_with_db.get_resource_req_resp(token_2_new)
     assert 'res1' and 'res2' and 'res3' in resp2.names
+
+
+async def test_get_tokens_status_same_as_single_token_status(redis_db_object, qrm_backend_with_db):
+    res_1 = Resource(name='res1', type='type1', status=ACTIVE_STATUS)
+    res_2 = Resource(name='res2', type='type1', status=ACTIVE_STATUS)
+    await redis_db_object.add_resource(res_1)
+    await redis_db_object.add_resource(res_2)
+    user_request = ResourcesRequest()
+    user_request.add_request_by_token('job_1_token')
+    user_request.add_request_by_names([res_1.name], count=1)
+    await qrm_backend_with_db.new_request(user_request)
+    user_request = ResourcesRequest()
+    user_request.add_request_by_token('job_2_token')
+    user_request.add_request_by_names([res_1.name, res_2.name], count=2)
+    waiting_request = asyncio.ensure_future(qrm_backend_with_db.new_request(user_request))
+    filled_token = await qrm_backend_with_db.get_new_token('job_1_token')
+    waiting_token = await qrm_backend_with_db.get_new_token('job_2_token')
+    await asyncio.sleep(0.1)
+
+    tokens_status = await qrm_backend_with_db.get_tokens_status([filled_token, waiting_token, 'unknown_token'])
+
+    for token in [filled_token, waiting_token, 'unknown_token']:
+        is_active = await qrm_backend_with_db.is_request_active(token)
+        expected_rrr = await qrm_backend_with_db.get_resource_req_resp(token)
+        expected_rrr.request_complete = not is_active
+        assert tokens_status[token] == expected_rrr
+    assert tokens_status[filled_token].request_complete
+    assert tokens_status[filled_token].names == [res_1.name]
+    assert not tokens_status[waiting_token].request_complete
+    assert tokens_status[waiting_token].names == [res_2.name]
+    assert not tokens_status['unknown_token'].is_valid
+    assert waiting_token in await redis_db_object.get_all_tokens_last_update()
+    await cancel_all_open_tasks([waiting_request])
+
+
+async def test_token_revision_changes_on_cancel(redis_db_object, qrm_backend_with_db):
+    res_1 = Resource(name='res1', type='type1', status=ACTIVE_STATUS)
+    await redis_db_object.add_resource(res_1)
+    user_request = ResourcesRequest()
+    user_request.add_request_by_token('job_1_token')
+    user_request.add_request_by_names([res_1.name], count=1)
+    await qrm_backend_with_db.new_request(user_request)
+    token = await qrm_backend_with_db.get_new_token('job_1_token')
+    revision = await qrm_backend_with_db.get_token_revision(token)
+    assert revision == await qrm_backend_with_db.get_token_revision(token)
+    await qrm_backend_with_db.cancel_request(token)
+    assert await qrm_backend_with_db.get_token_revision(token) > revision
+
+
+async def test_high_priority_request_passes_waiting_requests(redis_db_object, qrm_backend_with_db):
+    res_1 = Resource(name='res1', type='type1', status=ACTIVE_STATUS)
+    await redis_db_object.add_resource(res_1)
+    low_request = ResourcesRequest(token='low_token')
+    low_request.add_request_by_names([res_1.name], count=1)
+    low_task = asyncio.ensure_future(qrm_backend_with_db.new_request(low_request))
+    low_token = await qrm_backend_with_db.get_new_token('low_token')
+    await low_task  # low request is the active job
+    low_2_request = ResourcesRequest(token='low_2_token')
+    low_2_request.add_request_by_names([res_1.name], count=1)
+    low_2_task = asyncio.ensure_future(qrm_backend_with_db.new_request(low_2_request))
+    low_2_token = await qrm_backend_with_db.get_new_token('low_2_token')
+    high_request = ResourcesRequest(token='high_token', priority=10)
+    high_request.add_request_by_names([res_1.name], count=1)
+    high_task = asyncio.ensure_future(qrm_backend_with_db.new_request(high_request))
+    high_token = await qrm_backend_with_db.get_new_token('high_token')
+    await asyncio.sleep(0.1)
+
+    jobs_tokens = [job.get('token') for job in await redis_db_object.get_resource_jobs(res_1)]
+    assert jobs_tokens == [low_2_token, high_token, low_token, None]
+
+    await qrm_backend_with_db.cancel_request(low_token)
+    assert (await asyncio.wait_for(high_task, timeout=1)).names == [res_1.name]
+    assert await qrm_backend_with_db.is_request_active(low_2_token)
+    await qrm_backend_with_db.cancel_request(low_2_token)
+    await asyncio.wait_for(low_2_task, timeout=1)
+
+
+async def test_fair_share_request_passes_heavy_owner(redis_db_object, qrm_backend_with_db):
+    qrm_backend_with_db.redis.use_fair_share = True
+    res_1 = Resource(name='res1', type='type1', status=ACTIVE_STATUS)
+    res_2 = Resource(name='res2', type='type1', status=ACTIVE_STATUS)
+    await redis_db_object.add_resource(res_1)
+    await redis_db_object.add_resource(res_2)
+    # heavy owner holds res2 and is the active job of res1
+    tasks = {}
+    for seed, owner, resource in [('heavy_hold', 'heavy', res_2), ('heavy_1', 'heavy', res_1),
+                                  ('heavy_2', 'heavy', res_1), ('light', 'light', res_1)]:
+        request = ResourcesRequest(token=seed, owner=owner)
+        request.add_request_by_names([resource.name], count=1)
+        tasks[seed] = asyncio.ensure_future(qrm_backend_with_db.new_request(request))
+        await asyncio.sleep(0.1)
+    heavy_1_token = await qrm_backend_with_db.get_new_token('heavy_1')
+    light_token = await qrm_backend_with_db.get_new_token('light')
+    owners_usage = await redis_db_object.get_owners_usage()
+    assert owners_usage['heavy']['held'] == 2
+
+    await qrm_backend_with_db.cancel_request(heavy_1_token)
+    assert (await asyncio.wait_for(tasks['light'], timeout=1)).names == [res_1.name]
+    assert (await redis_db_object.get_owners_usage())['light']['held'] == 1
+    assert not tasks['heavy_2'].done()
+    await qrm_backend_with_db.cancel_request(await qrm_backend_with_db.get_new_token('heavy_2'))
+    await asyncio.wait_for(tasks['heavy_2'], timeout=1)
+
+
+async def test_concurrent_multi_resource_requests_dont_deadlock(redis_db_object, qrm_backend_with_db):
+    # every request needs all its resources, with jobs added one queue at a time two requests could be
+    # active each in one queue of the other and wait forever
+    resources = [Resource(name=f'res{i}', type='type1', status=ACTIVE_STATUS) for i in range(4)]
+    for resource in resources:
+        await redis_db_object.add_resource(resource)
+    rand = random.Random(1234)
+
+    async def client(index: int) -> None:
+        names = [resource.name for resource in rand.sample(resources, rand.randint(1, 4))]
+        request = ResourcesRequest(token=f'stress_{index}', priority=rand.randint(0, 2))
+        request.add_request_by_names(names, count=len(names))
+        rrr = await qrm_backend_with_db.new_request(request)
+        assert sorted(rrr.names) == sorted(names)
+        await asyncio.sleep(rand.random() * 0.01)
+        await qrm_backend_with_db.cancel_request(rrr.token)
+
+    await asyncio.wait_for(asyncio.gather(*[client(index) for index in range(30)]), timeout=4)
+    for resource in resources:
+        assert await redis_db_object.get_resource_jobs(resource) == [{}]
+
+
+async def test_gang_request_grants_all_resources_at_once(redis_db_object, qrm_backend_with_db):
+    res_1 = Resource(name='res1', type='type1', status=ACTIVE_STATUS)
+    res_2 = Resource(name='res2', type='type1', status=ACTIVE_STATUS)
+    await redis_db_object.add_resource(res_1)
+    await redis_db_object.add_resource(res_2)
+    holder_request = ResourcesRequest(token='holder')
+    holder_request.add_request_by_names([res_2.name], count=1)
+    holder_rrr = await qrm_backend_with_db.new_request(holder_request)
+
+    gang_request = ResourcesRequest(token='gang', gang=True)
+    gang_request.add_request_by_names([res_1.name], count=1)
+    gang_request.add_request_by_names([res_2.name], count=1)
+    gang_task = asyncio.ensure_future(qrm_backend_with_db.new_request(gang_request))
+    gang_token = await qrm_backend_with_db.get_new_token('gang')
+    await asyncio.sleep(0.1)
+    # the gang job is the active job of res1, but res1 is not granted while res2 is busy
+    assert (await redis_db_object.get_active_job(res_1))['token'] == gang_token
+    assert (await redis_db_object.get_partial_fill(gang_token)).names == []
+    assert not gang_task.done()
+
+    await qrm_backend_with_db.cancel_request(holder_rrr.token)
+    assert sorted((await asyncio.wait_for(gang_task, timeout=1)).names) == [res_1.name, res_2.name]
+
+
+async def test_gang_request_lets_next_jobs_go_after_window(redis_db_object, qrm_backend_with_db):
+    qrm_backend_with_db.gang_hold_window = 0.2
+    res_1 = Resource(name='res1', type='type1', status=ACTIVE_STATUS)
+    res_2 = Resource(name='res2', type='type1', status=ACTIVE_STATUS)
+    await redis_db_object.add_resource(res_1)
+    await redis_db_object.add_resource(res_2)
+    holder_request = ResourcesRequest(token='holder')
+    holder_request.add_request_by_names([res_2.name], count=1)
+    holder_rrr = await qrm_backend_with_db.new_request(holder_request)
+    gang_request = ResourcesRequest(token='gang', gang=True)
+    gang_request.add_request_by_names([res_1.name, res_2.name], count=2)
+    gang_task = asyncio.ensure_future(qrm_backend_with_db.new_request(gang_request))
+    await asyncio.sleep(0.05)
+    small_request = ResourcesRequest(token='small')
+    small_request.add_request_by_names([res_1.name], count=1)
+    small_task = asyncio.ensure_future(qrm_backend_with_db.new_request(small_request))
+
+    # res1 is not held by the gang request after the window, so the small request gets it
+    small_rrr = await asyncio.wait_for(small_task, timeout=1)
+    assert small_rrr.names == [res_1.name]
+    assert not gang_task.done()
+
+    await qrm_backend_with_db.cancel_request(small_rrr.token)
+    await qrm_backend_with_db.cancel_request(holder_rrr.token)
+    assert sorted((await asyncio.wait_for(gang_task, timeout=1)).names) == [res_1.name, res_2.name]
+
+
+async def test_backfill_request_before_waiting_gang_request(redis_db_object, qrm_backend_with_db):
+    qrm_backend_with_db.use_backfill = True
+    res_1 = Resource(name='res1', type='type1', status=ACTIVE_STATUS)
+    res_2 = Resource(name='res2', type='type1', status=ACTIVE_STATUS)
+    await redis_db_object.add_resource(res_1)
+    await redis_db_object.add_resource(res_2)
+    await redis_db_object.redis.hset(HOLD_TIME, mapping={'long': 100, 'short': 1, 'longer': 1000})
+    holder_request = ResourcesRequest(token='holder', owner='long')
+    holder_request.add_request_by_names([res_2.name], count=1)
+    holder_rrr = await qrm_backend_with_db.new_request(holder_request)
+    gang_request = ResourcesRequest(token='gang', gang=True)
+    gang_request.add_request_by_names([res_1.name, res_2.name], count=2)
+    gang_task = asyncio.ensure_future(qrm_backend_with_db.new_request(gang_request))
+    gang_token = await qrm_backend_with_db.get_new_token('gang')
+    await asyncio.sleep(0.05)
+
+    # res2 is expected to be busy for 100 seconds, a request that usually ends in 1000 seconds can't use res1
+    long_request = ResourcesRequest(token='longer', owner='longer')
+    long_request.add_request_by_names([res_1.name], count=1)
+    long_task = asyncio.ensure_future(qrm_backend_with_db.new_request(long_request))
+    short_request = ResourcesRequest(token='short', owner='short')
+    short_request.add_request_by_names([res_1.name], count=1)
+    short_task = asyncio.ensure_future(qrm_backend_with_db.new_request(short_request))
+    short_rrr = await asyncio.wait_for(short_task, timeout=1)
+    assert short_rrr.names == [res_1.name]
+    assert not long_task.done()
+
+    await qrm_backend_with_db.cancel_request(short_rrr.token)
+    await qrm_backend_with_db.cancel_request(holder_rrr.token)
+    assert sorted((await asyncio.wait_for(gang_task, timeout=1)).names) == [res_1.name, res_2.name]
+    await qrm_backend_with_db.cancel_request(gang_token)
+    assert (await asyncio.wait_for(long_task, timeout=1)).names == [res_1.name]
+
+
+async def test_pool_request_waits_once_in_pool_queue(redis_db_object, qrm_backend_with_db):
+    qrm_backend_with_db.pool_min_names = 4
+    resources = [Resource(name=f'res{i}', type='type1', status=ACTIVE_STATUS) for i in range(5)]
+    holders = []
+    for resource in resources:
+        await redis_db_object.add_resource(resource)
+        holder_request = ResourcesRequest(token=f'holder_{resource.name}')
+        holder_request.add_request_by_names([resource.name], count=1)
+        holders.append((await qrm_backend_with_db.new_request(holder_request)).token)
+
+    pool_request = ResourcesRequest(token='pool')
+    pool_request.add_request_by_names([resource.name for resource in resources], count=2)
+    pool_task = asyncio.ensure_future(qrm_backend_with_db.new_request(pool_request))
+    pool_token = await qrm_backend_with_db.get_new_token('pool')
+    await asyncio.sleep(0.1)
+    pool_id = RedisDB.pool_id([resource.name for resource in resources])
+    assert await redis_db_object.get_pool_queue(pool_id) == [pool_token]
+    for resource in resources:
+        assert len(await redis_db_object.get_resource_jobs(resource)) == 2
+
+    # every released resource is handed to the request, the other queues are not touched
+    await qrm_backend_with_db.cancel_request(holders[3])
+    await asyncio.sleep(0.1)
+    assert (await redis_db_object.get_partial_fill(pool_token)).names == [resources[3].name]
+    await qrm_backend_with_db.cancel_request(holders[1])
+    rrr = await asyncio.wait_for(pool_task, timeout=1)
+    assert rrr.names == [resources[3].name, resources[1].name]
+    assert await redis_db_object.get_pool_queue(pool_id) == []
+    for index in [0, 2, 4]:
+        assert [job.get('token') for job in await redis_db_object.get_resource_jobs(resources[index])] == \
+               [holders[index], None]
+
+
+async def test_canceled_pool_request_leaves_pool(redis_db_object, qrm_backend_with_db):
+    qrm_backend_with_db.pool_min_names = 2
+    res_1 = Resource(name='res1', type='type1', status=ACTIVE_STATUS)
+    res_2 = Resource(name='res2', type='type1', status=ACTIVE_STATUS)
+    await redis_db_object.add_resource(res_1)
+    await redis_db_object.add_resource(res_2)
+    holder_request = ResourcesRequest(token='holder')
+    holder_request.add_request_by_names([res_1.name, res_2.name], count=2)
+    holder_rrr = await qrm_backend_with_db.new_request(holder_request)
+    pool_request = ResourcesRequest(token='pool')
+    pool_request.add_request_by_names([res_1.name, res_2.name], count=1)
+    pool_task = asyncio.ensure_future(qrm_backend_with_db.new_request(pool_request))
+    pool_token = await qrm_backend_with_db.get_new_token('pool')
+    await asyncio.sleep(0.1)
+
+    await qrm_backend_with_db.cancel_request(pool_token)
+    assert (await asyncio.wait_for(pool_task, timeout=1)).names == []
+    await qrm_backend_with_db.cancel_request(holder_rrr.token)
+    assert await redis_db_object.get_resource_jobs(res_1) == [{}]
+    assert await redis_db_object.get_resource_jobs(res_2) == [{}]
+
+
+async def test_worker_rechecks_only_changed_resources(redis_db_object, qrm_backend_with_db):
+    qrm_backend_with_db.pool_min_names = 0
+    resources = [Resource(name=f'res{i}', type='type1', status=ACTIVE_STATUS) for i in range(5)]
+    holders = []
+    for resource in resources:
+        await redis_db_object.add_resource(resource)
+        holder_request = ResourcesRequest(token=f'holder_{resource.name}')
+        holder_request.add_request_by_names([resource.name], count=1)
+        holders.append((await qrm_backend_with_db.new_request(holder_request)).token)
+    user_request = ResourcesRequest(token='waiting')
+    user_request.add_request_by_names([resource.name for resource in resources], count=1)
+    task = asyncio.ensure_future(qrm_backend_with_db.new_request(user_request))
+    await asyncio.sleep(0.1)
+    checked = qrm_backend_with_db.get_metrics()['workers']['checked']
+
+    await qrm_backend_with_db.cancel_request(holders[2])
+    assert (await asyncio.wait_for(task, timeout=1)).names == [resources[2].name]
+    assert qrm_backend_with_db.get_metrics()['workers']['checked'] == checked + 1
+
+
+async def test_worker_full_recheck_finds_missed_change(redis_db_object, qrm_backend_with_db):
+    qrm_backend_with_db.full_recheck_interval = 0.2
+    res_1 = Resource(name='res1', type='type1', status=ACTIVE_STATUS)
+    await redis_db_object.add_resource(res_1)
+    holder_request = ResourcesRequest(token='holder')
+    holder_request.add_request_by_names([res_1.name], count=1)
+    holder_rrr = await qrm_backend_with_db.new_request(holder_request)
+    user_request = ResourcesRequest(token='waiting')
+    user_request.add_request_by_names([res_1.name], count=1)
+    task = asyncio.ensure_future(qrm_backend_with_db.new_request(user_request))
+    await asyncio.sleep(0.1)
+
+    # the holder job is removed without signaling the waiting worker
+    await redis_db_object.remove_job(holder_rrr.token, [res_1])
+    assert (await asyncio.wait_for(task, timeout=1)).names == [res_1.name]
+
+
+async def test_instances_share_db(redis_db_object):
+    instance_a = QueueManagerBackEnd(instance_id='a')
+    instance_b = QueueManagerBackEnd(instance_id='b')
+    try:
+        res_1 = Resource(name='res1', type='type1', status=ACTIVE_STATUS)
+        await redis_db_object.add_resource(res_1)
+        holder_request = ResourcesRequest(token='holder')
+        holder_request.add_request_by_names([res_1.name], count=1)
+        holder_rrr = await instance_b.new_request(holder_request)
+        user_request = ResourcesRequest(token='waiting')
+        user_request.add_request_by_names([res_1.name], count=1)
+        task = asyncio.ensure_future(instance_a.new_request(user_request))
+        token = await instance_b.get_new_token('waiting')
+        await asyncio.sleep(0.1)
+        assert await instance_b.is_request_active(token)
+
+        # the holder is canceled by the other instance, the waiting worker is woken up by the published event
+        await instance_b.cancel_request(holder_rrr.token)
+        assert (await asyncio.wait_for(task, timeout=1)).names == [res_1.name]
+        assert not await instance_b.is_request_active(token)
+    finally:
+        await instance_a.stop_backend()
+        await instance_b.stop_backend()
+
+
+async def test_restarted_instance_starts_only_its_workers(redis_db_object):
+    res_1 = Resource(name='res1', type='type1', status=ACTIVE_STATUS)
+    await redis_db_object.add_resource(res_1)
+    for token, instance_id in [('token_a', 'a'), ('token_b', 'b')]:
+        user_request = ResourcesRequest(token=token)
+        user_request.add_request_by_names([res_1.name], count=1)
+        await redis_db_object.add_resources_request(user_request)
+        await redis_db_object.set_token_instance(token, instance_id)
+    instance_a = QueueManagerBackEnd(instance_id='a')
+    try:
+        workers = []
+
+        async def names_worker(token: str) -> None:
+            workers.append(token)
+            instance_a.worker_started(token)
+
+        instance_a.names_worker = names_worker
+        await instance_a.init_backend()
+        await asyncio.sleep(0.05)
+        assert workers == ['token_a']
+    finally:
+        await instance_a.stop_backend()
+
+
+async def run_leader(lease_time: float) -> None:
+    leader = QueueManagerBackEnd(instance_id='leader', ha_lease_time=lease_time)
+    await leader.init_backend()
+    user_request = ResourcesRequest(token='waiting')
+    user_request.add_request_by_names(['res1'], count=1)
+    await leader.new_request(user_request)
+
+
+def leader_process(lease_time: float) -> None:
+    asyncio.run(run_leader(lease_time))
+
+
+@pytest.mark.timeout(15)
+async def test_standby_takes_over_waiting_requests(redis_db_object):
+    lease_time = 0.5
+    res_1 = Resource(name='res1', type='type1', status=ACTIVE_STATUS)
+    await redis_db_object.add_resource(res_1)
+    await redis_db_object.add_job_to_resource(res_1, {'token': 'holder'})
+    leader = multiprocessing.Process(target=leader_process, args=(lease_time,))
+    leader.start()
+    standby = QueueManagerBackEnd(instance_id='standby', ha_lease_time=lease_time)
+    try:
+        token = await standby.get_new_token('waiting')
+        while not (await redis_db_object.get_open_requests()).get(token):
+            await asyncio.sleep(0.01)
+        await standby.init_backend()
+        assert standby.is_standby()
+
+        # the leader process dies with the waiting worker, the holder job is removed while there's no leader
+        leader.kill()
+        kill_time = time.monotonic()
+        await redis_db_object.remove_job('holder', [res_1])
+        while (await redis_db_object.get_token_state(token)).state != TOKEN_FILLED:
+            await asyncio.sleep(0.01)
+        failover_time = time.monotonic() - kill_time
+        logging.info(f'failover time: {failover_time:.3f} seconds')
+        assert not standby.is_standby()
+        assert failover_time < 2 * lease_time
+        assert standby.get_metrics()['ha']['takeovers'] == 1
+        assert (await standby.get_resource_req_resp(token)).names == [res_1.name]
+    finally:
+        leader.kill()
+        leader.join()
+        await standby.stop_backend()
+
+
+async def test_recovery_in_batches_with_bounded_concurrency(redis_db_object):
+    res_1 = Resource(name='res1', type='type1', status=ACTIVE_STATUS)
+    await redis_db_object.add_resource(res_1)
+    for index in range(50):
+        user_request = ResourcesRequest(token=f'token_{index}')
+        user_request.add_request_by_names([res_1.name], count=1)
+        await redis_db_object.add_resources_request(user_request)
+    qrm_be = QueueManagerBackEnd(background_recovery=True, recovery_batch_size=10, recovery_concurrency=5)
+    try:
+        workers = {'active': 0, 'max_active': 0, 'started': set()}
+
+        async def names_worker(token: str) -> None:
+            workers['active'] += 1
+            workers['max_active'] = max(workers['max_active'], workers['active'])
+            workers['started'].add(token)
+            await asyncio.sleep(0.01)
+            workers['active'] -= 1
+            qrm_be.worker_started(token)
+
+        qrm_be.names_worker = names_worker
+        await qrm_be.init_backend()
+        # the backend is ready before the recovery is done
+        assert qrm_be.get_metrics()['recovery']['state'] == 'running'
+        await asyncio.wait_for(qrm_be.recovery_task, timeout=2)
+        assert workers['started'] == {f'token_{index}' for index in range(50)}
+        assert workers['max_active'] == 5
+        recovery_metrics = qrm_be.get_metrics()['recovery']
+        assert recovery_metrics['state'] == 'done'
+        assert recovery_metrics['tokens'] == recovery_metrics['open_requests'] == recovery_metrics['workers'] == 50
+    finally:
+        await qrm_be.stop_backend()
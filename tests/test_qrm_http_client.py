@@ -1,9 +1,12 @@
 import json
+import qrm_defs.qrm_urls
 
+from pytest_httpserver import HTTPServer
+from werkzeug.wrappers import Request, Response
 from qrm_server import qrm_http_server
-from qrm_client.qrm_http_client import QrmClient
+from qrm_client.qrm_http_client import QrmClient, PollingBackoff
 from qrm_defs.resource_definition import ResourcesRequest, ResourcesByName, ACTIVE_STATUS, PENDING_STATUS, \
-    generate_token_from_seed, json_to_dict
+    generate_token_from_seed, json_to_dict, ResourcesRequestResponse
 
 
 def test_qrm_http_client_get_root_url_debug(qrm_http_client_with_server_mock_debug_prints: QrmClient):
@@ -72,6 +75,49 @@ def test_qrm_http_client_get_token_status(qrm_http_client_with_server_mock, defa
     assert resp_data.get('names') is not None
 
 
+def test_qrm_http_client_get_tokens_status(qrm_http_client_with_server_mock, default_test_token):
+    tokens_status = qrm_http_client_with_server_mock.get_tokens_status([default_test_token])
+    assert isinstance(tokens_status, dict)
+    assert tokens_status[default_test_token].get('token') == default_test_token
+    assert tokens_status[default_test_token].get('request_complete') is not None
+    assert tokens_status[default_test_token].get('names') is not None
+
+
+def test_qrm_http_client_get_token_status_not_modified(httpserver: HTTPServer, default_test_token):
+    etag = '"1"'
+    requests_etags = []
+
+    def handler(request: Request):
+        requests_etags.append(request.headers.get('If-None-Match'))
+        if request.headers.get('If-None-Match') == etag:
+            return Response(status=304, headers={'ETag': etag})
+        rrr_json = ResourcesRequestResponse(token=default_test_token, names=['res1']).to_json()
+        return Response(json.dumps(rrr_json), status=200, content_type='application/json', headers={'ETag': etag})
+
+    httpserver.expect_request(qrm_defs.qrm_urls.URL_GET_TOKEN_STATUS).respond_with_handler(handler)
+    qrm_client_obj = QrmClient(server_ip=httpserver.host, server_port=httpserver.port, user_name='test_user')
+    first_status = qrm_client_obj.get_token_status(default_test_token)
+    second_status = qrm_client_obj.get_token_status(default_test_token)
+    assert requests_etags == [None, etag]
+    assert first_status == second_status
+    assert second_status.get('names') == ['res1']
+
+
+def test_polling_backoff():
+    backoff = PollingBackoff(min_sleep_time=1, max_sleep_time=4, factor=2, jitter=0)
+    assert backoff.next_sleep_time(status_changed=True) == 1
+    assert backoff.next_sleep_time(status_changed=False) == 2
+    assert backoff.next_sleep_time(status_changed=False) == 4
+    assert backoff.next_sleep_time(status_changed=False) == 4
+    assert backoff.next_sleep_time(status_changed=True) == 1
+
+
+def test_polling_backoff_jitter():
+    backoff = PollingBackoff(min_sleep_time=1, max_sleep_time=4, factor=2, jitter=0.2)
+    for _ in range(100):
+        assert 0.8 <= backoff.next_sleep_time(status_changed=True) <= 1.2
+
+
 def test_qrm_http_client_get_is_server_up(qrm_http_client_with_server_mock, default_test_token):
     resp_data = qrm_http_client_with_server_mock.wait_for_server_up()
     assert isinstance(resp_data, dict)
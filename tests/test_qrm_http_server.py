@@ -81,3 +81,72 @@ async def test_http_server_get_token_status_is_done(post_to_http_server, qrm_bac
     assert rrr_obj.token == token
     assert 'res1' in rrr_obj.names
     assert 'res2' in rrr_obj.names
+
+
+async def test_http_server_get_tokens_status(post_to_http_server, qrm_backend_mock_cls):
+    tokens = ['token_1', 'token_2']
+    qrm_backend_mock_cls.for_test_is_request_active = False
+    qrm_backend_mock_cls.get_filled_request_obj = ResourcesRequestResponse(names=['res1'])
+    qrm_http_server.init_qrm_back_end(qrm_backend_mock_cls)
+    resp = await post_to_http_server.post(qrm_defs.qrm_urls.URL_POST_TOKENS_STATUS,
+                                          data=json.dumps({'tokens': tokens}))
+    resp_dict = await resp.json()
+    assert resp.status == 200
+    assert list(resp_dict.keys()) == tokens
+    for token in tokens:
+        rrr_obj = ResourcesRequestResponse.from_dict(resp_dict[token])
+        assert rrr_obj.token == token
+        assert rrr_obj.request_complete
+        assert rrr_obj.names == ['res1']
+
+
+async def test_http_server_get_token_status_not_modified(post_to_http_server, qrm_backend_mock_cls):
+    token = 'my_req_token'
+    qrm_backend_mock_cls.for_test_token_revision = 3
+    qrm_http_server.init_qrm_back_end(qrm_backend_mock_cls)
+    resp = await post_to_http_server.get(qrm_defs.qrm_urls.URL_GET_TOKEN_STATUS, params={'token': token})
+    assert resp.status == 200
+    etag = resp.headers['ETag']
+    assert etag == qrm_http_server.token_etag(3)
+
+    resp = await post_to_http_server.get(qrm_defs.qrm_urls.URL_GET_TOKEN_STATUS, params={'token': token},
+                                         headers={'If-None-Match': etag})
+    assert resp.status == 304
+    assert not await resp.read()
+
+    # new revision, the full status is sent again:
+    qrm_backend_mock_cls.for_test_token_revision = 4
+    qrm_http_server.token_status_cache.invalidate(token)
+    resp = await post_to_http_server.get(qrm_defs.qrm_urls.URL_GET_TOKEN_STATUS, params={'token': token},
+                                         headers={'If-None-Match': etag})
+    assert resp.status == 200
+    assert resp.headers['ETag'] == qrm_http_server.token_etag(4)
+
+
+async def test_http_server_get_token_status_cached(post_to_http_server, qrm_backend_mock_cls):
+    token = 'my_req_token'
+    qrm_http_server.init_qrm_back_end(qrm_backend_mock_cls)
+    for _ in range(3):
+        resp = await post_to_http_server.get(qrm_defs.qrm_urls.URL_GET_TOKEN_STATUS, params={'token': token})
+        assert resp.status == 200
+    resp = await post_to_http_server.get(qrm_defs.qrm_urls.URL_GET_METRICS)
+    cache_metrics = (await resp.json())['token_status_cache']
+    assert cache_metrics['computed'] == 1
+    assert cache_metrics['hits'] == 2
+
+    qrm_http_server.token_status_cache.invalidate(token)
+    await post_to_http_server.get(qrm_defs.qrm_urls.URL_GET_TOKEN_STATUS, params={'token': token})
+    resp = await post_to_http_server.get(qrm_defs.qrm_urls.URL_GET_METRICS)
+    assert (await resp.json())['token_status_cache']['computed'] == 2
+
+
+async def test_http_server_new_request_on_standby(post_to_http_server, qrm_backend_mock_cls):
+    user_request = ResourcesRequest()
+    user_request.add_request_by_token('my_req_token')
+    qrm_backend_mock_cls.for_test_is_standby = True
+    qrm_http_server.init_qrm_back_end(qrm_backend_mock_cls)
+    resp = await post_to_http_server.post(qrm_defs.qrm_urls.URL_POST_NEW_REQUEST,
+                                          data=json.dumps(user_request.to_json()))
+    rrr_obj = ResourcesRequestResponse.from_json(await resp.json())
+    assert resp.status == 503
+    assert not rrr_obj.is_valid
@@ -1,12 +1,15 @@
+import asyncio
 import copy
 import json
 import time
 import pytest
 import subprocess
 
-from db_adapters.redis_adapter import RedisDB
+from db_adapters.redis_adapter import RedisDB, RESOURCE_TOKEN_MAP, TOKEN_STATE, PARTIAL_FILL_REQUESTS, \
+    OPEN_REQUESTS, OWNER_USAGE, RESOURCE_OWNER
 from qrm_defs.resource_definition import Resource, ResourcesRequest, ResourcesRequestResponse, \
-    generate_token_from_seed, ACTIVE_STATUS
+    generate_token_from_seed, ACTIVE_STATUS, TOKEN_QUEUED, TOKEN_PARTIAL, TOKEN_WAITING_ACTIVE, TOKEN_FILLED, \
+    TOKEN_CANCELED, TOKEN_INVALID
 
 
 def test_env():
@@ -582,3 +585,392 @@ async def test_original_request(redis_db_object, resource_foo, resource_bar):
     assert res_req == open_requests[req_token]
     orig_request = await redis_db_object.get_orig_request(req_token)
     assert orig_request == res_req
+
+
+async def test_get_tokens_status_snapshot(redis_db_object, resource_foo, resource_bar):
+    await redis_db_object.add_resource(resource_foo)
+    await redis_db_object.add_resource(resource_bar)
+    await redis_db_object.add_job_to_resource(resource_foo, {'token': 'token1'})
+    await redis_db_object.generate_token('token1', [resource_foo])
+    await redis_db_object.set_req_resp(ResourcesRequestResponse(names=[resource_foo.name], token='token1'))
+    res_req = ResourcesRequest(token='token2')
+    res_req.add_request_by_names(names=[resource_bar.name], count=1)
+    await redis_db_object.add_resources_request(res_req)
+
+    snapshot = await redis_db_object.get_tokens_status_snapshot(['token1', 'token2', 'unknown'])
+    assert snapshot['tokens']['token1']['is_filled']
+    assert snapshot['tokens']['token1']['req_resp'].names == [resource_foo.name]
+    assert snapshot['tokens']['token1']['token_resources'] == [resource_foo]
+    assert not snapshot['tokens']['token2']['is_filled']
+    assert snapshot['tokens']['unknown']['req_resp'].message == 'no response for token'
+    assert snapshot['owners'][resource_foo.name] == 'token1'
+    assert snapshot['active_jobs'][resource_foo.name] == {'token': 'token1'}
+    assert resource_bar.name not in snapshot['active_jobs']
+
+
+async def test_get_tokens_status_snapshot_no_tokens(redis_db_object):
+    snapshot = await redis_db_object.get_tokens_status_snapshot([])
+    assert snapshot == {'tokens': {}, 'owners': {}, 'active_jobs': {}}
+
+
+async def test_resources_tokens_map(redis_db_object, resource_foo, resource_bar):
+    await redis_db_object.add_resource(resource_foo)
+    await redis_db_object.add_resource(resource_bar)
+    await redis_db_object.set_token_for_resource('token1', resource_foo)
+    assert await redis_db_object.get_resources_tokens([resource_foo.name, resource_bar.name, 'not_exist']) == \
+           {resource_foo.name: 'token1', resource_bar.name: '', 'not_exist': ''}
+    await redis_db_object.set_token_for_resource('token2', resource_foo)
+    assert await redis_db_object.get_resources_tokens([resource_foo.name]) == {resource_foo.name: 'token2'}
+    await redis_db_object.remove_resource(resource_foo)
+    assert await redis_db_object.get_resources_tokens([resource_foo.name]) == {resource_foo.name: ''}
+
+
+async def test_rebuild_resource_token_map(redis_db_object, resource_foo, resource_bar):
+    resource_foo.token = 'token1'
+    await redis_db_object.add_resource(resource_foo)
+    await redis_db_object.add_resource(resource_bar)
+    await redis_db_object.redis.delete(RESOURCE_TOKEN_MAP)  # DB from a version without the map
+    await redis_db_object.rebuild_resource_token_map()
+    assert await redis_db_object.get_resources_tokens([resource_foo.name, resource_bar.name]) == \
+           {resource_foo.name: 'token1', resource_bar.name: ''}
+
+
+async def test_token_revision_changes_with_token_status(redis_db_object, resource_foo):
+    token = 'token1'
+    await redis_db_object.add_resource(resource_foo)
+    assert await redis_db_object.get_token_revision(token) == 0
+    await redis_db_object.set_req_resp(ResourcesRequestResponse(token=token))
+    revision_1 = await redis_db_object.get_token_revision(token)
+    await redis_db_object.add_job_to_resource(resource_foo, {'token': token})
+    revision_2 = await redis_db_object.get_token_revision(token)
+    await redis_db_object.generate_token(token, [resource_foo])
+    revision_3 = await redis_db_object.get_token_revision(token)
+    assert 0 < revision_1 < revision_2 < revision_3
+
+
+async def test_token_revision_changes_for_new_active_job(redis_db_object, resource_foo):
+    await redis_db_object.add_resource(resource_foo)
+    await redis_db_object.add_job_to_resource(resource_foo, {'token': 'token1'})
+    await redis_db_object.add_job_to_resource(resource_foo, {'token': 'token2'})
+    revision = await redis_db_object.get_token_revision('token2')
+    await redis_db_object.remove_job('token1', [resource_foo])
+    assert await redis_db_object.get_token_revision('token2') > revision
+
+
+async def test_token_state_transitions(redis_db_object, resource_foo, resource_bar):
+    token = 'token1'
+    assert await redis_db_object.get_token_state(token) is None
+    res_req = ResourcesRequest(token=token)
+    res_req.add_request_by_names(names=[resource_foo.name, resource_bar.name], count=2)
+    await redis_db_object.add_resources_request(res_req)
+    assert (await redis_db_object.get_token_state(token)).state == TOKEN_QUEUED
+    await redis_db_object.partial_fill_request(token, resource_foo)
+    token_state = await redis_db_object.get_token_state(token)
+    assert token_state.state == TOKEN_PARTIAL
+    assert token_state.grants == [resource_foo.name]
+    await redis_db_object.partial_fill_request(token, resource_bar)
+    assert (await redis_db_object.get_token_state(token)).grants == [resource_foo.name, resource_bar.name]
+    await redis_db_object.remove_open_request(token)
+    assert (await redis_db_object.get_token_state(token)).state == TOKEN_WAITING_ACTIVE
+    assert not await redis_db_object.is_request_filled(token)
+    await redis_db_object.generate_token(token, [resource_bar, resource_foo])
+    token_state = await redis_db_object.get_token_state(token)
+    assert token_state.state == TOKEN_FILLED
+    assert token_state.grants == [resource_bar.name, resource_foo.name]
+    assert list(token_state.timestamps) == [TOKEN_QUEUED, TOKEN_PARTIAL, TOKEN_WAITING_ACTIVE, TOKEN_FILLED]
+    assert await redis_db_object.is_request_filled(token)
+    assert await redis_db_object.get_all_open_tokens() == [token]
+
+
+async def test_token_final_state_does_not_change(redis_db_object, resource_foo):
+    token = 'token1'
+    await redis_db_object.add_resources_request(ResourcesRequest(token=token))
+    revision = await redis_db_object.get_token_revision(token)
+    rrr = ResourcesRequestResponse(token=token, is_valid=False)
+    await redis_db_object.set_token_state(token, TOKEN_CANCELED, rrr=rrr)
+    assert await redis_db_object.get_token_revision(token) > revision
+    assert not (await redis_db_object.get_req_resp_for_token(token)).is_valid
+    await redis_db_object.partial_fill_request(token, resource_foo)
+    await redis_db_object.set_token_state(token, TOKEN_INVALID)
+    assert (await redis_db_object.get_token_state(token)).state == TOKEN_CANCELED
+
+
+async def test_destroy_token_invalidates_filled_token(redis_db_object, resource_foo):
+    token = 'token1'
+    await redis_db_object.generate_token(token, [resource_foo])
+    await redis_db_object.destroy_token(token)
+    assert (await redis_db_object.get_token_state(token)).state == TOKEN_INVALID
+    assert not await redis_db_object.is_request_filled(token)
+
+
+async def test_rebuild_tokens_state(redis_db_object, resource_foo, resource_bar):
+    await redis_db_object.generate_token('filled_token', [resource_foo])
+    res_req = ResourcesRequest(token='partial_token')
+    res_req.add_request_by_names(names=[resource_bar.name], count=1)
+    await redis_db_object.add_resources_request(res_req)
+    # DB from a version without the state record:
+    await redis_db_object.redis.hset(PARTIAL_FILL_REQUESTS, 'partial_token', json.dumps([resource_bar.name]))
+    await redis_db_object.redis.delete(TOKEN_STATE)
+    assert (await redis_db_object.get_token_state('filled_token')).state == TOKEN_FILLED
+    await redis_db_object.rebuild_tokens_state()
+    tokens_state = await redis_db_object.get_all_tokens_state()
+    assert tokens_state['filled_token'].state == TOKEN_FILLED
+    assert tokens_state['filled_token'].grants == [resource_foo.name]
+    assert tokens_state['partial_token'].state == TOKEN_PARTIAL
+    assert tokens_state['partial_token'].grants == [resource_bar.name]
+
+
+async def test_partial_fill_updates_open_request_group(redis_db_object, resource_foo, resource_bar):
+    token = 'token1'
+    res_req = ResourcesRequest(token=token)
+    res_req.add_request_by_names(names=[resource_foo.name], count=1)
+    res_req.add_request_by_names(names=[resource_foo.name, resource_bar.name], count=2)
+    await redis_db_object.add_resources_request(res_req)
+    revision = await redis_db_object.get_token_revision(token)
+    await redis_db_object.partial_fill_request(token, resource_bar, req_index=1)
+    open_request = await redis_db_object.get_open_request_by_token(token)
+    assert open_request.names[0].count == 1
+    assert open_request.names[0].names == [resource_foo.name]
+    assert open_request.names[1].count == 1
+    assert open_request.names[1].names == [resource_foo.name]
+    assert (await redis_db_object.get_open_requests())[token] == open_request
+    assert await redis_db_object.get_token_revision(token) == revision + 1
+    rrr = await redis_db_object.get_req_resp_for_token(token)
+    assert rrr == ResourcesRequestResponse(names=[resource_bar.name], token=token)
+    token_state = await redis_db_object.get_token_state(token)
+    assert token_state.state == TOKEN_PARTIAL
+    assert token_state.grants == [resource_bar.name]
+    assert list(token_state.timestamps) == [TOKEN_QUEUED, TOKEN_PARTIAL]
+
+    # the same resource is granted only once:
+    await redis_db_object.partial_fill_request(token, resource_bar, req_index=1)
+    assert (await redis_db_object.get_open_request_by_token(token)).names[1].count == 1
+    assert await redis_db_object.get_token_revision(token) == revision + 1
+
+    await redis_db_object.remove_open_request(token)
+    assert await redis_db_object.get_partial_fill(token) == ResourcesRequestResponse([resource_bar.name], token)
+    assert not await redis_db_object.redis.keys('open_request_*')
+
+
+async def test_rebuild_open_requests(redis_db_object, resource_foo, resource_bar):
+    token = 'token1'
+    res_req = ResourcesRequest(token=token)
+    res_req.add_request_by_names(names=[resource_foo.name, resource_bar.name], count=1)
+    # DB from a version that stored the whole request and the fill list as json:
+    await redis_db_object.redis.hset(OPEN_REQUESTS, token, res_req.to_json())
+    await redis_db_object.redis.hset(PARTIAL_FILL_REQUESTS, token, json.dumps([resource_foo.name]))
+    await redis_db_object.rebuild_open_requests()
+    assert await redis_db_object.get_open_request_by_token(token) == res_req
+    assert await redis_db_object.get_partial_fill(token) == ResourcesRequestResponse([resource_foo.name], token)
+    await redis_db_object.partial_fill_request(token, resource_bar, req_index=0)
+    open_request = await redis_db_object.get_open_request_by_token(token)
+    assert open_request.names[0].count == 0
+    assert open_request.names[0].names == [resource_foo.name]
+
+
+async def test_add_job_with_priority(redis_db_object, resource_foo):
+    await redis_db_object.add_resource(resource_foo)
+    now = time.time()
+    head = {'token': 'head', 'priority': 0, 'enqueue_time': now}
+    low = {'token': 'low', 'priority': 0, 'enqueue_time': now}
+    high = {'token': 'high', 'priority': 5, 'enqueue_time': now}
+    high_2 = {'token': 'high_2', 'priority': 5, 'enqueue_time': now}
+    for job in [head, low, high, high_2]:
+        await redis_db_object.add_job_to_resource(resource_foo, job)
+    # the head is kept, jobs with the same priority are in arrival order:
+    assert await redis_db_object.get_resource_jobs(resource_foo) == [low, high_2, high, head, {}]
+    assert await redis_db_object.get_active_job(resource_foo) == head
+
+
+async def test_add_job_with_priority_aging(redis_db_object, resource_foo):
+    await redis_db_object.add_resource(resource_foo)
+    now = time.time()
+    head = {'token': 'head', 'priority': 0, 'enqueue_time': now}
+    old_low = {'token': 'old_low', 'priority': 0, 'enqueue_time': now - 3 * redis_db_object.priority_aging_time}
+    new_low = {'token': 'new_low', 'priority': 0, 'enqueue_time': now}
+    no_priority = {'token': 'no_priority'}
+    high = {'token': 'high', 'priority': 2, 'enqueue_time': now}
+    for job in [head, no_priority, old_low, new_low, high]:
+        await redis_db_object.add_job_to_resource(resource_foo, job)
+    # the old job waited long enough to have higher priority:
+    assert await redis_db_object.get_resource_jobs(resource_foo) == [new_low, high, old_low, no_priority, head, {}]
+    # jobs without priority are never passed:
+    await redis_db_object.remove_job('old_low', [resource_foo])
+    await redis_db_object.remove_job('high', [resource_foo])
+    await redis_db_object.add_job_to_resource(resource_foo, high)
+    assert await redis_db_object.get_resource_jobs(resource_foo) == [new_low, high, no_priority, head, {}]
+
+
+async def test_add_job_to_resources(redis_db_object):
+    res_1 = Resource(name='res1', type='type1')
+    res_2 = Resource(name='res2', type='type1')
+    await redis_db_object.add_resource(res_1)
+    await redis_db_object.add_resource(res_2)
+    now = time.time()
+    head = {'token': 'head', 'priority': 0, 'enqueue_time': now}
+    single = {'token': 'single', 'priority': 0, 'enqueue_time': now, 'queues': 1}
+    await redis_db_object.add_job_to_resource(res_2, head)
+    first = {'token': 'first', 'priority': 0, 'enqueue_time': now, 'queues': 2}
+    first['seq'] = await redis_db_object.add_job_to_resources([res_1, res_2], first)
+    await redis_db_object.add_job_to_resource(res_2, single)
+    # high passes only the jobs of one queue, jobs of several queues stay in sequence order
+    high = {'token': 'high', 'priority': 5, 'enqueue_time': now, 'queues': 2}
+    high['seq'] = await redis_db_object.add_job_to_resources([res_1, res_2], high)
+    assert high['seq'] == first['seq'] + 1
+    assert await redis_db_object.get_resource_jobs(res_1) == [high, first, {}]
+    assert await redis_db_object.get_resource_jobs(res_2) == [single, high, first, head, {}]
+    # the jobs are found and removed like any other job
+    await redis_db_object.remove_job('first', [res_1, res_2])
+    assert await redis_db_object.get_resource_jobs(res_2) == [single, high, head, {}]
+
+
+async def test_owner_usage_accounting(redis_db_object, resource_foo):
+    await redis_db_object.add_resource(resource_foo)
+    await redis_db_object.add_job_to_resource(resource_foo, {'token': 'token_a', 'owner': 'team_a'})
+    await redis_db_object.partial_fill_request('token_a', resource_foo, owner='team_a')
+    owners_usage = await redis_db_object.get_owners_usage()
+    assert owners_usage['team_a']['held'] == 1
+
+    # the resource is released when the job of the token that holds it is removed
+    await redis_db_object.remove_job('token_a', [resource_foo])
+    owners_usage = await redis_db_object.get_owners_usage()
+    assert owners_usage['team_a']['held'] == 0
+    assert owners_usage['team_a']['usage'] > 0
+
+    # two resources held for one decay time, with no usage before
+    decay_time = redis_db_object.owner_usage_decay_time
+    await redis_db_object.redis.hset(OWNER_USAGE, 'team_b',
+                                     json.dumps({'usage': 0, 'held': 2, 'time': time.time() - decay_time}))
+    owners_usage = await redis_db_object.get_owners_usage()
+    assert owners_usage['team_b']['usage'] == pytest.approx(2 * decay_time * (1 - 1 / 2.718281828), rel=0.01)
+
+
+async def test_remove_active_job_with_fair_share(redis_db_object, resource_foo):
+    redis_db_object.use_fair_share = True
+    await redis_db_object.add_resource(resource_foo)
+    now = time.time()
+    for owner, usage in [('heavy', 1000), ('light', 10), ('capped', 0.5)]:
+        await redis_db_object.redis.hset(OWNER_USAGE, owner, json.dumps({'usage': usage, 'held': 1, 'time': now}))
+    await redis_db_object.set_owner_share('capped', max_held=1)
+    head = {'token': 'head', 'priority': 0, 'enqueue_time': now, 'owner': 'heavy', 'queues': 1}
+    heavy = {'token': 'heavy', 'priority': 0, 'enqueue_time': now, 'owner': 'heavy', 'queues': 1}
+    light = {'token': 'light', 'priority': 0, 'enqueue_time': now, 'owner': 'light', 'queues': 1}
+    capped = {'token': 'capped', 'priority': 0, 'enqueue_time': now, 'owner': 'capped', 'queues': 1}
+    for job in [head, heavy, capped, light]:
+        await redis_db_object.add_job_to_resource(resource_foo, job)
+
+    # the owner with the lowest usage that is below its cap is next:
+    await redis_db_object.remove_job('head', [resource_foo])
+    assert await redis_db_object.get_resource_jobs(resource_foo) == [capped, heavy, light, {}]
+
+    # with weight 10000 heavy usage share is lower than capped
+    await redis_db_object.set_owner_share('heavy', weight=10000)
+    await redis_db_object.set_owner_share('capped', max_held=0)
+    await redis_db_object.remove_job('light', [resource_foo])
+    assert await redis_db_object.get_active_job(resource_foo) == heavy
+
+
+async def test_hold_time_history(redis_db_object, resource_foo):
+    await redis_db_object.add_resource(resource_foo)
+    assert await redis_db_object.get_hold_times(['team_a']) == {}
+    for token, hold_time in [('token_1', 10), ('token_2', 20)]:
+        await redis_db_object.add_job_to_resource(resource_foo, {'token': token, 'owner': 'team_a'})
+        await redis_db_object.partial_fill_request(token, resource_foo, owner='team_a')
+        holder = (await redis_db_object.get_resources_holders([resource_foo.name]))[resource_foo.name]
+        assert holder['token'] == token
+        holder['time'] -= hold_time
+        await redis_db_object.redis.hset(RESOURCE_OWNER, resource_foo.name, json.dumps(holder))
+        await redis_db_object.remove_job(token, [resource_foo])
+    hold_times = await redis_db_object.get_hold_times(['team_a', 'team_b'])
+    # moving average of 10 and 20, team_b has no history so it gets the average of all the owners
+    assert hold_times['team_a'] == pytest.approx(12, abs=0.1)
+    assert hold_times['team_b'] == hold_times['team_a']
+
+
+async def test_backfill_job(redis_db_object, resource_foo):
+    await redis_db_object.add_resource(resource_foo)
+    head = {'token': 'head'}
+    first = {'token': 'first'}
+    second = {'token': 'second'}
+    for job in [head, first, second]:
+        await redis_db_object.add_job_to_resource(resource_foo, job)
+    assert not await redis_db_object.backfill_job(resource_foo, 'first', 'second')
+    assert await redis_db_object.backfill_job(resource_foo, 'head', 'second')
+    assert await redis_db_object.get_resource_jobs(resource_foo) == [first, head, second, {}]
+
+
+@pytest.mark.asyncio
+async def test_pool_hands_free_resources_to_lowest_sequence(redis_db_object):
+    resources = [Resource(name=f'res{i}', type='type1', status=ACTIVE_STATUS) for i in range(3)]
+    for resource in resources:
+        await redis_db_object.add_resource(resource)
+    await redis_db_object.add_job_to_resource(resources[2], {'token': 'holder'})
+    names = [resource.name for resource in resources]
+    first = {'token': 'first', 'seq': 1}
+    # the free resources are handed at once, the job waits in the pool for the third one
+    pool_id, handed = await redis_db_object.add_job_to_pool(names, first, 3)
+    assert handed == ['res0', 'res1']
+    assert await redis_db_object.get_pool_queue(pool_id) == ['first']
+    assert await redis_db_object.get_active_job(resources[0]) == first
+
+    # the job of the smaller pool waits longer, but the first job has lower sequence
+    second = {'token': 'second', 'seq': 2}
+    small_pool_id, handed = await redis_db_object.add_job_to_pool(names[1:], second, 1)
+    assert handed == []
+    await redis_db_object.remove_job('holder', [resources[2]])
+    assert await redis_db_object.get_active_job(resources[2]) == first
+    assert await redis_db_object.get_pool_handed('first') == names
+    assert await redis_db_object.get_pool_queue(pool_id) == []
+
+    await redis_db_object.remove_job('first', [resources[1]])
+    assert await redis_db_object.get_active_job(resources[1]) == second
+    assert await redis_db_object.get_pool_queue(small_pool_id) == []
+
+
+@pytest.mark.asyncio
+async def test_claim_resource_of_other_token(redis_db_object, resource_foo):
+    await redis_db_object.add_resource(resource_foo)
+    await redis_db_object.add_job_to_resource(resource_foo, {'token': 'active'})
+    await redis_db_object.add_job_to_resource(resource_foo, {'token': 'waiting'})
+    assert not await redis_db_object.partial_fill_request('waiting', resource_foo, claim=True)
+    assert (await redis_db_object.get_partial_fill('waiting')).names == []
+    assert await redis_db_object.partial_fill_request('active', resource_foo, claim=True)
+    assert (await redis_db_object.get_partial_fill('active')).names == [resource_foo.name]
+
+
+async def test_leader_lease(redis_db_object):
+    assert await redis_db_object.acquire_lease('a', lease_time=0.2)
+    assert not await redis_db_object.acquire_lease('b', lease_time=0.2)
+    assert await redis_db_object.acquire_lease('a', lease_time=0.2)
+    assert await redis_db_object.get_leader() == 'a'
+    await asyncio.sleep(0.1)
+    assert await redis_db_object.renew_lease('a', lease_time=0.2)
+    await asyncio.sleep(0.15)
+    assert not await redis_db_object.renew_lease('b', lease_time=0.2)
+    await redis_db_object.release_lease('b')
+    assert await redis_db_object.get_leader() == 'a'
+    # the lease expires when the leader stops renewing it
+    await asyncio.sleep(0.25)
+    assert not await redis_db_object.renew_lease('a', lease_time=0.2)
+    assert await redis_db_object.acquire_lease('b', lease_time=0.2)
+    await redis_db_object.release_lease('b')
+    assert await redis_db_object.get_leader() is None
+
+
+async def test_token_event_is_published_to_token_instance(redis_my):
+    instances = {instance_id: RedisDB(redis_port=6379, pubsub_polling_time=0.05, instance_id=instance_id)
+                 for instance_id in ['a', 'b']}
+    received = {instance_id: [] for instance_id in instances}
+    try:
+        for instance_id, instance in instances.items():
+            instance.add_token_event_callback(lambda token_event, events=received[instance_id]:
+                                              events.append(token_event['token']))
+        await asyncio.sleep(0.2)  # let the readers subscribe
+        await instances['a'].set_token_instance('token_b', 'b')
+        await instances['a'].publish_token_event('token_b', instance_id='a')
+        await instances['a'].publish_token_event('token_without_instance', instance_id='a')
+        await asyncio.sleep(0.3)
+        assert received == {'a': ['token_without_instance'], 'b': ['token_b', 'token_without_instance']}
+    finally:
+        for instance in instances.values():
+            await instance.close()
@@ -0,0 +1,62 @@
+import asyncio
+import pytest
+
+from qrm_server.resource_locks import ResourceLocks
+
+
+async def hold_for(locks: ResourceLocks, names: list, hold_time: float, order: list, label: str) -> None:
+    async with locks.hold(names):
+        order.append(f'{label}_start')
+        await asyncio.sleep(hold_time)
+        order.append(f'{label}_end')
+
+
+async def test_disjoint_resources_dont_wait():
+    locks = ResourceLocks()
+    order = []
+    await asyncio.gather(hold_for(locks, ['res1'], 0.05, order, 'a'),
+                         hold_for(locks, ['res2'], 0.05, order, 'b'))
+    assert order[:2] == ['a_start', 'b_start']
+    metrics = locks.get_metrics()
+    assert metrics['acquired'] == 2
+    assert metrics['contended'] == 0
+    assert metrics['locks'] == 0
+
+
+async def test_same_resource_is_serialized():
+    locks = ResourceLocks()
+    order = []
+    await asyncio.gather(hold_for(locks, ['res1', 'res2'], 0.05, order, 'a'),
+                         hold_for(locks, ['res2'], 0.01, order, 'b'))
+    assert order == ['a_start', 'a_end', 'b_start', 'b_end']
+    metrics = locks.get_metrics()
+    assert metrics['contended'] == 1
+    assert metrics['max_wait_time'] >= 0.04
+    assert metrics['mean_hold_time'] > 0
+
+
+async def test_overlapping_resources_in_any_order_dont_deadlock():
+    locks = ResourceLocks()
+    order = []
+    tasks = [hold_for(locks, ['res1', 'res2', 'res3'], 0.01, order, 'a'),
+             hold_for(locks, ['res3', 'res2', 'res1'], 0.01, order, 'b'),
+             hold_for(locks, ['res2', 'res1'], 0.01, order, 'c')]
+    await asyncio.wait_for(asyncio.gather(*tasks), timeout=1)
+    assert len(order) == 6
+    assert locks.get_metrics()['locks'] == 0
+
+
+async def test_canceled_waiter_releases_its_locks():
+    locks = ResourceLocks()
+    order = []
+    holder = asyncio.ensure_future(hold_for(locks, ['res2'], 0.1, order, 'a'))
+    await asyncio.sleep(0.01)
+    waiter = asyncio.ensure_future(hold_for(locks, ['res1', 'res2'], 0, order, 'b'))
+    await asyncio.sleep(0.01)
+    waiter.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await waiter
+    # res1 was locked by the canceled waiter, it's free again
+    await asyncio.wait_for(hold_for(locks, ['res1'], 0, order, 'c'), timeout=0.05)
+    await holder
+    assert locks.get_metrics()['locks'] == 0
@@ -0,0 +1,62 @@
+import json
+
+import qrm_defs.qrm_urls
+from aiohttp import web
+from qrm_defs.resource_definition import Resource, ResourcesRequest, ACTIVE_STATUS
+from qrm_server.shard_router import ShardRouter, create_app
+
+
+async def test_new_request_url_by_shard(redis_db_object):
+    for resource in [Resource(name='r1', type='t1', status=ACTIVE_STATUS),
+                     Resource(name='r2', type='t1', status=ACTIVE_STATUS),
+                     Resource(name='r3', type='t2', status=ACTIVE_STATUS),
+                     Resource(name='r4', type='t1', shard='gpu', status=ACTIVE_STATUS)]:
+        await redis_db_object.add_resource(resource)
+        await redis_db_object.add_tag_to_resource(resource, resource.get_shard())
+    router = ShardRouter({'t1': 'http://t1', 'gpu': 'http://gpu'}, 'http://default')
+    await router.start()
+    try:
+        assert await router.new_request_url({'names': [{'names': ['r1', 'r2'], 'count': 1}]}) == 'http://t1'
+        assert await router.new_request_url({'names': [], 'tags': [{'tags': ['gpu'], 'count': 1}]}) == 'http://gpu'
+        # shard without server
+        assert await router.new_request_url({'names': [{'names': ['r3'], 'count': 1}]}) == 'http://default'
+        # several shards
+        assert await router.new_request_url({'names': [{'names': ['r1'], 'count': 1},
+                                                       {'names': ['r4'], 'count': 1}]}) == 'http://default'
+        assert router.metrics['cross_shard'] == 1
+    finally:
+        await router.stop()
+
+
+async def test_forward_requests(redis_db_object, aiohttp_server, aiohttp_client):
+    await redis_db_object.add_resource(Resource(name='r1', type='t1', status=ACTIVE_STATUS))
+    received = []
+
+    def upstream_app(name: str) -> web.Application:
+        async def handler(request: web.Request) -> web.Response:
+            received.append((name, request.path, request.headers.get('If-None-Match'), await request.text()))
+            return web.json_response({'server': name}, headers={'ETag': '"1"'})
+
+        app = web.Application()
+        app.router.add_post(qrm_defs.qrm_urls.URL_POST_NEW_REQUEST, handler)
+        app.router.add_get(qrm_defs.qrm_urls.URL_GET_TOKEN_STATUS, handler)
+        return app
+
+    shard_server = await aiohttp_server(upstream_app('t1'))
+    default_server = await aiohttp_server(upstream_app('default'))
+    router = ShardRouter({'t1': str(shard_server.make_url(''))}, str(default_server.make_url('')))
+    client = await aiohttp_client(create_app(router))
+
+    user_request = ResourcesRequest(token='token1')
+    user_request.add_request_by_names(['r1'], count=1)
+    request_json = json.dumps(user_request.to_json())
+    resp = await client.post(qrm_defs.qrm_urls.URL_POST_NEW_REQUEST, data=request_json)
+    assert resp.status == 200
+    assert await resp.json() == {'server': 't1'}
+    assert received[-1] == ('t1', qrm_defs.qrm_urls.URL_POST_NEW_REQUEST, None, request_json)
+
+    resp = await client.get(qrm_defs.qrm_urls.URL_GET_TOKEN_STATUS, params={'token': 'token1'},
+                            headers={'If-None-Match': '"1"'})
+    assert await resp.json() == {'server': 'default'}
+    assert resp.headers['ETag'] == '"1"'
+    assert received[-1][:3] == ('default', qrm_defs.qrm_urls.URL_GET_TOKEN_STATUS, '"1"')
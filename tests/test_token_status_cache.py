@@ -0,0 +1,84 @@
+import asyncio
+import pytest
+
+from qrm_server.token_status_cache import TokenStatusCache
+
+
+class ComputeCounter(object):
+    def __init__(self, delay: float = 0):
+        self.delay = delay
+        self.calls = 0
+
+    async def compute(self, token: str) -> str:
+        self.calls += 1
+        await asyncio.sleep(self.delay)
+        return f'{token}_status_{self.calls}'
+
+
+async def test_cache_lookup_after_compute():
+    cache = TokenStatusCache(ttl=10)
+    counter = ComputeCounter()
+    assert cache.lookup('token1') is None
+    value, computed = await cache.single_flight('token1', counter.compute)
+    assert computed
+    assert cache.lookup('token1') == value
+    metrics = cache.get_metrics()
+    assert metrics['hits'] == 1
+    assert metrics['misses'] == 1
+    assert metrics['hit_rate'] == 0.5
+
+
+async def test_cache_ttl_expired():
+    cache = TokenStatusCache(ttl=0.05)
+    await cache.single_flight('token1', ComputeCounter().compute)
+    await asyncio.sleep(0.1)
+    assert cache.lookup('token1') is None
+    assert cache.get_metrics()['size'] == 0
+
+
+async def test_cache_invalidate():
+    cache = TokenStatusCache(ttl=10)
+    await cache.single_flight('token1', ComputeCounter().compute)
+    cache.invalidate('token1')
+    assert cache.lookup('token1') is None
+    assert cache.get_metrics()['invalidations'] == 1
+
+
+async def test_cache_single_flight_concurrent_lookups():
+    cache = TokenStatusCache(ttl=10)
+    counter = ComputeCounter(delay=0.05)
+    results = await asyncio.gather(*[cache.single_flight('token1', counter.compute) for _ in range(10)])
+    assert counter.calls == 1
+    assert len(set(value for value, _ in results)) == 1
+    assert [computed for _, computed in results].count(True) == 1
+    assert cache.get_metrics()['coalesced'] == 9
+
+
+async def test_cache_invalidate_while_computing_not_stored():
+    cache = TokenStatusCache(ttl=10)
+    task = asyncio.ensure_future(cache.single_flight('token1', ComputeCounter(delay=0.05).compute))
+    await asyncio.sleep(0.01)
+    cache.invalidate('token1')
+    await task
+    assert cache.lookup('token1') is None
+
+
+async def test_cache_single_flight_exception():
+    async def compute_error(token: str) -> str:
+        await asyncio.sleep(0.01)
+        raise ValueError(token)
+
+    cache = TokenStatusCache(ttl=10)
+    with pytest.raises(ValueError):
+        await cache.single_flight('token1', compute_error)
+    assert cache.lookup('token1') is None
+    assert not cache.in_flight
+
+
+async def test_cache_max_size():
+    cache = TokenStatusCache(ttl=10, max_size=2)
+    counter = ComputeCounter()
+    for token in ['token1', 'token2', 'token3']:
+        await cache.single_flight(token, counter.compute)
+    assert cache.lookup('token1') is None
+    assert cache.lookup('token3')